@@ -0,0 +1,431 @@
+# This file is part of forward.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial
+# 4.0 International License. To view a copy of this license, visit
+# http://creativecommons.org/licenses/by-nc/4.0/ or send a letter to Creative
+# Commons, PO Box 1866, Mountain View, CA 94042, USA.
+
+"""
+This module provides a compact store of gene annotations.
+
+The genes of a GTF file are kept as columns (arrays) sorted by chromosome and
+start position instead of a hierarchy of Python objects (see
+:py:class:`forward.utils.EnsemblAnnotationParser`). The chromosomes are
+integer codes and genomic positions are packed with their chromosome in
+64-bit keys (``code << 32 | position``), so that the variants of all the
+chromosomes are assigned to genes using a few binary searches
+(``np.searchsorted``).
+
+The store is built once from the GTF file and saved as a ``.npz`` file. The
+nearest gene of every variant of an experiment can be saved in the
+``variant_genes`` table (see :py:class:`VariantGene`), which is joined with
+the results by the report.
+
+"""
+
+from __future__ import division
+
+import os
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import Column, String, Integer, ForeignKey, Index
+
+from . import SQLAlchemyBase
+
+
+__all__ = ["GeneAnnotation", "VariantGene"]
+
+
+# The number of bits used for the positions in the genomic keys.
+_POSITION_BITS = 32
+_MAX_POSITION = 2 ** _POSITION_BITS - 1
+
+
+class VariantGene(SQLAlchemyBase):
+    """ORM object for the nearest gene of a variant.
+
+    +-----------+--------------------------------------------+------------+
+    | Column    | Description                                | Type       |
+    +===========+============================================+============+
+    | variant   | The variant's name (foreign key to the     | String(25) |
+    |           | variants table)                            |            |
+    +-----------+--------------------------------------------+------------+
+    | gene_id   | The gene's identifier                      | String(25) |
+    +-----------+--------------------------------------------+------------+
+    | gene_name | The gene's name                            | String(30) |
+    +-----------+--------------------------------------------+------------+
+    | biotype   | The gene's biotype                         | String(40) |
+    +-----------+--------------------------------------------+------------+
+    | distance  | The distance to the gene (0 if the variant | Integer    |
+    |           | is in the gene)                            |            |
+    +-----------+--------------------------------------------+------------+
+
+    Variants without genes on their chromosome are not in the table.
+
+    """
+
+    __tablename__ = "variant_genes"
+    __table_args__ = (
+        Index("ix_variant_genes_gene_name", "gene_name"),
+    )
+
+    variant = Column(String(25), ForeignKey("variants.name"),
+                     primary_key=True)
+    gene_id = Column(String(25))
+    gene_name = Column(String(30))
+    biotype = Column(String(40))
+    distance = Column(Integer)
+
+
+class GeneAnnotation(object):
+    """Array-backed store of gene annotations.
+
+    :param chroms: The chromosomes of the genes.
+    :type chroms: list
+
+    :param starts: The start positions of the genes (inclusive).
+    :type starts: list
+
+    :param ends: The end positions of the genes (inclusive).
+    :type ends: list
+
+    :param gene_ids: The identifiers of the genes (`e.g.` ENSG00000139618).
+    :type gene_ids: list
+
+    :param gene_names: (optional) The names of the genes (`e.g.` BRCA2). The
+                       identifier is used if a name is missing.
+    :type gene_names: list
+
+    :param biotypes: (optional) The biotypes of the genes (`e.g.`
+                     protein_coding).
+    :type biotypes: list
+
+    The genes are sorted by chromosome and start position. The ``chr`` prefix
+    is removed from the chromosome names. Use :py:meth:`from_gtf` to build
+    the store from a GTF file.
+
+    """
+    def __init__(self, chroms, starts, ends, gene_ids, gene_names=None,
+                 biotypes=None):
+        chroms = np.array([_normalize_chrom(i) for i in chroms], dtype=str)
+        n = chroms.shape[0]
+
+        gene_ids = np.asarray(gene_ids, dtype=str)
+        gene_names = _fill_missing(gene_names, gene_ids)
+        biotypes = _fill_missing(biotypes, np.full(n, "", dtype=str))
+
+        self.chrom_names, chrom_codes = np.unique(chroms, return_inverse=True)
+        chrom_codes = chrom_codes.reshape(-1)
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+
+        order = np.lexsort((ends, starts, chrom_codes))
+        self.chrom_codes = chrom_codes[order].astype(np.int64)
+        self.starts = starts[order]
+        self.ends = ends[order]
+        self.gene_ids = gene_ids[order]
+        self.gene_names = gene_names[order]
+        self.biotypes = biotypes[order]
+
+        # The keys of the genes' boundaries.
+        self._start_keys = self._keys(self.chrom_codes, self.starts)
+        self._end_keys = self._keys(self.chrom_codes, self.ends)
+
+        # The largest end (and the gene it belongs to) among the genes that
+        # start before a given gene (used for the nearest gene queries).
+        self._max_end_keys = np.maximum.accumulate(self._end_keys)
+        self._max_end_genes = np.maximum.accumulate(np.where(
+            self._end_keys == self._max_end_keys, np.arange(n), 0
+        ))
+
+        # The genes sorted by end position.
+        self._end_order = np.argsort(self._end_keys, kind="mergesort")
+
+    @classmethod
+    def from_gtf(cls, filename, index=None):
+        """Build the store from the genes of a GTF file.
+
+        :param filename: The GTF file (it can be compressed using gzip).
+        :type filename: str
+
+        :param index: (optional) The ``.npz`` file of the store (default: the
+                      GTF file name with a ``.genes.npz`` extension). It is
+                      used if it is more recent than the GTF file, otherwise
+                      the GTF file is parsed and the store is saved.
+        :type index: str
+
+        :returns: The gene annotation.
+        :rtype: :py:class:`GeneAnnotation`
+
+        Only the ``gene`` and ``transcript`` lines are parsed (using pandas).
+        Genes without a ``gene`` line use the span of their transcripts.
+
+        """
+        if index is None:
+            index = filename + ".genes.npz"
+
+        if (os.path.isfile(index) and
+                os.path.getmtime(index) >= os.path.getmtime(filename)):
+            logger.info("Using the gene index '{}'.".format(index))
+            return cls.load(index)
+
+        logger.info("Indexing the genes from '{}'.".format(filename))
+        genes = cls._parse_gtf(filename)
+
+        try:
+            genes.save(index)
+            logger.info("Wrote the gene index to '{}'.".format(index))
+        except (IOError, OSError):
+            logger.warning("Could not write the gene index to '{}'. It will "
+                           "be rebuilt every time.".format(index))
+
+        return genes
+
+    @classmethod
+    def _parse_gtf(cls, filename):
+        """Parse the gene spans of a GTF file."""
+        data = pd.read_csv(
+            filename, sep="\t", header=None, comment="#",
+            usecols=[0, 2, 3, 4, 8],
+            names=["chrom", "feature", "start", "end", "attributes"],
+            dtype={"chrom": str, "feature": str, "attributes": str},
+        )
+        data = data[data["feature"].isin(["gene", "transcript"])]
+
+        for attribute in ("gene_id", "gene_name", "gene_biotype"):
+            data[attribute] = data["attributes"].str.extract(
+                attribute + r' "([^"]*)"', expand=False
+            )
+
+        if data["gene_id"].isnull().any():
+            raise ValueError("Some genes or transcripts don't have a "
+                             "'gene_id' in '{}'.".format(filename))
+
+        # The genes without a gene line use their transcripts' span.
+        is_gene = data["feature"] == "gene"
+        transcripts = data[~is_gene & ~data["gene_id"].isin(
+            data.loc[is_gene, "gene_id"]
+        )]
+        transcripts = transcripts.groupby("gene_id", sort=False).agg({
+            "chrom": "first", "start": "min", "end": "max",
+            "gene_name": "first", "gene_biotype": "first",
+        }).reset_index()
+
+        genes = pd.concat([data[is_gene], transcripts], ignore_index=True,
+                          sort=False)
+
+        return cls(
+            genes["chrom"].values, genes["start"].values, genes["end"].values,
+            genes["gene_id"].values, genes["gene_name"].values,
+            genes["gene_biotype"].values,
+        )
+
+    @classmethod
+    def load(cls, filename):
+        """Load a store saved using :py:meth:`save`."""
+        with np.load(filename, allow_pickle=False) as data:
+            return cls(data["chrom_names"][data["chrom_codes"]],
+                       data["starts"], data["ends"], data["gene_ids"],
+                       data["gene_names"], data["biotypes"])
+
+    def save(self, filename):
+        """Save the store (``.npz`` file)."""
+        with open(filename, "wb") as f:
+            np.savez(f, chrom_names=self.chrom_names,
+                     chrom_codes=self.chrom_codes, starts=self.starts,
+                     ends=self.ends, gene_ids=self.gene_ids,
+                     gene_names=self.gene_names, biotypes=self.biotypes)
+
+    def __len__(self):
+        return self.gene_ids.shape[0]
+
+    @property
+    def chroms(self):
+        """The chromosomes of the genes."""
+        return self.chrom_names[self.chrom_codes]
+
+    def get_overlaps(self, chroms, positions, flank=0):
+        """Find the genes that contain the variants.
+
+        :param chroms: The chromosomes of the variants.
+        :type chroms: list
+
+        :param positions: The positions of the variants.
+        :type positions: list
+
+        :param flank: The number of bases added on both sides of the genes.
+        :type flank: int
+
+        :returns: The indices of the variants and the indices of the genes
+                  (one element per overlapping pair, sorted by gene).
+        :rtype: tuple
+
+        The genes are not scanned for every variant: the variants are sorted
+        and the variants of a gene are the slice between the binary searches
+        of its boundaries.
+
+        """
+        keys = self._variant_keys(chroms, positions)
+        order = np.argsort(keys, kind="mergesort")
+        sorted_keys = keys[order]
+
+        lo = np.searchsorted(
+            sorted_keys,
+            self._keys(self.chrom_codes, np.maximum(self.starts - flank, 0)),
+            side="left"
+        )
+        hi = np.searchsorted(
+            sorted_keys,
+            self._keys(self.chrom_codes,
+                       np.minimum(self.ends + flank, _MAX_POSITION)),
+            side="right"
+        )
+        counts = hi - lo
+
+        genes = np.repeat(np.arange(len(self)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(
+            np.cumsum(counts) - counts, counts
+        )
+
+        return order[np.repeat(lo, counts) + offsets], genes
+
+    def get_nearest(self, chroms, positions):
+        """Find the nearest gene of every variant.
+
+        :param chroms: The chromosomes of the variants.
+        :type chroms: list
+
+        :param positions: The positions of the variants.
+        :type positions: list
+
+        :returns: The index of the nearest gene (-1 if there are no genes on
+                  the chromosome) and the distance to the gene (0 if the
+                  variant is in the gene, -1 if there is no gene).
+        :rtype: tuple
+
+        If a variant is in multiple genes, the one that ends last is
+        returned. Otherwise, the closest of the genes before and after the
+        variant is returned.
+
+        """
+        keys = self._variant_keys(chroms, positions)
+        codes = keys >> _POSITION_BITS
+        n = len(self)
+
+        nearest = np.full(keys.shape[0], -1, dtype=np.int64)
+        distance = np.full(keys.shape[0], -1, dtype=np.int64)
+        if n == 0:
+            return nearest, distance
+
+        # The last gene starting at or before the variant.
+        before = np.searchsorted(self._start_keys, keys, side="right") - 1
+
+        # The variant is in a gene if one of the genes starting before it
+        # ends after it.
+        max_end = self._max_end_keys[np.maximum(before, 0)]
+        overlap = (before >= 0) & (max_end >= keys)
+        nearest[overlap] = self._max_end_genes[before[overlap]]
+        distance[overlap] = 0
+
+        # The closest gene ending before the variant.
+        left = np.searchsorted(self._end_keys[self._end_order], keys,
+                               side="left") - 1
+        left = self._end_order[np.maximum(left, 0)]
+        left_distance = np.where(
+            (self.chrom_codes[left] == codes) & (self._end_keys[left] < keys),
+            keys - self._end_keys[left], -1
+        )
+
+        # The first gene starting after the variant.
+        right = np.minimum(before + 1, n - 1)
+        right_distance = np.where(
+            (self.chrom_codes[right] == codes) &
+            (self._start_keys[right] > keys),
+            self._start_keys[right] - keys, -1
+        )
+
+        use_left = ~overlap & (left_distance >= 0) & (
+            (right_distance < 0) | (left_distance <= right_distance)
+        )
+        use_right = ~overlap & ~use_left & (right_distance >= 0)
+
+        nearest[use_left] = left[use_left]
+        distance[use_left] = left_distance[use_left]
+        nearest[use_right] = right[use_right]
+        distance[use_right] = right_distance[use_right]
+
+        return nearest, distance
+
+    def get_snp_sets(self, variants, chroms, positions, flank=0):
+        """Assign variants to the genes that contain them.
+
+        :param variants: The names of the variants.
+        :type variants: list
+
+        :param chroms: The chromosomes of the variants.
+        :type chroms: list
+
+        :param positions: The positions of the variants.
+        :type positions: list
+
+        :param flank: The number of bases added on both sides of the genes.
+        :type flank: int
+
+        :returns: The (variant, set) pairs as a DataFrame, in the format of
+                  the SNP set files. The sets are named using the gene names.
+                  Variants can be in multiple genes.
+        :rtype: :py:class:`pandas.DataFrame`
+
+        """
+        variant_idx, gene_idx = self.get_overlaps(chroms, positions, flank)
+
+        data = pd.DataFrame({
+            "variant": np.asarray(variants, dtype=object)[variant_idx],
+            "set": self.gene_names[gene_idx],
+        })
+        data["set"] = data["set"].astype("category")
+
+        logger.info("Found {} variants in {} genes.".format(
+            np.unique(variant_idx).shape[0], data["set"].nunique()
+        ))
+
+        return data
+
+    def _variant_keys(self, chroms, positions):
+        """Compute the keys of the variants (unknown chromosomes are after
+           all the genes)."""
+        # The chromosome names are normalized once (not for every variant).
+        variant_codes, chroms = pd.factorize(np.asarray(chroms, dtype=object))
+        chroms = pd.Index([_normalize_chrom(i) for i in chroms], dtype=object)
+
+        codes = pd.Index(self.chrom_names).get_indexer(chroms).astype(np.int64)
+        codes[codes == -1] = len(self.chrom_names)
+        codes = codes[variant_codes]
+        return self._keys(codes, np.asarray(positions, dtype=np.int64))
+
+    @staticmethod
+    def _keys(codes, positions):
+        return (codes << _POSITION_BITS) | positions
+
+
+def _normalize_chrom(chrom):
+    """Remove the 'chr' prefix of a chromosome name."""
+    chrom = str(chrom)
+    if chrom.lower().startswith("chr"):
+        return chrom[3:]
+    return chrom
+
+
+def _fill_missing(values, default):
+    """Replace the missing values (None or NaN) by the default."""
+    if values is None:
+        return np.asarray(default, dtype=str)
+
+    values = pd.Series(values, dtype=object)
+    missing = values.isnull().values
+    values = values.values.copy()
+    values[missing] = np.asarray(default, dtype=object)[missing]
+    return values.astype(str)
@@ -23,6 +23,7 @@ from __future__ import division
 
 import json
 import os
+import fnmatch
 import collections
 
 import scipy.stats
@@ -42,6 +43,8 @@ from . import FORWARD_REPORT_ROOT, STATIC_ROOT, SQLAlchemySession, tasks
 from .phenotype.variables import Variable, DiscreteVariable, ContinuousVariable
 from .phenotype.db import apply_transformation
 from .utils import format_time_delta
+from .annotation import VariantGene
+from .statistics import permutation
 
 
 www_backend = None
@@ -84,6 +87,12 @@ class Backend(object):
                 with open(info_path, "rb") as f:
                     self.task_info[task_dir] = pickle.load(f)
 
+        # The variants are annotated with their nearest gene (optional).
+        self.has_variant_genes = (
+            VariantGene.__tablename__ in
+            sqlalchemy.inspect(self.engine).get_table_names()
+        )
+
         # Correlation matrix.
         filename = os.path.join(experiment_name, "phen_correlation_matrix.npy")
         self.correlation_matrix = np.load(filename)
@@ -335,10 +344,31 @@ class Backend(object):
         return out
 
     def get_results(self, task, filters=[], order_by=None, ascending=True):
-        """Get the results for a specific analysis."""
+        """Get the results for a specific analysis.
+
+        The information on the tested variants (and their nearest gene, if
+        the variants were annotated) is fetched using a join with the
+        variants table.
+
+        """
         cls = experiment.ExperimentResult
+        Variant = genotype.Variant
 
-        results = self.session.query(cls).filter(cls.task_name.like(task))
+        entities = [cls, Variant]
+        if self.has_variant_genes:
+            entities.append(VariantGene)
+
+        results = self.session.query(*entities).filter(
+            cls.task_name.like(task)
+        ).outerjoin(
+            Variant, sqlalchemy.and_(cls.tested_entity == "variant",
+                                     Variant.name == cls.entity_name)
+        )
+
+        if self.has_variant_genes:
+            results = results.outerjoin(
+                VariantGene, VariantGene.variant == Variant.name
+            )
 
         if order_by is not None:
             field = getattr(cls, order_by, order_by)
@@ -351,45 +381,56 @@ class Backend(object):
             for f in filters:
                 results = results.filter(f)
 
-        results = [e.to_json() for e in results.all()]
+        out = []
+        for row in results.all():
+            res = row[0].to_json()
+            out.append(res)
 
-        if not results:
-            return []
+            # If the entity type is variant, we add the information from the
+            # variants table.
+            if res["tested_entity"] != "variant":
+                continue
 
-        # If the entity type is variant, we will fetch information on them in
-        # the variants table.
-        if results[0]["tested_entity"] == "variant":
-            variants_dict = {}
-            for var in self.session.query(genotype.Variant).all():
-                variants_dict[var.name] = var
+            variant = row[1]
+            if variant is None:
+                msg = "Could not find variant {} in database.".format(
+                    res["entity_name"]
+                )
+                raise ValueError(msg)
 
-            for res in results:
-                info = variants_dict.get(res["entity_name"]).to_json()
-                if info is None:
-                    msg = "Could not find variant {} in database.".format(
-                        res["entity_name"]
-                    )
-                    raise ValueError(msg)
+            res.pop("entity_name")
+            res["variant"] = variant.to_json()
 
-                res.pop("entity_name")
-                res["variant"] = info
+            gene = row[2] if self.has_variant_genes else None
+            res["gene"] = gene.to_json() if gene is not None else None
 
-        return results
+        return out
 
     def get_bonferonni(self, task_name, alpha):
-        """Get the Bonferonni adjusted alpha for a given task."""
-        try:
-            n_tests, _ = self.session.query(
-                sqlalchemy.func.count(
-                    experiment.ExperimentResult.task_name
-                ), experiment.ExperimentResult.task_name
-            ).filter(
-                experiment.ExperimentResult.task_name.like(task_name)
-            ).group_by(experiment.ExperimentResult.task_name).one()
-        except Exception:
+        """Get the Bonferonni adjusted alpha for a given task.
+
+        The number of tests is saved by the experiment when the results are
+        corrected.
+
+        """
+        pattern = task_name.replace("%", "*")
+        n_tests = [n for name, n in self.info.get("n_tests", {}).items()
+                   if fnmatch.fnmatchcase(name, pattern)]
+        if len(n_tests) != 1:
             return None
 
-        return alpha / n_tests
+        return alpha / n_tests[0]
+
+    def get_empirical_threshold(self, task_name, alpha):
+        """Get the permutation based p-value threshold controlling the FWER
+           for a given task (None if permutations were not used)."""
+        info = self.get_task_info(task_name)
+        if not info or not info.get("permutation_min_p"):
+            return None
+
+        return permutation.empirical_threshold(
+            np.array(info["permutation_min_p"]), alpha
+        )
 
     def get_configuration(self):
         """Return the YAML configuration file."""
@@ -541,6 +582,8 @@ def api_tasks():
 def api_task_results():
     task = request.args.get("task")
     p_thresh = request.args.get("pthresh", 0.05)
+    q_thresh = request.args.get("qthresh", None)
+    fdr_thresh = request.args.get("fdrthresh", None)
     order_by = request.args.get("order_by", None)
     ascending = parse_bool(request.args.get("ascending", "true"))
 
@@ -552,11 +595,24 @@ def api_task_results():
         experiment.ExperimentResult.significance <= p_thresh,
     ]
 
+    # The FDR corrections are computed by the experiment (and indexed).
+    if q_thresh is not None:
+        filters.append(experiment.ExperimentResult.q_value <= q_thresh)
+    if fdr_thresh is not None:
+        filters.append(
+            experiment.ExperimentResult.fdr_significance <= fdr_thresh
+        )
+
     sort_by_variant = False
     if order_by == "variant":
         order_by = None
         sort_by_variant = True
 
+    sort_by_gene = False
+    if order_by == "gene":
+        order_by = None
+        sort_by_gene = True
+
     sort_by_delta_rsq = False
     if order_by == "delta_rsquared":
         order_by = None
@@ -576,6 +632,15 @@ def api_task_results():
                 # We had no gain in variance explained.
                 d["delta_rsquared"] = 0
 
+    # If permutations were used, we also give the FWER adjusted p-values.
+    if info and info.get("permutation_min_p"):
+        adjusted = permutation.adjusted_p_values(
+            np.array([d["significance"] for d in results], dtype=float),
+            np.array(info["permutation_min_p"])
+        )
+        for d, p in zip(results, adjusted):
+            d["fwer_significance"] = None if np.isnan(p) else p
+
     if sort_by_variant:
         results = sorted(
             results,
@@ -583,6 +648,13 @@ def api_task_results():
             reverse=(not ascending)
         )
 
+    if sort_by_gene:
+        results = sorted(
+            results,
+            key=lambda x: (x["gene"] or {}).get("gene_name") or "",
+            reverse=(not ascending)
+        )
+
     if sort_by_delta_rsq:
         results = sorted(
             results,
@@ -636,6 +708,25 @@ def api_bonferonni():
     })
 
 
+@app.route(FORWARD_REPORT_ROOT + "/tasks/corrections/permutation.json")
+def api_empirical_threshold():
+    task = request.args.get("task")
+    if task is None:
+        raise InvalidAPIUsage("A 'task' parameter is expected.")
+
+    alpha = request.args.get("alpha")
+    try:
+        alpha = float(alpha)
+    except Exception:
+        raise InvalidAPIUsage("A float 'alpha' parameter is expected.")
+
+    # The task info is indexed by the complete task name.
+    task = "{}_LinearTest".format(task)
+    return json.dumps({
+        "alpha": www_backend.get_empirical_threshold(task, alpha)
+    })
+
+
 @app.route(FORWARD_REPORT_ROOT + "/tasks/logistic_section.html")
 def task_rendered_logistic():
     task = request.args.get("task")
@@ -54,9 +54,13 @@ def parse_configuration(filename):
     experiment_name = config["Experiment"].pop("name", "forward_experiment")
     experiment_cpu = int(config["Experiment"].pop("cpu", 1))
     experiment_build = config["Experiment"].pop("build", "GRCh37")
+    experiment_pcs = config["Experiment"].pop("principal_components", None)
+    experiment_genes = config["Experiment"].pop("gene_annotation", None)
 
     experiment = Experiment(experiment_name, database, genotypes, variables,
-                            tasks, experiment_build, cpu=experiment_cpu)
+                            tasks, experiment_build, cpu=experiment_cpu,
+                            principal_components=experiment_pcs,
+                            gene_annotation=experiment_genes)
     experiment.info.update({"configuration": filename})
 
     return experiment
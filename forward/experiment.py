@@ -24,6 +24,7 @@ import logging
 logger = logging.getLogger(__name__)
 
 import numpy as np
+import pandas as pd
 import sqlalchemy
 import h5py
 from sqlalchemy import (Column, Enum, String, Float, ForeignKey, Integer,
@@ -31,7 +32,11 @@ from sqlalchemy import (Column, Enum, String, Float, ForeignKey, Integer,
 from six.moves import cPickle as pickle
 
 from . import SQLAlchemySession, SQLAlchemyBase, FORWARD_INIT_TIME
-from .utils import format_time_delta
+from .utils import format_time_delta, expand, float_or_none
+from .genotype import Variant, VariantSelector
+from .annotation import GeneAnnotation, VariantGene
+from .pca import compute_principal_components
+from .statistics import multiple_testing
 from .phenotype.variables import (Variable, DiscreteVariable,
                                   ContinuousVariable, TRANSFORMATIONS)
 
@@ -107,6 +112,15 @@ class ExperimentResult(SQLAlchemyBase):
     | confidence_interval_max | Higher bound of the 95% CI on    | Float      |
     |                         | the coefficient                  |            |
     +-------------------------+----------------------------------+------------+
+    | fdr_significance        | Benjamini-Hochberg adjusted      | Float      |
+    |                         | p-value (indexed)                |            |
+    +-------------------------+----------------------------------+------------+
+    | q_value                 | Storey's q-value (indexed)       | Float      |
+    +-------------------------+----------------------------------+------------+
+
+    The FDR corrections (``fdr_significance`` and ``q_value``) are computed
+    by the experiment once all the tasks are done, independently for every
+    task and outcome.
 
     .. todo::
 
@@ -139,6 +153,10 @@ class ExperimentResult(SQLAlchemyBase):
     confidence_interval_min = Column(Float())  # min of 95% CI on coefficient
     confidence_interval_max = Column(Float())  # max of 95% CI on coefficient
 
+    # FDR corrections (by task and outcome).
+    fdr_significance = Column(Float(), index=True)
+    q_value = Column(Float(), index=True)
+
     __mapper_args__ = {
         "polymorphic_on": results_type,
         "polymorphic_identity": "GenericResults",
@@ -149,7 +167,14 @@ class ExperimentResult(SQLAlchemyBase):
 class Experiment(object):
     """Class representing an experiment."""
     def __init__(self, name, phenotype_container, genotype_container,
-                 variables, tasks, build, cpu=1):
+                 variables, tasks, build, cpu=1, principal_components=None,
+                 gene_annotation=None):
+
+        # The variants are annotated with their nearest gene when the tasks
+        # are done.
+        self.gene_annotation = None
+        if gene_annotation:
+            self.gene_annotation = _parse_gene_annotation(gene_annotation)
 
         # Create a directory for the experiment.
         try:
@@ -183,9 +208,14 @@ class Experiment(object):
 
         # Do experiment initialization on the database objects.
         self.genotypes.experiment_init(self)
+        self.genotypes.sparse_init(self)
         self.experiment_info_init()
         self.results_init()
 
+        # Compute the genotype PCs (they are added to the covariates).
+        if principal_components:
+            self.principal_components_init(principal_components)
+
         # Initialize the variables (generates some statistics).
         self.variables_init()
 
@@ -206,6 +236,53 @@ class Experiment(object):
         for cls in result_tables:
             getattr(cls, "__table__").create(self.engine)
 
+    def principal_components_init(self, config):
+        """Compute the genotype principal components and add them as
+           covariates.
+
+        :param config: The parameters for the PCs: `n_components` (default
+                       10), `variants` (a variant selection, see
+                       :py:class:`forward.genotype.VariantSelector`),
+                       `prefix` for the names of the covariates (default
+                       "PC"), `seed` and `cache`, the directory where the PCs
+                       are cached (defaults to the experiment's directory).
+        :type config: dict
+
+        The PCs are added to the phenotype database and a continuous covariate
+        is created for every one of them, so they are used by the tasks with
+        ``covariates: all``.
+
+        """
+        config = dict(config)
+        n_components = int(config.pop("n_components", 10))
+        selector = VariantSelector.from_config(config.pop("variants", "all"))
+        prefix = config.pop("prefix", "PC")
+        seed = config.pop("seed", None)
+        path = config.pop(
+            "cache", os.path.join(self.name, "principal_components")
+        )
+
+        if config:
+            raise ValueError("Invalid parameter(s) for the principal "
+                             "components: {}.".format(", ".join(config)))
+
+        pcs = compute_principal_components(
+            self.genotypes, self.session, expand(path),
+            n_components=n_components, selector=selector, seed=seed
+        )
+
+        # The PCs are in the sample order of the genotype container, which
+        # is also the order of the phenotype container.
+        for i, name in enumerate(pcs.get_names(prefix)):
+            self.phenotypes.add_phenotype(name, pcs.pcs[:, i])
+            self.variables.append(ContinuousVariable(name, covariate=True))
+
+        self.info["principal_components"] = {
+            "path": pcs.path,
+            "names": pcs.get_names(prefix),
+            "eigenvalues": list(pcs.eigenvalues),
+        }
+
     def variables_init(self):
         """Initialize the variables table and computes some statistics."""
         for obj in (Variable, DiscreteVariable, ContinuousVariable):
@@ -255,6 +332,94 @@ class Experiment(object):
             "phenotype_correlation_for_exclusion": corr_thresh
         })
 
+    def annotate_variants(self, filename, index=None):
+        """Save the nearest gene of every variant in the database.
+
+        :param filename: The GTF file with the genes.
+        :type filename: str
+
+        :param index: (optional) The file of the compiled gene index (see
+                      :py:meth:`forward.annotation.GeneAnnotation.from_gtf`).
+        :type index: str
+
+        The overlapping (or nearest) gene and the distance to the gene are
+        computed once for all the variants and saved in the ``variant_genes``
+        table (:py:class:`forward.annotation.VariantGene`).
+
+        """
+        genes = GeneAnnotation.from_gtf(filename, index=index)
+
+        variants = self.session.query(
+            Variant.name, Variant.chrom, Variant.pos
+        ).all()
+        names, chroms, positions = (
+            zip(*variants) if variants else ([], [], [])
+        )
+        nearest, distance = genes.get_nearest(chroms, positions)
+
+        VariantGene.__table__.create(self.engine, checkfirst=True)
+        self.session.bulk_insert_mappings(VariantGene, [
+            {
+                "variant": names[i],
+                "gene_id": genes.gene_ids[nearest[i]],
+                "gene_name": genes.gene_names[nearest[i]],
+                "biotype": genes.biotypes[nearest[i]],
+                "distance": int(distance[i]),
+            }
+            for i in np.flatnonzero(nearest != -1)
+        ])
+        self.session.commit()
+
+        logger.info("Annotated {} variants (found {} in genes).".format(
+            np.sum(nearest != -1), np.sum(distance == 0)
+        ))
+
+        self.info["gene_annotation"] = filename
+
+    def correct_results(self):
+        """Compute the FDR corrections of the results.
+
+        The Benjamini-Hochberg adjusted p-values and the q-values are computed
+        for every task and outcome (see
+        :py:mod:`forward.statistics.multiple_testing`) and saved in the
+        results table. The number of tests of every task is also saved in the
+        experiment's metadata (for the Bonferonni correction).
+
+        """
+        results = self.session.query(
+            ExperimentResult.pk, ExperimentResult.task_name,
+            ExperimentResult.phenotype, ExperimentResult.significance
+        ).all()
+
+        if not results:
+            self.info["n_tests"] = {}
+            return
+
+        results = pd.DataFrame.from_records(
+            results, columns=["pk", "task_name", "phenotype", "significance"]
+        )
+        results["significance"] = results["significance"].astype(float)
+
+        # Every group of tests is corrected with a single sort of the
+        # p-values.
+        groups = results.groupby(["task_name", "phenotype"])
+        results["fdr_significance"] = groups["significance"].transform(
+            multiple_testing.bh_adjusted_p_values
+        )
+        results["q_value"] = groups["significance"].transform(
+            multiple_testing.q_values
+        )
+
+        self.session.bulk_update_mappings(ExperimentResult, [
+            {"pk": int(pk), "fdr_significance": float_or_none(fdr),
+             "q_value": float_or_none(q)}
+            for pk, fdr, q in zip(results["pk"], results["fdr_significance"],
+                                  results["q_value"])
+        ])
+        self.session.commit()
+
+        self.info["n_tests"] = results.groupby("task_name").size().to_dict()
+
     def add_result(self, **kwargs):
         """Add a result to the experiment database.
 
@@ -324,10 +489,17 @@ class Experiment(object):
         # Commit the database.
         self.session.commit()
 
+        # Compute the FDR corrections of the results.
+        self.correct_results()
+
         # Write the exclusions that were made based on related phenotypes to
         # the database.
         self._write_exclusions()
 
+        # Annotate the variants with their nearest gene.
+        if self.gene_annotation is not None:
+            self.annotate_variants(**self.gene_annotation)
+
         # All tasks are done, set the walltime.
         self.info["walltime"] = (datetime.datetime.now() -
                                  self.info["start_time"])
@@ -347,3 +519,24 @@ class Experiment(object):
         logger.info("Completed all tasks in {}.".format(
             format_time_delta(self.info["walltime"])
         ))
+
+
+def _parse_gene_annotation(config):
+    """Parse the gene annotation parameters (a GTF file or a dict with the
+       `filename` and the `index`)."""
+    if not isinstance(config, dict):
+        config = {"filename": config}
+
+    config = dict(config)
+    filename = config.pop("filename", None)
+    index = config.pop("index", None)
+
+    if config or filename is None:
+        raise ValueError("Invalid parameter(s) for the gene annotation: "
+                         "a GTF 'filename' and an optional 'index' are "
+                         "expected.")
+
+    return {
+        "filename": expand(filename),
+        "index": expand(index) if index else None,
+    }
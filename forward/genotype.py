@@ -12,17 +12,29 @@ This module provides utilities to handle genotype data.
 """
 
 import os
+import glob
+import zlib
+import shutil
+import struct
+import sqlite3
 import logging
+import threading
+from multiprocessing.pool import ThreadPool
 logger = logging.getLogger(__name__)
 
 from gepyto.formats.impute2 import Impute2File
 import numpy as np
 import pandas as pd
-from sqlalchemy import Column, String, Integer, Float
+import scipy.sparse
+import sqlalchemy
+from sqlalchemy import (Column, String, Integer, Float, Index, and_, or_,
+                        select)
 from sqlalchemy.ext.hybrid import hybrid_property
 
 from . import SQLAlchemyBase
-from .utils import abstract, dispatch_methods, expand
+from .utils import (abstract, dispatch_methods, expand, float_or_none,
+                    parse_region, SampleIndex)
+from .statistics.utilities import hwe_exact_midp, impute_info
 
 try:  # pragma: no cover
     import pyplink
@@ -30,8 +42,16 @@ try:  # pragma: no cover
 except ImportError:
     HAS_PYPLINK = False
 
+try:  # pragma: no cover
+    import zstandard
+    HAS_ZSTANDARD = True
+except ImportError:
+    HAS_ZSTANDARD = False
 
-__all__ = ["MemoryImpute2Geno", "PlinkGenotypeDatabase"]
+
+__all__ = ["MemoryImpute2Geno", "PlinkGenotypeDatabase",
+           "BgenGenotypeDatabase", "VCFGenotypeDatabase",
+           "MultiFileGenotypeDatabase"]
 
 
 class FrozenDatabaseError(Exception):
@@ -64,15 +84,27 @@ class Variant(SQLAlchemyBase):
     | n_non_missing  | Number of non-missing genotypes for this | Integer    |
     |                | variant                                  |            |
     +----------------+------------------------------------------+------------+
+    | hwe_p          | Hardy-Weinberg equilibrium exact test    | Float      |
+    |                | mid p-value (using hard calls)           |            |
+    +----------------+------------------------------------------+------------+
+    | info           | IMPUTE info measure (only available for  | Float      |
+    |                | genotype probabilities)                  |            |
+    +----------------+------------------------------------------+------------+
 
     Computed fields:
 
         - ``maf``: mac / (2 :math:`\cdot` n non missing)
         - ``completion_rate``: n non missing / (n non missing + n missing)
 
+    The table has a composite index on (chrom, pos) to efficiently query
+    genomic regions (see :py:func:`Variant.in_region`).
+
     """
 
     __tablename__ = "variants"
+    __table_args__ = (
+        Index("ix_variants_chrom_pos", "chrom", "pos"),
+    )
 
     name = Column(String(25), primary_key=True)
     chrom = Column(String(15))
@@ -82,6 +114,8 @@ class Variant(SQLAlchemyBase):
     major = Column(String(10))
     n_missing = Column(Integer)
     n_non_missing = Column(Integer)
+    hwe_p = Column(Float)
+    info = Column(Float)
 
     # The maf = mac / (2 * n_non_missing)
     @hybrid_property
@@ -93,6 +127,191 @@ class Variant(SQLAlchemyBase):
     def completion_rate(self):
         return self.n_non_missing / (self.n_non_missing + self.n_missing)
 
+    @classmethod
+    def in_region(cls, chrom, start, end):
+        """SQL expression to filter variants in a region (inclusive bounds).
+
+        This uses the (chrom, pos) index of the table.
+
+        """
+        return and_(cls.chrom == str(chrom), cls.pos >= start, cls.pos <= end)
+
+
+class VariantSelector(object):
+    """Selection of a subset of the variants for a task.
+
+    :param names: (optional) A list of variant names or the path to a file
+                  containing a single column of names.
+    :type names: list or str
+
+    :param regions: (optional) A list of genomic regions (`e.g.`
+                    ``"3:1234-5678"``).
+    :type regions: list
+
+    :param maf: (optional) Either a minimum MAF or a ``[min, max]`` range
+                (inclusive).
+    :type maf: float or list
+
+    :param completion: (optional) The minimum completion rate.
+    :type completion: float
+
+    :param hwe: (optional) The minimum Hardy-Weinberg equilibrium test
+                p-value.
+    :type hwe: float
+
+    :param info: (optional) The minimum imputation quality (info measure).
+                 Variants without an info measure are excluded.
+    :type info: float
+
+    A variant needs to satisfy all the criteria to be selected. The criteria
+    are compiled into a single SQL query over the :py:class:`Variant` table so
+    that the (chrom, pos) and primary key indices are used. Long name lists
+    are queried in chunks to stay below the limit on the number of bound
+    parameters.
+
+    """
+
+    _names_chunk_size = 500
+
+    def __init__(self, names=None, regions=None, maf=None, completion=None,
+                 hwe=None, info=None):
+        if names is not None and not type(names) in (list, tuple):
+            with open(expand(names), "r") as f:
+                names = f.read().split()
+        self.names = list(names) if names is not None else None
+
+        self.regions = None
+        if regions is not None:
+            self.regions = [parse_region(region) for region in regions]
+
+        self.maf = None
+        if maf is not None:
+            if type(maf) in (list, tuple):
+                if len(maf) != 2:
+                    raise ValueError("MAF ranges are given as [min, max] "
+                                     "(got '{}').".format(maf))
+                self.maf = (float(maf[0]), float(maf[1]))
+            else:
+                self.maf = (float(maf), 0.5)
+
+        self.completion = float(completion) if completion is not None else None
+        self.hwe = float(hwe) if hwe is not None else None
+        self.info = float(info) if info is not None else None
+
+    @classmethod
+    def from_config(cls, config):
+        """Build a selector from a task's ``variants`` parameter.
+
+        The parameter is either "all" or a dict whose keys are the arguments
+        of the constructor.
+
+        """
+        if config == "all":
+            return cls()
+
+        if type(config) is not dict:
+            raise ValueError("Variants need to be either 'all' or a dict of "
+                             "selection criteria.")
+
+        unknown = set(config.keys()) - {"names", "regions", "maf",
+                                        "completion", "hwe", "info"}
+        if unknown:
+            raise ValueError("Unknown variant selection criteria: '{}'.".format(
+                "', '".join(sorted(unknown))
+            ))
+
+        return cls(**config)
+
+    def filters(self):
+        """Get the list of SQL expressions (excluding the name criterion)."""
+        filters = []
+        if self.regions:
+            filters.append(
+                or_(*[Variant.in_region(*region) for region in self.regions])
+            )
+
+        if self.maf is not None:
+            filters.append(Variant.mac >= 2 * self.maf[0] *
+                           Variant.n_non_missing)
+            filters.append(Variant.mac <= 2 * self.maf[1] *
+                           Variant.n_non_missing)
+
+        if self.completion is not None:
+            # Avoid the integer division of the completion_rate expression.
+            filters.append(
+                Variant.n_non_missing >= self.completion *
+                (Variant.n_non_missing + Variant.n_missing)
+            )
+
+        if self.hwe is not None:
+            filters.append(Variant.hwe_p >= self.hwe)
+
+        if self.info is not None:
+            filters.append(Variant.info >= self.info)
+
+        return filters
+
+    def query(self, session, fields=None):
+        """Get the selected variants.
+
+        :param session: A session object to interface with the Variant table.
+        :type session: :py:class:`sqlalchemy.orm.session.Session`
+
+        :param fields: (optional) The columns to query (default: the Variant
+                       objects).
+        :type fields: list
+
+        :returns: A list of query results ordered by chromosome and position.
+        :rtype: list
+
+        """
+        if fields is None:
+            fields = [Variant]
+        elif not type(fields) in (tuple, list):
+            fields = [fields]
+
+        query = session.query(*fields)
+        for f in self.filters():
+            query = query.filter(f)
+        query = query.order_by(Variant.chrom, Variant.pos)
+
+        if self.names is None:
+            return query.all()
+
+        if len(self.names) <= self._names_chunk_size:
+            return query.filter(Variant.name.in_(self.names)).all()
+
+        # Every chunk is sorted, so the chromosome and position are also
+        # queried to sort the merged results.
+        query = query.add_columns(Variant.chrom, Variant.pos)
+        results = []
+        for i in range(0, len(self.names), self._names_chunk_size):
+            chunk = self.names[i:(i + self._names_chunk_size)]
+            results.extend(query.filter(Variant.name.in_(chunk)).all())
+
+        results.sort(key=lambda row: (row[-2], row[-1]))
+
+        # Single entity queries (`e.g.` the Variant objects) are not tuples.
+        if len(fields) == 1 and isinstance(fields[0], type):
+            return [row[0] for row in results]
+        return [row[:-2] for row in results]
+
+    def get_variants(self, session):
+        """Get the names of the selected variants."""
+        return [i[0] for i in self.query(session, Variant.name)]
+
+    def get_rows(self, session, genotypes):
+        """Get the integer rows of the selected variants in a genotype
+           database's dosage store.
+
+        :returns: The selected variant names and their rows (as given by
+                  :py:func:`AbstractGenotypeDatabase.get_variant_rows`).
+        :rtype: tuple
+
+        """
+        names = self.get_variants(session)
+        return names, genotypes.get_variant_rows(names)
+
 
 @abstract
 class AbstractGenotypeDatabase(object):
@@ -102,6 +321,13 @@ class AbstractGenotypeDatabase(object):
     procedures used by Forward.
 
     """
+    # The MAF threshold for the sparse representation of rare variants (see
+    # sparse_maf).
+    _sparse_maf = None
+
+    # Number of variants read at once to build the sparse representation.
+    _sparse_block_size = 1000
+
     def __init__(self, **kwargs):
         dispatch_methods(self, kwargs)
 
@@ -163,6 +389,41 @@ class AbstractGenotypeDatabase(object):
         """
         raise NotImplementedError()
 
+    def get_variant_rows(self, variant_names):
+        """Get the integer rows of variants in the underlying dosage store.
+
+        Rows can be passed to :py:func:`get_genotype_block` to avoid looking
+        the variants up by name repeatedly. Implementations that do not have
+        a row-based store return None.
+
+        """
+        return None
+
+    def get_genotype_block(self, variant_names, rows=None):
+        """Get a matrix of genotypes for many variants at once.
+
+        :param variant_names: The variant names.
+        :type variant_names: list
+
+        :param rows: (optional) The rows of the variants in the dosage store
+                     (from :py:func:`get_variant_rows`).
+        :type rows: np.ndarray
+
+        :returns: A samples x variants matrix (in the order of the names).
+        :rtype: np.ndarray
+
+        Implementations reading from disk should override this to read the
+        variants in a single pass. The default stacks the
+        :py:func:`get_genotypes` vectors.
+
+        """
+        if len(variant_names) == 0:
+            return np.empty((len(self.get_sample_order()), 0))
+
+        return np.vstack(
+            [self.get_genotypes(name) for name in variant_names]
+        ).T
+
     # Experiment initalization including filling up the database and filtering
     # variants.
     def experiment_init(self, experiment):
@@ -177,6 +438,159 @@ class AbstractGenotypeDatabase(object):
         # Create the tables corresponding to the SQLAlchemyBase subclasses.
         Variant.__table__.create(experiment.engine, checkfirst=True)
 
+        # Used to build the position index once the table is filled.
+        self._engine = experiment.engine
+        self._position_index = None
+
+    def query_region(self, chrom, start, end):
+        """Get the names of the variants in a genomic region.
+
+        :param chrom: The chromosome.
+        :type chrom: str
+
+        :param start: The start position (inclusive).
+        :type start: int
+
+        :param end: The end position (inclusive).
+        :type end: int
+
+        :returns: The variant names sorted by position.
+        :rtype: np.ndarray
+
+        This only considers the variants that were kept after the
+        initialization of the experiment. On the first call, sorted arrays of
+        positions are loaded for every chromosome (using the (chrom, pos)
+        index of the variants table). Regions are then found using binary
+        search.
+
+        """
+        positions, names = self._get_position_index().get(
+            str(chrom), (np.array([], dtype=int), np.array([], dtype=str))
+        )
+
+        left = np.searchsorted(positions, start, side="left")
+        right = np.searchsorted(positions, end, side="right")
+
+        return names[left:right]
+
+    def _get_position_index(self):
+        """Build a mapping of chromosome to sorted positions and names."""
+        if getattr(self, "_position_index", None) is not None:
+            return self._position_index
+
+        if getattr(self, "_engine", None) is None:
+            raise ValueError("The genotype database needs to be initialized "
+                             "by an experiment before querying regions.")
+
+        con = self._engine.connect()
+        data = pd.DataFrame(
+            con.execute(
+                select([Variant.chrom, Variant.pos, Variant.name])
+                .order_by(Variant.chrom, Variant.pos)
+            ).fetchall(),
+            columns=["chrom", "pos", "name"]
+        )
+        con.close()
+
+        self._position_index = {}
+        for chrom, group in data.groupby("chrom"):
+            self._position_index[chrom] = (
+                group["pos"].values.astype(int),
+                group["name"].values.astype(str)
+            )
+
+        return self._position_index
+
+    # Sparse representation of the rare variants.
+    def sparse_maf(self, maf):
+        """Keep a sparse copy of the genotypes of the variants with a MAF
+           lower or equal to the threshold.
+
+        This is a configuration option. The sparse matrix is built by
+        :py:func:`sparse_init` once the variants are initialized and it can
+        be accessed using :py:func:`get_sparse_block`.
+
+        """
+        if getattr(self, "_frozen", False):
+            raise FrozenDatabaseError()
+        self._sparse_maf = maf
+
+    def sparse_init(self, experiment):
+        """Build the sparse (CSC) genotype matrix of the rare variants.
+
+        This is called by the experiment after the initialization of the
+        variants (if a threshold was set using :py:func:`sparse_maf`).
+        Missing genotypes are stored explicitly (as NaN).
+
+        """
+        self._sparse_genotypes = None
+        self._sparse_index = pd.Index([])
+
+        if self._sparse_maf is None:
+            return
+
+        names = VariantSelector(maf=(0, self._sparse_maf)).get_variants(
+            experiment.session
+        )
+
+        blocks = [
+            scipy.sparse.csc_matrix(self.get_genotype_block(
+                names[i:(i + self._sparse_block_size)]
+            ))
+            for i in range(0, len(names), self._sparse_block_size)
+        ]
+
+        n = len(self.get_sample_order())
+        if blocks:
+            self._sparse_genotypes = scipy.sparse.hstack(blocks, format="csc")
+        else:
+            self._sparse_genotypes = scipy.sparse.csc_matrix((n, 0))
+        self._sparse_index = pd.Index(names)
+
+        logger.info("Built the sparse genotype matrix of {} variants with a "
+                    "MAF <= {} ({} non-zero genotypes).".format(
+                        len(names), self._sparse_maf,
+                        self._sparse_genotypes.nnz
+                    ))
+
+    def is_sparse(self, variant_names):
+        """Check if variants are in the sparse genotype matrix.
+
+        :returns: A boolean mask (in the order of the names).
+        :rtype: np.ndarray
+
+        """
+        index = getattr(self, "_sparse_index", None)
+        if index is None:
+            return np.zeros(len(variant_names), dtype=bool)
+        return index.get_indexer(variant_names) != -1
+
+    def get_sparse_block(self, variant_names):
+        """Get a sparse matrix of genotypes for rare variants.
+
+        :param variant_names: The variant names (they need to be in the sparse
+                              genotype matrix, see :py:func:`is_sparse`).
+        :type variant_names: list
+
+        :returns: A samples x variants matrix (in the order of the names).
+        :rtype: :py:class:`scipy.sparse.csc_matrix`
+
+        """
+        if getattr(self, "_sparse_genotypes", None) is None:
+            raise ValueError("The sparse genotype matrix was not built (use "
+                             "the 'sparse_maf' option).")
+
+        columns = self._sparse_index.get_indexer(variant_names)
+        if np.any(columns == -1):
+            missing = np.asarray(variant_names)[columns == -1]
+            raise ValueError(
+                "Variant {} not in the sparse genotype matrix.".format(
+                    missing[0]
+                )
+            )
+
+        return self._sparse_genotypes[:, columns]
+
     # Filtering methods.
     def filter_name(self, variant_list):
         """Filtering by variant id.
@@ -191,6 +605,17 @@ class AbstractGenotypeDatabase(object):
     def filter_completion(self, rate):
         raise NotImplementedError()
 
+    def filter_hwe(self, p):
+        """Filtering by Hardy-Weinberg equilibrium (exact test mid p-value).
+
+        Variants with a p-value lower than the threshold are excluded.
+        """
+        raise NotImplementedError()
+
+    def filter_info(self, info):
+        """Filtering by imputation quality (IMPUTE info measure)."""
+        raise NotImplementedError()
+
     # Static utilities.
     @staticmethod
     def load_samples(filename):
@@ -230,14 +655,21 @@ class MemoryImpute2Geno(AbstractGenotypeDatabase):
         self.filename = expand(filename)
         self.samples = self.load_samples(expand(samples))
 
-        self.impute2file = Impute2File(self.filename, "dosage",
-                                       prob_threshold=filter_probability)
+        # The file is read as probabilities (to compute the info measure).
+        # The probability threshold is only used by the dosage matrix read
+        # before the initialization (see _check_matrix).
+        self.prob_threshold = filter_probability
+        self.impute2file = Impute2File(self.filename)
+        self.impute2file.dosage_arguments["prob_threshold"] = \
+            filter_probability
 
         # Filters (init).
         self.thresh_completion = 0
         self.thresh_maf = 0
+        self.thresh_hwe = 0
+        self.thresh_info = 0
         self.names = set()
-        self.samples_mask = None
+        self.samples_keep = None
 
         # The initial filtering is done when the file is parsed. We won't allow
         # the user to apply the filtering methods again.
@@ -257,21 +689,26 @@ class MemoryImpute2Geno(AbstractGenotypeDatabase):
         super(MemoryImpute2Geno, self).experiment_init(experiment)
 
         names = []  # Used to set the index.
-        self._mat = []  # The actual dosage vectors.
+        blocks = []  # The dosage matrices (variants x samples).
+
+        # The variants that are not in a block yet (dosage and genotype
+        # variance vectors and the variant information).
+        block = []
 
-        db_buffer = []  # List of dicts to bulk insert in the database.
         num_inserts = 0
         con = experiment.engine.connect()  # We also get a connection object.
 
-        for dosage, info in self.impute2file:
-
-            name = info["name"]
+        for line in self.impute2file:
+            name = line.name
 
             # Go through the filters.
             # Name
             if self.names and name not in self.names:
                 continue
 
+            dosage, variance, flip = _impute2_dosage(line.probabilities,
+                                                     self.prob_threshold)
+
             # Completion
             n_missing = np.sum(np.isnan(dosage))
             n_non_missing = dosage.shape[0] - n_missing
@@ -282,47 +719,39 @@ class MemoryImpute2Geno(AbstractGenotypeDatabase):
                     continue
 
             # MAF
-            if info["maf"] < self.thresh_maf:
+            mac = np.nansum(dosage)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                maf = mac / (2 * n_non_missing)
+            if maf < self.thresh_maf:
                 continue
 
-            # Remove samples if needed.
-            if self.samples_mask is not None:
-                dosage = dosage[self.samples_mask]
-
-            # Note that probability is already filtered by gepyto.
-
-            # Add to the matrix.
-            names.append(name)
-            self._mat.append(dosage)
+            minor, major = line.a2, line.a1
+            if flip:
+                minor, major = major, minor
 
-            # Add the variant information to the database.
-            db_buffer.append(
-                dict(name=name, chrom=info["chrom"], pos=int(info["pos"]),
-                     mac=float(info["minor_allele_count"]),
-                     minor=info["minor"], major=info["major"],
-                     n_missing=int(n_missing),
-                     n_non_missing=int(n_non_missing))
-            )
+            # The variant information for the database.
+            block.append((dosage, variance, dict(
+                name=name, chrom=line.chrom, pos=int(line.pos),
+                mac=float(mac), minor=minor, major=major,
+                n_missing=int(n_missing), n_non_missing=int(n_non_missing)
+            )))
 
             # We use sqlalchemy core to insert faster.
             # When we have more than 100,000 variants, we bulk insert them.
-            if len(db_buffer) >= batch_insert_n:
-                con.execute(Variant.__table__.insert(), db_buffer)
-                num_inserts += len(db_buffer)
-                db_buffer = []
+            if len(block) >= batch_insert_n:
+                num_inserts += self._insert_block(con, block, names, blocks)
+                block = []
 
         # Bulk insert the remainder.
-        if db_buffer:
-            con.execute(Variant.__table__.insert(), db_buffer)
-            num_inserts += len(db_buffer)
-            del db_buffer
+        if block or not blocks:
+            num_inserts += self._insert_block(con, block, names, blocks)
 
         logger.info("Built the variant database ({} entries).".format(
             num_inserts
         ))
 
         # Set the names as the index for the variant dataframe.
-        self._mat = pd.DataFrame(self._mat)
+        self._mat = pd.DataFrame(np.vstack(blocks))
         self._mat.index = names
 
         # Close the connection.
@@ -342,6 +771,43 @@ class MemoryImpute2Geno(AbstractGenotypeDatabase):
         :rtype: np.nadarray
 
         """
+        self._check_matrix()
+
+        try:
+            vect = self._mat.loc[variant_name, :].values
+            return vect
+        except KeyError:
+            msg = "Variant {} not found in genotype database.".format(
+                variant_name
+            )
+            raise ValueError(msg)
+
+    def get_variant_rows(self, variant_names):
+        """Get the rows of the variants in the in-memory genotype matrix."""
+        self._check_matrix()
+
+        rows = self._mat.index.get_indexer(variant_names)
+        if np.any(rows == -1):
+            missing = np.asarray(variant_names)[rows == -1]
+            raise ValueError(
+                "Variant {} not found in genotype database.".format(missing[0])
+            )
+
+        return rows
+
+    def get_genotype_block(self, variant_names, rows=None):
+        """Get a samples x variants matrix of genotypes.
+
+        The variants are gathered from the in-memory matrix using a single
+        integer index array.
+
+        """
+        if rows is None:
+            rows = self.get_variant_rows(variant_names)
+
+        return self._mat.values[rows, :].T
+
+    def _check_matrix(self):
         # We want to be able to get genotypes even before experiment
         # initialization, mainly for testing. To support this, we will look for
         # the variant in the impute2 file and reset the file.
@@ -354,15 +820,6 @@ class MemoryImpute2Geno(AbstractGenotypeDatabase):
             self._mat = pd.DataFrame(self._mat.T)
             self._mat.index = info["name"]
 
-        try:
-            vect = self._mat.loc[variant_name, :].values
-            return vect
-        except KeyError:
-            msg = "Variant {} not found in genotype database.".format(
-                variant_name
-            )
-            raise ValueError(msg)
-
     def filter_completion(self, rate):
         """Apply a filter on completion rate.
 
@@ -393,6 +850,37 @@ class MemoryImpute2Geno(AbstractGenotypeDatabase):
         logger.info("Setting the MAF threshold to {}".format(maf))
         self.thresh_maf = maf
 
+    def filter_hwe(self, p):
+        """Apply a filter on the Hardy-Weinberg equilibrium test.
+
+        :param p: The minimum p-value for inclusion.
+        :type p: float
+
+        The exact test (mid p-value) is computed using the hard calls
+        (rounded dosage). This is a configuration option.
+
+        """
+        if self._frozen:
+            raise FrozenDatabaseError()
+
+        logger.info("Setting the HWE p-value threshold to {}".format(p))
+        self.thresh_hwe = p
+
+    def filter_info(self, info):
+        """Apply a filter on the imputation quality (IMPUTE info measure).
+
+        :param info: The minimum info for inclusion.
+        :type info: float
+
+        This is a configuration option.
+
+        """
+        if self._frozen:
+            raise FrozenDatabaseError()
+
+        logger.info("Setting the info threshold to {}".format(info))
+        self.thresh_info = info
+
     def filter_name(self, names_list):
         """Only includes variants in a list.
 
@@ -439,25 +927,49 @@ class MemoryImpute2Geno(AbstractGenotypeDatabase):
         if self._frozen:
             raise FrozenDatabaseError()
 
-        # Build a mask.
-        self.samples_mask = np.ones(len(self.samples), dtype=bool)
+        self.samples_keep = SampleIndex(self.samples).get_complement(
+            samples_list
+        )
 
-        # Find the index of the samples to mask.
-        for i in samples_list:
-            idx = np.where(self.samples == i)[0]
-            if len(idx) == 0:
-                raise ValueError("Can't remove samples that are not in the "
-                                 "genotype database ('{}')".format(i))
+        # Also remove from the list of samples.
+        self.samples = self.samples[self.samples_keep]
 
-            if idx.shape[0] > 1:
-                raise ValueError("Samples are not unique ('{}').".format(i))
+    def _insert_block(self, con, block, names, blocks):
+        """Apply the HWE and info filters to a block of variants and insert
+           the remaining ones.
 
-            idx = idx[0]
+        The sample exclusions are applied to the whole block at once.
 
-            self.samples_mask[idx] = False
+        """
+        if not block:
+            blocks.append(np.empty((0, len(self.samples))))
+            return 0
+
+        dosage = np.vstack([i[0] for i in block])
+        variance = np.vstack([i[1] for i in block])
+        if self.samples_keep is not None:
+            dosage = dosage[:, self.samples_keep]
+            variance = variance[:, self.samples_keep]
+
+        hwe_p = _hwe_p(dosage)
+        info = impute_info(dosage, variance)
+
+        passed = ~((hwe_p < self.thresh_hwe) | (info < self.thresh_info))
+        passed = np.where(passed)[0]
+
+        db_buffer = []
+        for j in passed:
+            variant = block[j][2]
+            variant["hwe_p"] = float(hwe_p[j])
+            variant["info"] = float_or_none(info[j])
+            db_buffer.append(variant)
+            names.append(variant["name"])
 
-        # Also remove from the list of samples.
-        self.samples = self.samples[self.samples_mask]
+        if db_buffer:
+            con.execute(Variant.__table__.insert(), db_buffer)
+        blocks.append(dosage[passed, :])
+
+        return len(db_buffer)
 
     def close(self):
         self.impute2file.close()
@@ -472,7 +984,7 @@ class PlinkGenotypeDatabase(AbstractGenotypeDatabase):
     This container relies on `pyplink <http://github.org/lemieuxl/pyplink>`_.
 
     """
-    def __init__(self, prefix, **kwargs):
+    def __init__(self, prefix, chunk_size=1000, **kwargs):
         if not HAS_PYPLINK:
             raise Exception("Install pyplink to use the '{}' class.".format(
                 self.__class__.__name__,
@@ -482,12 +994,20 @@ class PlinkGenotypeDatabase(AbstractGenotypeDatabase):
         self.fam = self.ped.get_fam()
         self.bim = self.ped.get_bim()
 
+        # Number of markers that are read and summarized together.
+        self.chunk_size = chunk_size
+
         # Filters.
         self.min_maf = 0
         self.min_completion = 0
-        self.good_names = []
+        self.min_hwe = 0
+        self.good_names = set()
         self._frozen = False
 
+        # The markers for which a2 is the minor allele (set by
+        # experiment_init).
+        self._flipped = set()
+
         super(PlinkGenotypeDatabase, self).__init__(**kwargs)
 
     def get_sample_order(self):
@@ -498,57 +1018,122 @@ class PlinkGenotypeDatabase(AbstractGenotypeDatabase):
         return list(self.fam["iid"].values)
 
     def get_genotypes(self, variant_name):
-        """Returns a genotype vector for the given variant."""
-        return self.ped.get_geno_marker(variant_name)
+        """Returns a genotype vector for the given variant.
 
-    def experiment_init(self, experiment):
+        The genotypes are the counts of the minor allele (pyplink counts the
+        a1 allele, so the markers for which a2 is the minor allele are
+        flipped). Missing genotypes (encoded as -1 by pyplink) are set to NaN.
+
+        """
+        geno = self.ped.get_geno_marker(variant_name).astype(float)
+        geno[geno == -1] = np.nan
+        if variant_name in self._flipped:
+            geno = 2 - geno
+        return geno
+
+    def experiment_init(self, experiment, batch_insert_n=100000):
         """Initialization method called by the Experiment.
 
         Applies filtering, creates and fills the database.
 
+        The markers are read in chunks of ``chunk_size``. The allele counts
+        and the number of missing genotypes are computed for the whole chunk
+        at once and the filters are applied as boolean masks.
+
         """
         # Create the table.
         super(PlinkGenotypeDatabase, self).experiment_init(experiment)
 
-        # Filter and fill the database.
-        con = experiment.engine.connect()
-        db_variants = []
-        for name, geno in self.ped:
-            info = self.bim.loc[name, :]
-
-            # Name filtering.
-            if self.good_names:
-                if name not in self.good_names:
-                    continue
-
-            # maf filtering.
-            mac = np.nansum(geno)
-            maf = mac / (2 * geno.shape[0])
-            if maf < self.min_maf:
-                continue
-
-            # completion filtering.
-            n_missing = np.sum(np.isnan(geno))
-            n_non_missing = np.sum(~np.isnan(geno))
+        # The name filter is evaluated once for all the markers (the bim file
+        # is in the same order as the bed file).
+        if self.good_names:
+            name_mask = self.bim.index.isin(list(self.good_names))
+        else:
+            name_mask = np.ones(self.bim.shape[0], dtype=bool)
 
-            completion = n_non_missing / geno.shape[0]
-            if completion < self.min_completion:
-                continue
+        chroms = self.bim["chrom"].astype(str).values
+        positions = self.bim["pos"].values
+        a1 = self.bim["a1"].values
+        a2 = self.bim["a2"].values
 
-            # Everything passed, we can add to the db.
-            db_variants.append(
-                dict(name=name, chrom=info.chrom, pos=int(info.pos),
-                     mac=float(mac), n_missing=int(n_missing),
-                     n_non_missing=int(n_non_missing),
-                     minor=info["a1"], major=info["a2"])
+        num_inserts = 0
+        con = experiment.engine.connect()
+        self._flipped = set()
+
+        chunk = []
+        for i, (name, geno) in enumerate(self.ped.iter_geno()):
+            chunk.append(geno)
+            if len(chunk) == self.chunk_size:
+                start = i + 1 - len(chunk)
+                num_inserts += self._insert_chunk(
+                    con, np.vstack(chunk), slice(start, i + 1), name_mask,
+                    chroms, positions, a1, a2, batch_insert_n
+                )
+                chunk = []
+
+        if chunk:
+            start = self.bim.shape[0] - len(chunk)
+            num_inserts += self._insert_chunk(
+                con, np.vstack(chunk), slice(start, None), name_mask, chroms,
+                positions, a1, a2, batch_insert_n
             )
 
-        con.execute(Variant.__table__.insert(), db_variants)
+        con.close()
+
         logger.info("Built the variant database ({} entries).".format(
-            len(db_variants)
+            num_inserts
         ))
         self._frozen = True
 
+    def _insert_chunk(self, con, geno, rows, name_mask, chroms, positions,
+                      a1, a2, batch_insert_n):
+        """Filter a chunk of markers and insert the remaining variants."""
+        missing = geno == -1
+        n_missing = missing.sum(axis=1)
+        n_non_missing = geno.shape[1] - n_missing
+
+        # Counts of the a1 allele (pyplink's encoding).
+        counts = np.where(missing, 0, geno).sum(axis=1, dtype=float)
+
+        # The minor allele is not always a1 (the genotypes of these markers
+        # are flipped by get_genotypes).
+        flip = counts > n_non_missing
+        mac = np.where(flip, 2 * n_non_missing - counts, counts)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            maf = np.nan_to_num(mac / (2 * n_non_missing))
+        completion = n_non_missing / geno.shape[1]
+
+        hwe_p = hwe_exact_midp((geno == 0).sum(axis=1),
+                               (geno == 1).sum(axis=1),
+                               (geno == 2).sum(axis=1))
+
+        keep = (name_mask[rows] & (maf >= self.min_maf) &
+                (completion >= self.min_completion) &
+                (hwe_p >= self.min_hwe))
+
+        names = self.bim.index.values[rows]
+        minor = np.where(flip, a2[rows], a1[rows])
+        major = np.where(flip, a1[rows], a2[rows])
+        chroms = chroms[rows]
+        positions = positions[rows]
+
+        db_buffer = [
+            dict(name=names[j], chrom=chroms[j], pos=int(positions[j]),
+                 mac=float(mac[j]), n_missing=int(n_missing[j]),
+                 n_non_missing=int(n_non_missing[j]),
+                 minor=minor[j], major=major[j], hwe_p=float(hwe_p[j]))
+            for j in np.where(keep)[0]
+        ]
+        self._flipped.update(names[keep & flip])
+
+        # Bulk insert (the list can be empty if everything was filtered).
+        for j in range(0, len(db_buffer), batch_insert_n):
+            con.execute(Variant.__table__.insert(),
+                        db_buffer[j:(j + batch_insert_n)])
+
+        return len(db_buffer)
+
     # Filtering methods.
     def filter_name(self, variant_list):
         """Filter by variant name.
@@ -560,10 +1145,10 @@ class PlinkGenotypeDatabase(AbstractGenotypeDatabase):
             raise FrozenDatabaseError()
 
         if type(variant_list) in (tuple, list):
-            self.good_names = variant_list
+            self.good_names = set(variant_list)
         else:
             with open(variant_list, "r") as f:
-                self.good_names = f.read().split()
+                self.good_names = set(f.read().split())
 
     def filter_maf(self, maf):
         """Filters variants by allele frequency (MAF).
@@ -583,4 +1168,1385 @@ class PlinkGenotypeDatabase(AbstractGenotypeDatabase):
         """
         if self._frozen:
             raise FrozenDatabaseError()
-        self.min_rate = rate
+        self.min_completion = rate
+
+    def filter_hwe(self, p):
+        """Filters variants using the Hardy-Weinberg equilibrium exact test
+           (mid p-value).
+
+        This is a configuration option.
+
+        """
+        if self._frozen:
+            raise FrozenDatabaseError()
+        self.min_hwe = p
+
+
+@abstract
+class AbstractIndexedGenotypeDatabase(AbstractGenotypeDatabase):
+    """Genotype container for indexed files that are read lazily.
+
+    :param chunk_size: The number of variants that are decoded together
+                       during initialization.
+    :type chunk_size: int
+
+    Implementations provide a variant index (``_load_index``) and decode the
+    dosage for a list of rows from the index (``_read_dosage``). This class
+    takes care of the filtering, of filling the database and of the dosage
+    vector accession.
+
+    The index is a DataFrame with one row per variant in the file and (at
+    least) the following columns: name, chrom, pos, n_alleles, a1 and a2.
+    The dosage is expressed as the expected number of minor alleles.
+
+    """
+    def __init__(self, chunk_size=1000, **kwargs):
+        self.chunk_size = chunk_size
+
+        self._index = None  # Lazily loaded variant index.
+        self._variants = None  # Index rows for the variants that passed QC.
+
+        # Filters (init).
+        self.thresh_completion = 0
+        self.thresh_maf = 0
+        self.thresh_hwe = 0
+        self.thresh_info = 0
+        self.names = set()
+        self.regions = []
+        self.samples_keep = None
+
+        self._frozen = False
+
+        super(AbstractIndexedGenotypeDatabase, self).__init__(**kwargs)
+
+    def _load_index(self):
+        """Load (or build) the variant index DataFrame."""
+        raise NotImplementedError()
+
+    def _read_dosage(self, rows, pool=None, min_completion=0, info=False):
+        """Decode the dosage for the variants at the given index rows.
+
+        :param rows: Sorted rows of the index.
+        :type rows: np.ndarray
+
+        :param pool: An optional thread pool to use for decoding.
+        :type pool: :py:class:`multiprocessing.pool.ThreadPool`
+
+        :param min_completion: Variants with a completion rate lower than this
+                               threshold can be skipped (if it can be checked
+                               before decoding).
+        :type min_completion: float
+
+        :param info: Compute the IMPUTE info measure (using the samples that
+                     are not excluded).
+        :type info: bool
+
+        :returns: A boolean mask of the variants that were decoded, the
+                  dosage matrix (variants x samples, before sample
+                  exclusions), a boolean vector indicating if the alleles
+                  were flipped (`i.e.` the first allele is the minor allele)
+                  and the info of the decoded variants (None if it was not
+                  requested or if the format has no genotype probabilities).
+        :rtype: tuple
+
+        """
+        raise NotImplementedError()
+
+    def get_index(self):
+        """Get the variant index (it is loaded on the first call)."""
+        if self._index is None:
+            self._index = self._load_index()
+            self._index_names = pd.Series(
+                np.arange(self._index.shape[0]),
+                index=self._index["name"].values
+            )
+
+        return self._index
+
+    def _select_variants(self, index):
+        """Boolean mask of the variants selected only using the index."""
+        keep = (index["n_alleles"] == 2).values
+        if not np.all(keep):
+            logger.warning("Ignoring {} multiallelic variants.".format(
+                np.sum(~keep)
+            ))
+
+        if self.names:
+            keep &= index["name"].isin(self.names).values
+
+        if self.regions:
+            in_regions = np.zeros(index.shape[0], dtype=bool)
+            for chrom, start, end in self.regions:
+                in_regions |= ((index["chrom"] == chrom) &
+                               (index["pos"] >= start) &
+                               (index["pos"] <= end)).values
+            keep &= in_regions
+
+        return keep
+
+    def experiment_init(self, experiment, batch_insert_n=100000):
+        """Experiment specific initialization.
+
+        This takes care of initializing the database and filtering variants. It
+        is automatically called by the Experiment.
+
+        """
+        super(AbstractIndexedGenotypeDatabase, self).experiment_init(
+            experiment
+        )
+
+        index = self.get_index()
+        candidates = np.where(self._select_variants(index))[0]
+
+        # The completion can only be checked before decoding if no samples
+        # are excluded.
+        min_completion = 0
+        if self.samples_keep is None:
+            min_completion = self.thresh_completion
+
+        self._variants = {}
+        num_inserts = 0
+        con = experiment.engine.connect()
+        self._cpu = getattr(experiment, "cpu", 1)
+        pool = ThreadPool(self._cpu)
+
+        for i in range(0, candidates.shape[0], self.chunk_size):
+            rows = candidates[i:(i + self.chunk_size)]
+            decoded, dosage, flips, info = self._read_dosage(
+                rows, pool, min_completion, info=True
+            )
+            rows = rows[decoded]
+            if self.samples_keep is not None:
+                dosage = dosage[:, self.samples_keep]
+
+            # Filtering (vectorized over the chunk).
+            n_missing = np.sum(np.isnan(dosage), axis=1)
+            n_non_missing = dosage.shape[1] - n_missing
+            mac = np.nansum(dosage, axis=1)
+
+            with np.errstate(invalid="ignore", divide="ignore"):
+                maf = mac / (2 * n_non_missing)
+            completion = n_non_missing / dosage.shape[1]
+
+            hwe_p = _hwe_p(dosage)
+            if info is None:
+                info = np.full(dosage.shape[0], np.nan)
+
+            passed = ((completion >= self.thresh_completion) &
+                      (maf >= self.thresh_maf) &
+                      (hwe_p >= self.thresh_hwe) &
+                      ~(info < self.thresh_info))
+
+            db_buffer = []
+            for j in np.where(passed)[0]:
+                row = index.iloc[rows[j], :]
+                minor, major = row["a2"], row["a1"]
+                if flips[j]:
+                    minor, major = major, minor
+
+                self._variants[row["name"]] = rows[j]
+                db_buffer.append(dict(
+                    name=row["name"], chrom=row["chrom"], pos=int(row["pos"]),
+                    mac=float(mac[j]), minor=minor, major=major,
+                    n_missing=int(n_missing[j]),
+                    n_non_missing=int(n_non_missing[j]),
+                    hwe_p=float(hwe_p[j]), info=float_or_none(info[j])
+                ))
+
+            for j in range(0, len(db_buffer), batch_insert_n):
+                con.execute(Variant.__table__.insert(),
+                            db_buffer[j:(j + batch_insert_n)])
+            num_inserts += len(db_buffer)
+
+        pool.close()
+        con.close()
+
+        logger.info("Built the variant database ({} entries).".format(
+            num_inserts
+        ))
+
+        self._frozen = True
+
+    def get_genotypes(self, variant_name):
+        """Get a vector of genotypes for a variant.
+
+        :param variant_name: The variant name (e.g. rs123456)
+        :type variant_name: str
+
+        :returns: A vector of minor allele dosage.
+        :rtype: np.nadarray
+
+        """
+        row = self._get_row(variant_name)
+
+        dosage = self._read_dosage(np.array([row]))[1]
+        dosage = dosage[0, :]
+        if self.samples_keep is not None:
+            dosage = dosage[self.samples_keep]
+
+        return dosage
+
+    def get_variant_rows(self, variant_names):
+        """Get the rows of the variants in the file's index."""
+        return np.array([self._get_row(name) for name in variant_names],
+                        dtype=int)
+
+    def get_genotype_block(self, variant_names, rows=None):
+        """Get a samples x variants matrix of minor allele dosage.
+
+        The variants are decoded in file order, so that consecutive records
+        are read together.
+
+        """
+        if rows is None:
+            rows = self.get_variant_rows(variant_names)
+
+        if len(rows) == 0:
+            return np.empty((len(self.get_sample_order()), 0))
+
+        unique_rows, inverse = np.unique(rows, return_inverse=True)
+
+        cpu = getattr(self, "_cpu", 1)
+        pool = ThreadPool(cpu) if cpu > 1 else None
+        dosage = self._read_dosage(unique_rows, pool=pool)[1]
+        if pool is not None:
+            pool.close()
+
+        dosage = dosage[inverse, :]
+        if self.samples_keep is not None:
+            dosage = dosage[:, self.samples_keep]
+
+        return dosage.T
+
+    def _get_row(self, variant_name):
+        if self._variants is not None:
+            # Only the variants that passed QC are available.
+            row = self._variants.get(variant_name)
+        else:
+            self.get_index()
+            row = self._index_names.get(variant_name)
+            if np.ndim(row) != 0:
+                row = None
+
+        if row is None:
+            raise ValueError(
+                "Variant {} not found in genotype database.".format(
+                    variant_name
+                )
+            )
+
+        return row
+
+    def filter_completion(self, rate):
+        """Apply a filter on completion rate.
+
+        :param rate: The minimum completion rate for inclusion.
+        :type rate: float
+
+        This is a configuration option.
+
+        """
+        if self._frozen:
+            raise FrozenDatabaseError()
+
+        logger.info("Setting the completion threshold to {}".format(rate))
+        self.thresh_completion = rate
+
+    def filter_maf(self, maf):
+        """Apply a filter on minor allele frequency.
+
+        :param rate: The minimum maf for inclusion.
+        :type rate: float
+
+        This is a configuration option.
+
+        """
+        if self._frozen:
+            raise FrozenDatabaseError()
+
+        logger.info("Setting the MAF threshold to {}".format(maf))
+        self.thresh_maf = maf
+
+    def filter_hwe(self, p):
+        """Apply a filter on the Hardy-Weinberg equilibrium test.
+
+        :param p: The minimum p-value for inclusion.
+        :type p: float
+
+        The exact test (mid p-value) is computed using the hard calls
+        (rounded dosage). This is a configuration option.
+
+        """
+        if self._frozen:
+            raise FrozenDatabaseError()
+
+        logger.info("Setting the HWE p-value threshold to {}".format(p))
+        self.thresh_hwe = p
+
+    def filter_info(self, info):
+        """Apply a filter on the imputation quality (IMPUTE info measure).
+
+        :param info: The minimum info for inclusion.
+        :type info: float
+
+        This is a configuration option. It is only available for formats
+        with genotype probabilities.
+
+        """
+        if self._frozen:
+            raise FrozenDatabaseError()
+
+        logger.info("Setting the info threshold to {}".format(info))
+        self.thresh_info = info
+
+    def filter_name(self, names_list):
+        """Only includes variants in a list.
+
+        :param names_list: Either a list of variant names or the path to a file
+                           containing a single column of variant names.
+        :type names_list: str
+
+        Variants that are not in the list are never decoded.
+
+        This is a configuration option.
+
+        """
+        if self._frozen:
+            raise FrozenDatabaseError()
+
+        if type(names_list) in (list, tuple):
+            self.names = set(names_list)
+
+        else:
+            logger.info("Keeping only variants with IDs in file: '{}'".format(
+                names_list
+            ))
+            with open(expand(names_list), "r") as f:
+                self.names = set(f.read().splitlines())
+
+    def filter_region(self, regions):
+        """Only includes variants in the given genomic regions.
+
+        :param regions: A list of regions formatted as ``chrom:start-end``
+                        (`e.g.` ``"3:12345-23456"``). Bounds are inclusive.
+        :type regions: list
+
+        Variants outside of the regions are never decoded.
+
+        This is a configuration option.
+
+        """
+        if self._frozen:
+            raise FrozenDatabaseError()
+
+        if not type(regions) in (list, tuple):
+            regions = [regions]
+
+        self.regions = [parse_region(region) for region in regions]
+
+    def exclude_samples(self, samples_list):
+        """Exclude samples in the list.
+
+        :param samples_list: A list of samples to exclude.
+        :type samples_list: list
+
+        This is a configuration option.
+
+        """
+        if self._frozen:
+            raise FrozenDatabaseError()
+
+        self.samples_keep = SampleIndex(self.samples).get_complement(
+            samples_list
+        )
+        self.samples = self.samples[self.samples_keep]
+
+    def close(self):
+        self._file.close()
+
+
+class BgenGenotypeDatabase(AbstractIndexedGenotypeDatabase):
+    """Container for BGEN files (v1.2, layout 2).
+
+    :param filename: The filename for the BGEN file.
+    :type filename: str
+
+    :param samples: (optional) A list containing a single column and no
+                    header. The rows are the ordered sample IDs. If it is
+                    not provided, the sample identifiers stored in the BGEN
+                    file are used.
+    :type samples: str
+
+    :param index: (optional) Path to a variant offset index. The default is
+                  the BGEN filename with a ``.bgi`` suffix. Existing indices
+                  (`e.g.` built by ``bgenix``) are reused. If no index is
+                  found, it is built by scanning the file and saved to this
+                  path.
+    :type index: str
+
+    :param filter_probability: A cutoff for imputation probability. Only
+                               genotypes with an imputation probability above
+                               this threshold will be used for the analysis.
+    :type filter_probability: float
+
+    Only biallelic variants for diploid samples are supported. Dosage vectors
+    are read lazily from the disk using the offset index (the file is not
+    loaded in memory). As for IMPUTE2 files, the dosage is expressed as the
+    expected number of minor alleles.
+
+    Probability blocks are decompressed in worker threads (one per CPU
+    allocated to the experiment). Variants that are excluded by the name
+    filter are never decompressed and the completion filter is checked using
+    the missingness flags before computing the dosage.
+
+    """
+    def __init__(self, filename, samples=None, index=None,
+                 filter_probability=0, **kwargs):
+        self.filename = expand(filename)
+        self._file = open(self.filename, "rb")
+        self._lock = threading.Lock()
+
+        self._parse_header()
+
+        # Samples from the companion file have precedence over the samples
+        # block.
+        if samples is not None:
+            self.samples = self.load_samples(expand(samples))
+        elif self._file_samples is not None:
+            self.samples = self._file_samples
+        else:
+            raise ValueError("The BGEN file '{}' does not contain sample "
+                             "identifiers. Use the 'samples' argument to "
+                             "provide them.".format(self.filename))
+
+        if self.samples.shape[0] != self.n_samples:
+            raise ValueError(
+                "The number of samples ({}) is different from the number "
+                "of samples in the BGEN file ({}).".format(
+                    self.samples.shape[0], self.n_samples
+                )
+            )
+
+        if index is None:
+            self.index_filename = self.filename + ".bgi"
+        else:
+            self.index_filename = expand(index)
+
+        self.prob_threshold = filter_probability
+
+        super(BgenGenotypeDatabase, self).__init__(**kwargs)
+
+    def _parse_header(self):
+        """Parse the header and sample identifier blocks."""
+        f = self._file
+        f.seek(0)
+
+        offset, header_length, n_variants, n_samples = struct.unpack(
+            "<IIII", f.read(16)
+        )
+        magic = f.read(4)
+        if magic not in (b"bgen", b"\x00\x00\x00\x00"):
+            raise ValueError("'{}' is not a BGEN file.".format(self.filename))
+
+        # Skip the free data area.
+        f.seek(header_length - 20, 1)
+        flags, = struct.unpack("<I", f.read(4))
+
+        self.n_variants = n_variants
+        self.n_samples = n_samples
+        self._first_variant = offset + 4
+
+        self.compression = flags & 3
+        layout = (flags >> 2) & 15
+        if layout != 2:
+            raise NotImplementedError(
+                "Only layout 2 BGEN files (v1.2) are supported."
+            )
+
+        if self.compression == 2 and not HAS_ZSTANDARD:
+            raise Exception("Install zstandard to read zstd compressed BGEN "
+                            "files.")
+
+        # Sample identifiers.
+        self._file_samples = None
+        if flags >> 31:
+            f.seek(header_length + 4)
+            _, n = struct.unpack("<II", f.read(8))
+            samples = []
+            for _ in range(n):
+                length, = struct.unpack("<H", f.read(2))
+                samples.append(f.read(length).decode("utf-8"))
+            self._file_samples = np.array(samples, dtype=str)
+
+    def _load_index(self):
+        """Load (or build) the variant offset index.
+
+        In addition to the standard columns, the index has the offset and
+        size (in bytes) of every variant in the file.
+
+        """
+        if _is_index_valid(self.index_filename, self.filename):
+            logger.info("Using the BGEN index '{}'.".format(
+                self.index_filename
+            ))
+            con = sqlite3.connect(self.index_filename)
+            index = pd.read_sql(
+                "SELECT rsid AS name, chromosome AS chrom, position AS pos, "
+                "number_of_alleles AS n_alleles, allele1 AS a1, "
+                "allele2 AS a2, file_start_position AS offset, "
+                "size_in_bytes AS size "
+                "FROM Variant ORDER BY file_start_position",
+                con
+            )
+            con.close()
+            return index
+
+        index = self._build_index()
+        self._write_index(index)
+        return index
+
+    def _build_index(self):
+        """Scan the file to build the variant offset index."""
+        logger.info("Indexing the BGEN file '{}'.".format(self.filename))
+
+        records = []
+        with open(self.filename, "rb") as f:
+            f.seek(self._first_variant)
+            for _ in range(self.n_variants):
+                start = f.tell()
+                varid, rsid, chrom, pos, alleles = _bgen_read_identifiers(f)
+
+                # Skip the genotype data block.
+                length, = struct.unpack("<I", f.read(4))
+                f.seek(length, 1)
+
+                records.append((
+                    rsid if rsid and rsid != "." else varid, chrom, pos,
+                    len(alleles), alleles[0],
+                    alleles[1] if len(alleles) > 1 else None,
+                    start, f.tell() - start
+                ))
+
+        return pd.DataFrame(records, columns=["name", "chrom", "pos",
+                                              "n_alleles", "a1", "a2",
+                                              "offset", "size"])
+
+    def _write_index(self, index):
+        """Write the index using the bgenix (sqlite) schema."""
+        try:
+            con = sqlite3.connect(self.index_filename)
+            con.execute("DROP TABLE IF EXISTS Variant")
+            con.execute(
+                "CREATE TABLE Variant ("
+                "  chromosome TEXT NOT NULL,"
+                "  position INT NOT NULL,"
+                "  rsid TEXT NOT NULL,"
+                "  number_of_alleles INT NOT NULL,"
+                "  allele1 TEXT NOT NULL,"
+                "  allele2 TEXT NULL,"
+                "  file_start_position INT NOT NULL,"
+                "  size_in_bytes INT NOT NULL"
+                ")"
+            )
+            con.executemany(
+                "INSERT INTO Variant VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    (row.chrom, int(row.pos), row.name, int(row.n_alleles),
+                     row.a1, row.a2, int(row.offset), int(row.size))
+                    for row in index.itertuples()
+                )
+            )
+            con.commit()
+            con.close()
+            logger.info("Wrote the BGEN index to '{}'.".format(
+                self.index_filename
+            ))
+
+        except (IOError, OSError, sqlite3.Error):
+            logger.warning("Could not write the BGEN index to '{}'. It will "
+                           "be rebuilt every time.".format(
+                               self.index_filename
+                           ))
+
+    def _read_block(self, offset, size):
+        """Read the probability data block for the variant at offset.
+
+        The raw (compressed) block is returned.
+
+        """
+        with self._lock:
+            self._file.seek(offset)
+            buf = self._file.read(size)
+
+        # Skip the variant identifying data.
+        skip = 0
+        for _ in range(3):
+            length, = struct.unpack_from("<H", buf, skip)
+            skip += 2 + length
+
+        # pos, number of alleles.
+        _, n_alleles = struct.unpack_from("<IH", buf, skip)
+        skip += 6
+        for _ in range(n_alleles):
+            length, = struct.unpack_from("<I", buf, skip)
+            skip += 4 + length
+
+        return buf[skip + 4:]
+
+    def _decode(self, block, min_completion=0, info=False):
+        """Decompress a block and compute the dosage vector.
+
+        :returns: The minor allele dosage vector, a flag indicating if the
+                  alleles were flipped (if the second allele is the major
+                  allele) and the info measure (if requested). If the
+                  variant does not pass the completion threshold based on
+                  the missingness flags, None is returned.
+        :rtype: tuple
+
+        This is thread safe and used by the workers.
+
+        """
+        data = _bgen_decompress(block, self.compression)
+
+        n, n_alleles, min_ploidy, max_ploidy = struct.unpack_from(
+            "<IHBB", data, 0
+        )
+        if n_alleles != 2:
+            raise ValueError("Only biallelic variants are supported.")
+
+        ploidy = np.frombuffer(data, dtype=np.uint8, count=n, offset=8)
+        missing = (ploidy & 128).astype(bool)
+
+        # Check the completion rate before decoding the probabilities.
+        if min_completion and (n - np.sum(missing)) / n < min_completion:
+            return None
+
+        if np.any((ploidy & 63)[~missing] != 2):
+            raise ValueError("Only diploid samples are supported.")
+
+        phased, n_bits = struct.unpack_from("<BB", data, 8 + n)
+        values = _bgen_unpack(data, 10 + n, 2 * n, n_bits)
+        values = values.reshape(n, 2) / (2 ** n_bits - 1)
+
+        if phased:
+            # We have the probability of the first allele for each haplotype.
+            dosage = 2 - values[:, 0] - values[:, 1]
+            if info:
+                variance = np.sum(values * (1 - values), axis=1)
+            if self.prob_threshold > 0:
+                probs = np.vstack((
+                    values[:, 0] * values[:, 1],
+                    (values[:, 0] * (1 - values[:, 1]) +
+                     (1 - values[:, 0]) * values[:, 1]),
+                    (1 - values[:, 0]) * (1 - values[:, 1])
+                )).T
+        else:
+            # We have p(AA) and p(AB), p(BB) is implied.
+            p_bb = np.clip(1 - values[:, 0] - values[:, 1], 0, 1)
+            dosage = 2 * p_bb + values[:, 1]
+            if info:
+                variance = 4 * p_bb + values[:, 1] - dosage ** 2
+            if self.prob_threshold > 0:
+                probs = np.hstack((values, p_bb[:, np.newaxis]))
+
+        if self.prob_threshold > 0:
+            missing |= ~np.any(probs > self.prob_threshold, axis=1)
+
+        dosage[missing] = np.nan
+
+        # Express the dosage in terms of the minor allele.
+        flip = np.nanmean(dosage) > 1
+        if flip:
+            dosage = 2 - dosage
+
+        # The variance does not depend on the coding of the alleles.
+        info_value = None
+        if info:
+            if self.samples_keep is not None:
+                info_value = impute_info(dosage[self.samples_keep],
+                                         variance[self.samples_keep])[0]
+            else:
+                info_value = impute_info(dosage, variance)[0]
+
+        return dosage, flip, info_value
+
+    def _read_dosage(self, rows, pool=None, min_completion=0, info=False):
+        index = self._index
+        blocks = [
+            self._read_block(offset, size) for offset, size in
+            zip(index["offset"].values[rows], index["size"].values[rows])
+        ]
+
+        # Sequential I/O, then decompression and decoding in threads.
+        def _f(block):
+            return self._decode(block, min_completion, info)
+
+        decoded = pool.map(_f, blocks) if pool else [_f(b) for b in blocks]
+
+        passed = np.array([d is not None for d in decoded], dtype=bool)
+        decoded = [d for d in decoded if d is not None]
+        if not decoded:
+            return (passed, np.empty((0, self.n_samples)), np.empty(0, bool),
+                    np.empty(0) if info else None)
+
+        return (
+            passed,
+            np.vstack([d[0] for d in decoded]),
+            np.array([d[1] for d in decoded], dtype=bool),
+            np.array([d[2] for d in decoded], dtype=float) if info else None
+        )
+
+
+class VCFGenotypeDatabase(AbstractIndexedGenotypeDatabase):
+    """Container for bgzipped VCF files.
+
+    :param filename: The filename for the bgzipped VCF file.
+    :type filename: str
+
+    :param field: (optional) The FORMAT field to use ("DS" or "GT"). If it is
+                  not provided, the dosage (DS) is used if it is defined in
+                  the header.
+    :type field: str
+
+    :param index: (optional) Path to the variant index. The default is the
+                  VCF filename with a ``.fwdidx.npz`` suffix. The index is
+                  built and saved if it does not exist.
+    :type index: str
+
+    The index contains the BGZF virtual offset of every record (the offset
+    of the compressed block and the offset within the uncompressed block).
+    Variants are decoded in chunks of consecutive records, so that only the
+    BGZF blocks that contain selected variants are decompressed (`e.g.` when
+    using ``filter_name`` or ``filter_region``).
+
+    Only biallelic variants are supported. Haploid genotype calls are treated
+    as missing when using the GT field.
+
+    """
+    def __init__(self, filename, field=None, index=None, **kwargs):
+        self.filename = expand(filename)
+        self._file = open(self.filename, "rb")
+        self._lock = threading.Lock()
+
+        header = self._read_header()
+        self.samples = np.array(
+            header[-1].split("\t")[9:], dtype=str
+        )
+
+        if field is None:
+            field = "GT"
+            if any([l.startswith("##FORMAT=<ID=DS,") for l in header]):
+                field = "DS"
+
+        if field not in ("DS", "GT"):
+            raise ValueError("Unsupported VCF field '{}' (use DS or "
+                             "GT).".format(field))
+        logger.info("Using the '{}' field from the VCF file.".format(field))
+        self.field = field
+
+        if index is None:
+            self.index_filename = self.filename + ".fwdidx.npz"
+        else:
+            self.index_filename = expand(index)
+
+        super(VCFGenotypeDatabase, self).__init__(**kwargs)
+
+    def _read_header(self):
+        """Read the header lines (including the #CHROM line)."""
+        coffset = 0
+        data = b""
+        while data.find(b"\n#CHROM") == -1 or not data.endswith(b"\n"):
+            cdata, coffset = _bgzf_raw_block(self._file, coffset)
+            if cdata is None:
+                raise ValueError("Could not find the header in the VCF file "
+                                 "'{}'.".format(self.filename))
+            data += _bgzf_inflate(cdata)
+
+            # We have the whole header.
+            chrom_line = data.find(b"\n#CHROM")
+            if chrom_line != -1 and data.find(b"\n", chrom_line + 1) != -1:
+                break
+
+        header = []
+        for line in data.decode("utf-8").split("\n"):
+            if not line.startswith("#"):
+                break
+            header.append(line.rstrip("\r"))
+
+        return header
+
+    def _load_index(self):
+        """Load (or build) the variant index.
+
+        In addition to the standard columns, the index has the BGZF virtual
+        offset of every record.
+
+        """
+        if _is_index_valid(self.index_filename, self.filename):
+            logger.info("Using the VCF index '{}'.".format(
+                self.index_filename
+            ))
+            index = np.load(self.index_filename, allow_pickle=False)
+            return pd.DataFrame({k: index[k] for k in index.files})[[
+                "name", "chrom", "pos", "n_alleles", "a1", "a2", "voffset"
+            ]]
+
+        index = self._build_index()
+        try:
+            with open(self.index_filename, "wb") as f:
+                np.savez(f, **{
+                    k: index[k].values.astype(
+                        str if index[k].dtype == object else index[k].dtype
+                    )
+                    for k in index.columns
+                })
+            logger.info("Wrote the VCF index to '{}'.".format(
+                self.index_filename
+            ))
+        except (IOError, OSError):
+            logger.warning("Could not write the VCF index to '{}'. It will "
+                           "be rebuilt every time.".format(
+                               self.index_filename
+                           ))
+
+        return index
+
+    def _build_index(self):
+        """Scan the file to record the virtual offset of every record."""
+        logger.info("Indexing the VCF file '{}'.".format(self.filename))
+
+        records = []
+        leftover = b""
+        leftover_voffset = None
+        coffset = 0
+
+        def _add_record(line, voffset):
+            if line.startswith(b"#") or not line.strip():
+                return
+            chrom, pos, name, ref, alt = line.split(b"\t", 5)[:5]
+            chrom, name = chrom.decode("utf-8"), name.decode("utf-8")
+            ref, alt = ref.decode("utf-8"), alt.decode("utf-8")
+            if name == ".":
+                name = ":".join((chrom, pos.decode("utf-8"), ref, alt))
+            records.append((name, chrom, int(pos), alt.count(",") + 2, ref,
+                            alt, voffset))
+
+        with open(self.filename, "rb") as f:
+            while True:
+                cdata, next_coffset = _bgzf_raw_block(f, coffset)
+                if cdata is None:
+                    break
+                data = _bgzf_inflate(cdata)
+
+                start = 0
+                end = data.find(b"\n")
+                while end != -1:
+                    if leftover:
+                        _add_record(leftover + data[start:end],
+                                    leftover_voffset)
+                        leftover = b""
+                    else:
+                        _add_record(data[start:end], (coffset << 16) | start)
+                    start = end + 1
+                    end = data.find(b"\n", start)
+
+                # Lines that span multiple blocks.
+                if start < len(data):
+                    if not leftover:
+                        leftover_voffset = (coffset << 16) | start
+                    leftover += data[start:]
+
+                coffset = next_coffset
+
+        if leftover:
+            _add_record(leftover, leftover_voffset)
+
+        index = pd.DataFrame(records, columns=["name", "chrom", "pos",
+                                               "n_alleles", "a1", "a2",
+                                               "voffset"])
+        index["voffset"] = index["voffset"].astype(np.int64)
+        return index
+
+    def _read_lines(self, rows, pool=None):
+        """Read the lines for a run of consecutive records."""
+        voffsets = self._index["voffset"].values
+        first, last = int(voffsets[rows[0]]), int(voffsets[rows[-1]])
+
+        # Read all the blocks up to the start of the last record.
+        raw = []
+        coffset = first >> 16
+        with self._lock:
+            while coffset <= (last >> 16):
+                cdata, coffset = _bgzf_raw_block(self._file, coffset)
+                raw.append(cdata)
+
+        if pool is not None:
+            blocks = pool.map(_bgzf_inflate, raw)
+        else:
+            blocks = [_bgzf_inflate(cdata) for cdata in raw]
+
+        # Read more blocks if the last line is incomplete.
+        last_start = sum([len(b) for b in blocks[:-1]]) + (last & 0xFFFF)
+        data = b"".join(blocks)
+        while data.find(b"\n", last_start) == -1:
+            with self._lock:
+                cdata, coffset = _bgzf_raw_block(self._file, coffset)
+            if cdata is None:
+                break
+            data += _bgzf_inflate(cdata)
+
+        return data[(first & 0xFFFF):].split(b"\n", len(rows))[:len(rows)]
+
+    def _read_dosage(self, rows, pool=None, min_completion=0, info=False):
+        # Split the rows into runs of consecutive records.
+        runs = np.split(rows, np.where(np.diff(rows) != 1)[0] + 1)
+        lines = []
+        for run in runs:
+            lines.extend(self._read_lines(run, pool))
+
+        dosage = _vcf_dosage(lines, self.field.encode("utf-8"))
+
+        # Express the dosage in terms of the minor allele.
+        with np.errstate(invalid="ignore"):
+            flips = np.nanmean(dosage, axis=1) > 1
+        dosage[flips, :] = 2 - dosage[flips, :]
+
+        # There are no genotype probabilities to compute the info.
+        return np.ones(len(rows), dtype=bool), dosage, flips, None
+
+    def filter_info(self, info):
+        """The info measure is not available for VCF files."""
+        raise NotImplementedError("The info measure requires genotype "
+                                  "probabilities (not available for VCF "
+                                  "files).")
+
+
+class MultiFileGenotypeDatabase(AbstractGenotypeDatabase):
+    """Container for genotypes split across many files (`e.g.` one file per
+       chromosome).
+
+    :param container: The genotype container used for every file (`e.g.`
+                      "BgenGenotypeDatabase").
+    :type container: str
+
+    :param filenames: A glob pattern or a list of filenames. For PLINK files,
+                      either the prefixes or the ``.bed`` files can be given.
+    :type filenames: str or list
+
+    The other arguments are passed to the container of every file (`e.g.`
+    ``samples`` or the filtering options). All the files need to have the
+    same samples, in the same order.
+
+    Files are opened lazily. During the experiment initialization, they are
+    initialized in parallel (using ``experiment.cpu`` threads), each in a
+    temporary database which is then merged in the experiment's variants
+    table. The variants are then routed to the file that contains them
+    without reading the other files.
+
+    """
+    def __init__(self, container, filenames, **kwargs):
+        if type(container) is str:
+            if container not in __all__ or container == type(self).__name__:
+                raise ValueError(
+                    "Unknown genotype container '{}'.".format(container)
+                )
+            container = globals()[container]
+        self.container = container
+
+        if not type(filenames) in (list, tuple):
+            filenames = sorted(glob.glob(expand(filenames)))
+            if not filenames:
+                raise ValueError("No genotype files match '{}'.".format(
+                    expand(filenames)
+                ))
+        self.filenames = [expand(filename) for filename in filenames]
+
+        if self.container is PlinkGenotypeDatabase:
+            self.filenames = [
+                filename[:-4] if filename.endswith(".bed") else filename
+                for filename in self.filenames
+            ]
+
+        # The arguments (and method calls) for the container of every file.
+        self._container_kwargs = kwargs
+        self._dbs = [None] * len(self.filenames)
+        self._lock = threading.Lock()
+
+        # The virtual variant index (variant name to file) that is built
+        # during the experiment initialization.
+        self._names = None
+        self._files = None
+        self._frozen = False
+
+    def get_database(self, i):
+        """Get (and open if needed) the genotype database for the ith file."""
+        if self._dbs[i] is None:
+            reference = self.get_database(0) if i != 0 else None
+
+            with self._lock:
+                if self._dbs[i] is None:
+                    logger.info("Opening genotype file '{}'.".format(
+                        self.filenames[i]
+                    ))
+                    db = self.container(self.filenames[i],
+                                        **self._container_kwargs)
+
+                    if reference is not None:
+                        reference_samples = list(reference.get_sample_order())
+                        if reference_samples != list(db.get_sample_order()):
+                            raise ValueError(
+                                "The samples of '{}' are not the same as the "
+                                "samples of '{}'.".format(self.filenames[i],
+                                                          self.filenames[0])
+                            )
+
+                    self._dbs[i] = db
+
+        return self._dbs[i]
+
+    def get_sample_order(self):
+        return self.get_database(0).get_sample_order()
+
+    def experiment_init(self, experiment, batch_insert_n=100000):
+        """Initialize the files in parallel and merge their variants."""
+        super(MultiFileGenotypeDatabase, self).experiment_init(experiment)
+
+        parts_dir = os.path.join(experiment.name, "genotype_parts")
+        if not os.path.isdir(parts_dir):
+            os.makedirs(parts_dir)
+
+        def _init(i):
+            part = _PartialExperiment(
+                os.path.join(parts_dir, "part{}.db".format(i + 1))
+            )
+            self.get_database(i).experiment_init(part)
+            return part
+
+        n_cpu = min(getattr(experiment, "cpu", 1), len(self.filenames))
+        pool = ThreadPool(max(1, n_cpu))
+        parts = pool.map(_init, range(len(self.filenames)))
+        pool.close()
+
+        # Merge the variants in the experiment's database.
+        names = []
+        files = []
+        table = Variant.__table__
+        con = experiment.engine.connect()
+        for i, part in enumerate(parts):
+            part_con = part.engine.connect()
+            result = part_con.execute(select([table]))
+            while True:
+                rows = result.fetchmany(batch_insert_n)
+                if not rows:
+                    break
+
+                rows = [dict(row) for row in rows]
+                con.execute(table.insert(), rows)
+                names.extend([row["name"] for row in rows])
+                files.append(np.full(len(rows), i, dtype=int))
+
+            part_con.close()
+            part.clean()
+
+        con.close()
+        shutil.rmtree(parts_dir)
+
+        self._names = pd.Index(names)
+        self._files = (np.concatenate(files) if files
+                       else np.array([], dtype=int))
+
+        logger.info("Built the variant database ({} entries from {} "
+                    "files).".format(len(names), len(self.filenames)))
+
+        self._frozen = True
+
+    def get_genotypes(self, variant_name):
+        """Get a vector of genotypes from the file containing the variant."""
+        if self._names is not None:
+            row = self.get_variant_rows([variant_name])[0]
+            return self.get_database(self._files[row]).get_genotypes(
+                variant_name
+            )
+
+        # Before initialization, we need to look in every file.
+        for i in range(len(self.filenames)):
+            try:
+                return self.get_database(i).get_genotypes(variant_name)
+            except (ValueError, KeyError):
+                continue
+
+        raise ValueError("Variant {} not found in genotype database.".format(
+            variant_name
+        ))
+
+    def get_variant_rows(self, variant_names):
+        """Get the rows of the variants in the virtual variant index."""
+        if self._names is None:
+            raise ValueError("The genotype database needs to be initialized "
+                             "by an experiment before using variant rows.")
+
+        rows = self._names.get_indexer(variant_names)
+        if np.any(rows == -1):
+            missing = np.asarray(variant_names)[rows == -1]
+            raise ValueError(
+                "Variant {} not found in genotype database.".format(missing[0])
+            )
+
+        return rows
+
+    def get_genotype_block(self, variant_names, rows=None):
+        """Get a samples x variants matrix of genotypes.
+
+        The variants are grouped by file and every file is only asked for
+        the variants it contains.
+
+        """
+        if self._names is None:
+            return super(MultiFileGenotypeDatabase, self).get_genotype_block(
+                variant_names
+            )
+
+        if rows is None:
+            rows = self.get_variant_rows(variant_names)
+
+        variant_names = np.asarray(variant_names)
+        files = self._files[rows]
+
+        block = np.empty((len(self.get_sample_order()), len(rows)))
+        for i in np.unique(files):
+            columns = np.where(files == i)[0]
+            block[:, columns] = self.get_database(i).get_genotype_block(
+                list(variant_names[columns])
+            )
+
+        return block
+
+    def _configure(self, method, value):
+        """Set an option for the files (including the opened ones)."""
+        if self._frozen:
+            raise FrozenDatabaseError()
+
+        self._container_kwargs[method] = value
+        for db in self._dbs:
+            if db is not None:
+                getattr(db, method)(value)
+
+    def filter_name(self, variant_list):
+        # The files are opened lazily, so the list is read right away.
+        if not type(variant_list) in (tuple, list):
+            with open(expand(variant_list), "r") as f:
+                variant_list = f.read().split()
+
+        self._configure("filter_name", variant_list)
+
+    def filter_maf(self, maf):
+        self._configure("filter_maf", maf)
+
+    def filter_completion(self, rate):
+        self._configure("filter_completion", rate)
+
+    def filter_hwe(self, p):
+        self._configure("filter_hwe", p)
+
+    def filter_info(self, info):
+        self._configure("filter_info", info)
+
+    def filter_region(self, regions):
+        self._configure("filter_region", regions)
+
+    def exclude_samples(self, samples_list):
+        self._configure("exclude_samples", samples_list)
+
+    def close(self):
+        for db in self._dbs:
+            if db is not None and hasattr(db, "close"):
+                db.close()
+
+
+class _PartialExperiment(object):
+    """Minimal experiment used to initialize one file of a multi-file
+       genotype database in its own (temporary) database.
+
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.engine = sqlalchemy.create_engine(
+            "sqlite:///{}".format(db_path)
+        )
+        self.cpu = 1
+
+    def clean(self):
+        self.engine.dispose()
+        if os.path.isfile(self.db_path):
+            os.remove(self.db_path)
+
+
+def _impute2_dosage(probabilities, prob_threshold=0):
+    """Compute the minor allele dosage from IMPUTE2 probabilities.
+
+    :returns: The dosage (NaN if no probability is above the threshold), the
+              variance of the genotype distribution (used for the info
+              measure) and whether the alleles were flipped (if a1 is the
+              minor allele).
+    :rtype: tuple
+
+    """
+    p_ab, p_bb = probabilities[:, 1], probabilities[:, 2]
+    dosage = p_ab + 2 * p_bb
+    variance = p_ab + 4 * p_bb - dosage ** 2
+
+    if prob_threshold > 0:
+        dosage[~np.any(probabilities > prob_threshold, axis=1)] = np.nan
+
+    # The minor allele frequency is larger than 0.5.
+    flip = np.nansum(dosage) > np.sum(~np.isnan(dosage))
+    if flip:
+        dosage = 2 - dosage
+
+    return dosage, variance, flip
+
+
+def _hwe_p(dosage):
+    """HWE exact test mid p-values using the hard calls (rounded dosage)."""
+    calls = np.rint(dosage)
+    return hwe_exact_midp(np.sum(calls == 0, axis=1),
+                          np.sum(calls == 1, axis=1),
+                          np.sum(calls == 2, axis=1))
+
+
+def _is_index_valid(index_filename, filename):
+    """Check if an index file exists and is more recent than the file."""
+    return (os.path.isfile(index_filename) and
+            os.path.getmtime(index_filename) >= os.path.getmtime(filename))
+
+
+def _bgzf_raw_block(f, coffset):
+    """Read the compressed BGZF block at coffset.
+
+    :returns: The raw deflate data (or None at the end of the file) and the
+              offset of the next block.
+    :rtype: tuple
+
+    """
+    f.seek(coffset)
+    header = f.read(12)
+    if len(header) < 12:
+        return None, None
+
+    if header[:4] != b"\x1f\x8b\x08\x04":
+        raise ValueError("Invalid BGZF block (is the file bgzipped?).")
+
+    extra_length, = struct.unpack_from("<H", header, 10)
+    extra = f.read(extra_length)
+
+    # Find the block size in the extra subfields.
+    block_size = None
+    i = 0
+    while i < extra_length:
+        subfield_length, = struct.unpack_from("<H", extra, i + 2)
+        if extra[i:(i + 2)] == b"BC":
+            block_size, = struct.unpack_from("<H", extra, i + 4)
+        i += 4 + subfield_length
+
+    if block_size is None:
+        raise ValueError("Invalid BGZF block (missing block size).")
+
+    # The data is followed by the CRC32 and the uncompressed size.
+    cdata = f.read(block_size - extra_length - 19)
+    return cdata, coffset + block_size + 1
+
+
+def _bgzf_inflate(cdata):
+    """Decompress the raw deflate data from a BGZF block."""
+    return zlib.decompress(cdata, -15)
+
+
+def _vcf_dosage(lines, field):
+    """Compute the (alternative allele) dosage for a list of VCF records."""
+    k = len(lines)
+    fields = np.array(b"\t".join(lines).rstrip(b"\r").split(b"\t"))
+    if fields.shape[0] % k != 0:
+        raise ValueError("Malformed VCF records (different number of "
+                         "columns).")
+    fields = fields.reshape(k, -1)
+
+    formats = fields[:, 8]
+    samples = fields[:, 9:]
+
+    dosage = np.empty(samples.shape, dtype=float)
+    for fmt in np.unique(formats):
+        mask = formats == fmt
+        keys = fmt.split(b":")
+        if field not in keys:
+            raise ValueError("A VCF record has no '{}' field.".format(
+                field.decode("utf-8")
+            ))
+
+        # Extract the subfield.
+        values = samples[mask, :]
+        for _ in range(keys.index(field)):
+            values = np.char.partition(values, b":")[..., 2]
+        values = np.char.partition(values, b":")[..., 0]
+
+        if field == b"GT":
+            alleles = np.char.partition(
+                np.char.replace(values, b"|", b"/"), b"/"
+            )
+            a1, a2 = alleles[..., 0], alleles[..., 2]
+            missing = ((a1 == b".") | (a2 == b".") |
+                       (a1 == b"") | (a2 == b""))
+            values = (a1 != b"0").astype(float) + (a2 != b"0")
+
+        else:
+            missing = (values == b".") | (values == b"")
+            values = np.where(missing, b"nan", values).astype(float)
+
+        values[missing] = np.nan
+        dosage[mask, :] = values
+
+    return dosage
+
+
+def _bgen_read_identifiers(f):
+    """Read the variant identifying data (layout 2) from a file object."""
+    def _read_string(length_fmt):
+        size = struct.calcsize(length_fmt)
+        length, = struct.unpack(length_fmt, f.read(size))
+        return f.read(length).decode("utf-8")
+
+    varid = _read_string("<H")
+    rsid = _read_string("<H")
+    chrom = _read_string("<H")
+    pos, n_alleles = struct.unpack("<IH", f.read(6))
+    alleles = [_read_string("<I") for _ in range(n_alleles)]
+
+    return varid, rsid, chrom, pos, alleles
+
+
+def _bgen_decompress(block, compression):
+    """Decompress a genotype data block (without the leading length)."""
+    if compression == 0:
+        return block
+
+    # The uncompressed length is stored first.
+    if compression == 1:
+        return zlib.decompress(block[4:])
+
+    return zstandard.ZstdDecompressor().decompress(
+        block[4:], max_output_size=struct.unpack_from("<I", block)[0]
+    )
+
+
+def _bgen_unpack(data, offset, n, n_bits):
+    """Unpack n little-endian integers of n_bits bits starting at offset."""
+    if n_bits in (8, 16, 32):
+        dtype = "<u{}".format(n_bits // 8)
+        return np.frombuffer(data, dtype=dtype, count=n, offset=offset)
+
+    n_bytes = (n * n_bits + 7) // 8
+    bits = np.unpackbits(
+        np.frombuffer(data, dtype=np.uint8, count=n_bytes, offset=offset),
+        bitorder="little"
+    )[:(n * n_bits)].reshape(n, n_bits)
+
+    return bits.dot(2 ** np.arange(n_bits, dtype=np.uint64))
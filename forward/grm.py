@@ -0,0 +1,198 @@
+# This file is part of forward.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial
+# 4.0 International License. To view a copy of this license, visit
+# http://creativecommons.org/licenses/by-nc/4.0/ or send a letter to Creative
+# Commons, PO Box 1866, Mountain View, CA 94042, USA.
+
+"""
+This module provides utilities to compute the genetic relationship matrix
+(GRM) between the samples of a genotype database.
+
+The GRM is computed as :math:`ZZ^T / M` where :math:`Z` is the matrix of
+standardized dosages and :math:`M` the number of (polymorphic) variants. The
+products are accumulated over blocks of variants and written to a
+memory-mapped matrix.
+
+"""
+
+from __future__ import division
+
+import os
+import json
+import logging
+logger = logging.getLogger(__name__)
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from .genotype import VariantSelector
+
+
+__all__ = ["standardize_genotypes", "compute_grm",
+           "GeneticRelationshipMatrix"]
+
+
+def standardize_genotypes(x):
+    """Standardize a block of dosages.
+
+    :param x: A genotype matrix (samples x variants). Missing values are NaN.
+    :type x: np.ndarray
+
+    :returns: A tuple of the standardized matrix (float32) where missing
+              genotypes are set to 0 (the mean) and of the mask of
+              polymorphic variants. Monomorphic variants are set to 0.
+    :rtype: tuple
+
+    The dosage is centered by twice the allele frequency and scaled by
+    :math:`\\sqrt{2p(1-p)}`.
+
+    """
+    x = np.asarray(x, dtype=float)
+    with np.errstate(invalid="ignore"):
+        p = np.nanmean(x, axis=0) / 2
+
+    polymorphic = (p > 0) & (p < 1)
+
+    z = np.zeros(x.shape, dtype=np.float32)
+    p = p[polymorphic]
+    z[:, polymorphic] = (x[:, polymorphic] - 2 * p) / np.sqrt(2 * p * (1 - p))
+    z[np.isnan(x)] = 0
+
+    return z, polymorphic
+
+
+def compute_grm(genotypes, session, path, selector=None, block_size=1000,
+                cpu=1):
+    """Compute the genetic relationship matrix and write it to disk.
+
+    :param genotypes: An initialized genotype database.
+    :type genotypes: :py:class:`forward.genotype.AbstractGenotypeDatabase`
+
+    :param session: A session object to interface with the Variant table.
+    :type session: :py:class:`sqlalchemy.orm.session.Session`
+
+    :param path: The directory for the GRM (created if needed), usually in
+                 the experiment's directory.
+    :type path: str
+
+    :param selector: (optional) A selection of variants (all the variants
+                     are used by default). A MAF threshold or a list of LD
+                     pruned variants (see :py:meth:`forward.ld.LDStore.prune`)
+                     can be used.
+    :type selector: :py:class:`forward.genotype.VariantSelector`
+
+    :param block_size: The number of variants in a block.
+    :type block_size: int
+
+    :param cpu: The number of threads used for the matrix products.
+    :type cpu: int
+
+    :returns: The GRM.
+    :rtype: :py:class:`GeneticRelationshipMatrix`
+
+    Blocks of variants are read sequentially and the products (in single
+    precision) are computed by a pool of workers. The accumulated matrix is
+    a memory-mapped numpy file (``grm.npy``).
+
+    """
+    if selector is None:
+        selector = VariantSelector()
+
+    variants = selector.get_variants(session)
+    samples = genotypes.get_sample_order()
+    n = len(samples)
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    mat = np.lib.format.open_memmap(
+        os.path.join(path, "grm.npy"), mode="w+", dtype=np.float32,
+        shape=(n, n)
+    )
+    mat[:] = 0
+
+    pool = ThreadPool(cpu) if cpu > 1 else None
+
+    n_variants = 0
+    n_blocks = max(1, cpu)
+    step = block_size * n_blocks
+    for i in range(0, len(variants), step):
+        # Read a block for every worker.
+        blocks = [
+            genotypes.get_genotype_block(variants[j:(j + block_size)])
+            for j in range(i, min(i + step, len(variants)), block_size)
+        ]
+
+        if pool is None:
+            products = [_crossproduct(block) for block in blocks]
+        else:
+            products = pool.map(_crossproduct, blocks)
+
+        for product, n_polymorphic in products:
+            mat += product
+            n_variants += int(n_polymorphic)
+
+    if pool is not None:
+        pool.close()
+
+    if n_variants > 0:
+        mat /= n_variants
+
+    mat.flush()
+    del mat
+
+    np.save(os.path.join(path, "samples.npy"), np.array(samples, dtype=str))
+    with open(os.path.join(path, "info.json"), "w") as f:
+        json.dump({"n_variants": n_variants, "n_samples": n}, f)
+
+    logger.info("Computed the GRM of {} samples using {} variants.".format(
+        n, n_variants
+    ))
+
+    return GeneticRelationshipMatrix(path)
+
+
+def _crossproduct(block):
+    z, polymorphic = standardize_genotypes(block)
+    return np.dot(z, z.T), np.sum(polymorphic)
+
+
+class GeneticRelationshipMatrix(object):
+    """Genetic relationship matrix written by :py:func:`compute_grm`.
+
+    :param path: The directory containing the GRM.
+    :type path: str
+
+    The matrix is memory-mapped.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self.samples = list(np.load(os.path.join(path, "samples.npy")))
+        self.matrix = np.load(os.path.join(path, "grm.npy"), mmap_mode="r")
+
+        with open(os.path.join(path, "info.json"), "r") as f:
+            self.info = json.load(f)
+
+        self.n_variants = self.info["n_variants"]
+
+    def __len__(self):
+        return len(self.samples)
+
+    def get_matrix(self, mask=None):
+        """Get the GRM for a subset of the samples.
+
+        :param mask: (optional) A boolean mask (or indices) of the samples to
+                     keep (in the order of the samples of the GRM).
+        :type mask: np.ndarray
+
+        :returns: The GRM (double precision).
+        :rtype: np.ndarray
+
+        """
+        if mask is None:
+            return np.array(self.matrix, dtype=float)
+
+        idx = np.arange(len(self))[mask]
+        return np.array(self.matrix[np.ix_(idx, idx)], dtype=float)
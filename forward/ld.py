@@ -0,0 +1,371 @@
+# This file is part of forward.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial
+# 4.0 International License. To view a copy of this license, visit
+# http://creativecommons.org/licenses/by-nc/4.0/ or send a letter to Creative
+# Commons, PO Box 1866, Mountain View, CA 94042, USA.
+
+"""
+This module provides utilities to compute linkage disequilibrium (LD) from
+the genotype databases.
+
+The correlation between variants is computed for blocks of variants using
+matrix products. LD in windows along the genome is written to a sparse on-disk
+store (:py:class:`LDStore`) that can be memory-mapped by the analyses that need
+it.
+
+"""
+
+from __future__ import division
+
+import os
+import json
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+from .genotype import Variant, VariantSelector
+
+
+__all__ = ["ld_correlation", "compute_ld", "LDStore"]
+
+
+def ld_correlation(x, y=None):
+    """Compute the correlation between the columns of genotype matrices.
+
+    :param x: A genotype matrix (samples x variants). Missing values are NaN.
+    :type x: np.ndarray
+
+    :param y: (optional) A second genotype matrix (samples x variants). If it
+              is not given, the correlation between the columns of x is
+              computed.
+    :type y: np.ndarray
+
+    :returns: The correlation matrix (variants of x x variants of y).
+    :rtype: np.ndarray
+
+    If there are no missing values, the columns are standardized and the
+    correlation is obtained using a single matrix product. Otherwise, the
+    correlation is computed using the pairwise complete observations (the
+    sums required for every pair are also obtained using matrix products).
+    Monomorphic variants have a correlation of NaN.
+
+    """
+    x = np.asarray(x, dtype=float)
+    y = x if y is None else np.asarray(y, dtype=float)
+
+    x_missing = np.isnan(x)
+    y_missing = x_missing if y is x else np.isnan(y)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if not (x_missing.any() or y_missing.any()):
+            n = x.shape[0]
+            x_std = _standardize(x)
+            y_std = x_std if y is x else _standardize(y)
+            r = np.dot(x_std.T, y_std) / n
+
+        else:
+            x_mask = (~x_missing).astype(float)
+            y_mask = x_mask if y is x else (~y_missing).astype(float)
+            x0 = np.where(x_missing, 0, x)
+            y0 = x0 if y is x else np.where(y_missing, 0, y)
+
+            n = np.dot(x_mask.T, y_mask)
+            sum_x = np.dot(x0.T, y_mask)
+            sum_y = np.dot(x_mask.T, y0)
+            sum_xx = np.dot((x0 ** 2).T, y_mask)
+            sum_yy = np.dot(x_mask.T, y0 ** 2)
+            sum_xy = np.dot(x0.T, y0)
+
+            cov = sum_xy - sum_x * sum_y / n
+            var_x = sum_xx - sum_x ** 2 / n
+            var_y = sum_yy - sum_y ** 2 / n
+            r = cov / np.sqrt(var_x * var_y)
+
+    return np.clip(r, -1, 1)
+
+
+def _standardize(x):
+    return (x - x.mean(axis=0)) / x.std(axis=0)
+
+
+def compute_ld(genotypes, session, path, window_kb=None,
+               window_variants=None, min_r2=0, block_size=1000,
+               selector=None):
+    """Compute LD between neighbouring variants and write an LD store.
+
+    :param genotypes: An initialized genotype database.
+    :type genotypes: :py:class:`forward.genotype.AbstractGenotypeDatabase`
+
+    :param session: A session object to interface with the Variant table.
+    :type session: :py:class:`sqlalchemy.orm.session.Session`
+
+    :param path: The directory for the LD store (created if needed).
+    :type path: str
+
+    :param window_kb: (optional) The maximum distance between variants (in
+                      kb).
+    :type window_kb: float
+
+    :param window_variants: (optional) The maximum number of variants between
+                            two variants (`e.g.` 1 for adjacent variants).
+    :type window_variants: int
+
+    :param min_r2: Only pairs with a r2 greater or equal to this threshold
+                   are stored.
+    :type min_r2: float
+
+    :param block_size: The number of variants in a block of rows.
+    :type block_size: int
+
+    :param selector: (optional) A selection of variants (all the variants
+                     are used by default).
+    :type selector: :py:class:`forward.genotype.VariantSelector`
+
+    :returns: The LD store.
+    :rtype: :py:class:`LDStore`
+
+    At least one of the windows needs to be given. If both are given, pairs
+    need to be in both windows. Variants are processed by chromosome and
+    position. For every block of rows, the genotypes of the variants up to
+    the end of the window are read (reusing the variants from the previous
+    block) and the correlations are computed with a single matrix product.
+
+    """
+    if window_kb is None and window_variants is None:
+        raise ValueError("A window (in kb or in number of variants) is "
+                         "required to compute LD.")
+
+    if selector is None:
+        selector = VariantSelector()
+
+    variants = selector.query(session, [Variant.name, Variant.chrom,
+                                        Variant.pos])
+    variants = pd.DataFrame(variants, columns=["name", "chrom", "pos"])
+
+    # The rows of the store (and the windows) need the variants sorted by
+    # chromosome and position, so that every chromosome is a contiguous
+    # range of rows.
+    variants = variants.sort_values(
+        ["chrom", "pos"], kind="mergesort"
+    ).reset_index(drop=True)
+
+    writer = _LDStoreWriter(path, variants)
+
+    offset = 0
+    for chrom, group in variants.groupby("chrom", sort=False):
+        _compute_chrom_ld(genotypes, writer, offset, group["name"].values,
+                          group["pos"].values, window_kb, window_variants,
+                          min_r2, block_size)
+        offset += group.shape[0]
+
+    writer.close(window_kb=window_kb, window_variants=window_variants,
+                 min_r2=min_r2)
+
+    return LDStore(path)
+
+
+def _compute_chrom_ld(genotypes, writer, offset, names, positions, window_kb,
+                      window_variants, min_r2, block_size):
+    n = names.shape[0]
+
+    # The genotypes of the variants from loaded_start to loaded_end.
+    loaded = None
+    loaded_start = loaded_end = 0
+
+    for start in range(0, n, block_size):
+        end = min(start + block_size, n)
+
+        # The last variant that can be in the window of the block.
+        window_end = n
+        if window_variants is not None:
+            window_end = min(window_end, end + window_variants)
+        if window_kb is not None:
+            window_end = min(window_end, np.searchsorted(
+                positions, positions[end - 1] + window_kb * 1000, "right"
+            ))
+
+        # Read the genotypes that are missing (and drop the previous ones).
+        if loaded is not None:
+            loaded = loaded[:, (start - loaded_start):]
+            loaded_start = start
+        else:
+            loaded_start = loaded_end = start
+
+        new = genotypes.get_genotype_block(list(names[loaded_end:window_end]))
+        loaded = new if loaded is None else np.hstack((loaded, new))
+        loaded_end = window_end
+
+        r = ld_correlation(loaded[:, :(end - start)], loaded)
+
+        # Keep the pairs in the window (upper triangle).
+        rows = np.arange(start, end)[:, np.newaxis]
+        cols = np.arange(start, window_end)[np.newaxis, :]
+        keep = cols > rows
+        if window_variants is not None:
+            keep &= (cols - rows) <= window_variants
+        if window_kb is not None:
+            keep &= ((positions[cols] - positions[rows]) <=
+                     window_kb * 1000)
+        keep &= ~np.isnan(r)
+        if min_r2 > 0:
+            keep &= r ** 2 >= min_r2
+
+        for i in range(end - start):
+            j = np.where(keep[i, :])[0]
+            writer.add_row(offset + cols[0, j], r[i, j])
+
+
+class _LDStoreWriter(object):
+    """Incremental writer for the LD store (rows are added in order)."""
+    def __init__(self, path, variants):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        np.save(os.path.join(path, "names.npy"),
+                variants["name"].values.astype(str))
+        np.save(os.path.join(path, "chrom.npy"),
+                variants["chrom"].values.astype(str))
+        np.save(os.path.join(path, "pos.npy"),
+                variants["pos"].values.astype(np.int64))
+
+        self.indptr = [0]
+
+        self._indices = open(os.path.join(path, "indices.bin"), "wb")
+        self._data = open(os.path.join(path, "data.bin"), "wb")
+
+    def add_row(self, indices, r):
+        """Add the correlations for the next row (variant)."""
+        np.asarray(indices, dtype=np.int32).tofile(self._indices)
+        np.asarray(r, dtype=np.float32).tofile(self._data)
+        self.indptr.append(self.indptr[-1] + len(indices))
+
+    def close(self, **info):
+        self._indices.close()
+        self._data.close()
+        np.save(os.path.join(self.path, "indptr.npy"),
+                np.array(self.indptr, dtype=np.int64))
+
+        with open(os.path.join(self.path, "info.json"), "w") as f:
+            json.dump(info, f)
+
+
+class LDStore(object):
+    """Sparse on-disk store of LD between variants.
+
+    :param path: The directory containing the store.
+    :type path: str
+
+    The correlation (r) between pairs of variants is stored in the compressed
+    sparse row format (only the upper triangle, ``i < j``). The column indices
+    and the values are memory-mapped.
+
+    """
+    def __init__(self, path):
+        self.path = path
+
+        self.names = np.load(os.path.join(path, "names.npy"))
+        self.chrom = np.load(os.path.join(path, "chrom.npy"))
+        self.pos = np.load(os.path.join(path, "pos.npy"))
+        self.indptr = np.load(os.path.join(path, "indptr.npy"))
+
+        self.indices = _memmap(os.path.join(path, "indices.bin"), np.int32)
+        self.data = _memmap(os.path.join(path, "data.bin"), np.float32)
+
+        with open(os.path.join(path, "info.json"), "r") as f:
+            self.info = json.load(f)
+
+        self._index = pd.Index(self.names)
+
+    def __len__(self):
+        return self.names.shape[0]
+
+    def get_indexer(self, names):
+        """Get the positions of variants in the store."""
+        idx = self._index.get_indexer(names)
+        if np.any(idx == -1):
+            missing = np.asarray(names)[idx == -1]
+            raise ValueError("Variant {} is not in the LD store.".format(
+                missing[0]
+            ))
+        return idx
+
+    def to_csr(self):
+        """Get the (upper triangular) sparse matrix of correlations."""
+        n = len(self)
+        return scipy.sparse.csr_matrix(
+            (self.data, self.indices, self.indptr), shape=(n, n)
+        )
+
+    def get_matrix(self, names=None, r2=False):
+        """Get a dense (symmetric) LD matrix for a set of variants.
+
+        :param names: (optional) The variant names (all the variants are used
+                      by default).
+        :type names: list
+
+        :param r2: Return the squared correlation.
+        :type r2: bool
+
+        Pairs that are not in the store (outside of the window or below the
+        threshold) are set to 0.
+
+        """
+        if names is None:
+            idx = np.arange(len(self))
+        else:
+            idx = self.get_indexer(names)
+
+        # The position of every variant of the store in the matrix.
+        position = np.full(len(self), -1, dtype=np.int64)
+        position[idx] = np.arange(idx.shape[0])
+
+        mat = np.eye(idx.shape[0])
+        for i, row in enumerate(idx):
+            begin, end = self.indptr[row], self.indptr[row + 1]
+            cols = position[self.indices[begin:end]]
+            keep = cols != -1
+            values = self.data[begin:end][keep]
+            mat[i, cols[keep]] = values
+            mat[cols[keep], i] = values
+
+        if r2:
+            mat = mat ** 2
+
+        return mat
+
+    def prune(self, max_r2):
+        """Select variants that are not in LD with each other.
+
+        :param max_r2: The maximal r2 between two selected variants.
+        :type max_r2: float
+
+        :returns: The names of the selected variants.
+        :rtype: list
+
+        Variants are visited in order (chromosome and position). A variant is
+        selected if it was not removed by a previously selected variant, and
+        it removes the following variants with a r2 greater than the
+        threshold. Only the pairs in the store are considered.
+
+        """
+        removed = np.zeros(len(self), dtype=bool)
+        for i in range(len(self)):
+            if removed[i]:
+                continue
+
+            begin, end = self.indptr[i], self.indptr[i + 1]
+            r = self.data[begin:end]
+            removed[self.indices[begin:end][r ** 2 > max_r2]] = True
+
+        return list(self.names[~removed])
+
+
+def _memmap(filename, dtype):
+    if os.path.getsize(filename) == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode="r")
@@ -0,0 +1,196 @@
+# This file is part of forward.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial
+# 4.0 International License. To view a copy of this license, visit
+# http://creativecommons.org/licenses/by-nc/4.0/ or send a letter to Creative
+# Commons, PO Box 1866, Mountain View, CA 94042, USA.
+
+"""
+This module provides the computation of the genotype principal components
+(PCs) using a randomized singular value decomposition.
+
+The standardized genotype matrix is never loaded in memory: every pass of the
+algorithm streams blocks of variants from the genotype database. The PCs can
+then be used as covariates in the analyses.
+
+"""
+
+from __future__ import division
+
+import os
+import json
+import hashlib
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+
+from .genotype import VariantSelector
+from .grm import standardize_genotypes
+
+
+__all__ = ["compute_principal_components", "PrincipalComponents"]
+
+
+def compute_principal_components(genotypes, session, path, n_components=10,
+                                 selector=None, block_size=1000,
+                                 n_oversamples=10, n_iter=4, seed=None):
+    """Compute the top principal components of the genotypes.
+
+    :param genotypes: An initialized genotype database.
+    :type genotypes: :py:class:`forward.genotype.AbstractGenotypeDatabase`
+
+    :param session: A session object to interface with the Variant table.
+    :type session: :py:class:`sqlalchemy.orm.session.Session`
+
+    :param path: The directory where the PCs are cached.
+    :type path: str
+
+    :param n_components: The number of PCs.
+    :type n_components: int
+
+    :param selector: (optional) A selection of variants (all the variants
+                     are used by default).
+    :type selector: :py:class:`forward.genotype.VariantSelector`
+
+    :param block_size: The number of variants in a block.
+    :type block_size: int
+
+    :param n_oversamples: The number of additional random vectors used to
+                          find the range of the matrix.
+    :type n_oversamples: int
+
+    :param n_iter: The number of power iterations.
+    :type n_iter: int
+
+    :param seed: (optional) The seed of the random number generator.
+    :type seed: int
+
+    :returns: The PCs.
+    :rtype: :py:class:`PrincipalComponents`
+
+    If the directory already contains PCs that were computed for the same
+    samples, variants and number of components, they are reused.
+
+    The left singular vectors of the standardized genotype matrix
+    :math:`Z` (samples x variants) are the eigenvectors of :math:`ZZ^T`. The
+    range finder and the power iterations compute products with
+    :math:`ZZ^T = \\sum_b Z_b Z_b^T` by streaming the blocks of variants, so
+    only matrices with one row per sample are kept in memory.
+
+    """
+    if selector is None:
+        selector = VariantSelector()
+
+    variants = selector.get_variants(session)
+    samples = [str(i) for i in genotypes.get_sample_order()]
+
+    info = {
+        "n_components": n_components,
+        "n_variants": len(variants),
+        "variants_md5": hashlib.md5(
+            "\n".join(variants).encode("utf-8")
+        ).hexdigest(),
+        "n_samples": len(samples),
+    }
+
+    cached = PrincipalComponents.load(path)
+    if (cached is not None and cached.info == info and
+            cached.samples == samples):
+        logger.info("Using the cached principal components "
+                    "('{}').".format(path))
+        return cached
+
+    random_state = np.random.RandomState(seed)
+    n_random = min(n_components + n_oversamples, len(samples))
+
+    def _blocks():
+        for i in range(0, len(variants), block_size):
+            block = genotypes.get_genotype_block(variants[i:(i + block_size)])
+            yield standardize_genotypes(block)[0].astype(float)
+
+    # Find the range of Z using random projections of the variants.
+    y = np.zeros((len(samples), n_random))
+    for z in _blocks():
+        y += np.dot(z, random_state.normal(size=(z.shape[1], n_random)))
+
+    q, _ = np.linalg.qr(y)
+
+    # Power iterations (products with ZZ^T).
+    for i in range(n_iter):
+        q, _ = np.linalg.qr(_grm_product(_blocks(), q))
+
+    # Project ZZ^T on the range and use the eigendecomposition of the small
+    # matrix.
+    b = np.zeros((n_random, n_random))
+    for z in _blocks():
+        projection = np.dot(z.T, q)
+        b += np.dot(projection.T, projection)
+
+    eigenvalues, eigenvectors = np.linalg.eigh(b)
+    order = np.argsort(eigenvalues)[::-1][:n_components]
+
+    pcs = np.dot(q, eigenvectors[:, order])
+    eigenvalues = eigenvalues[order]
+
+    if len(variants) > 0:
+        # Scale to the eigenvalues of the GRM.
+        eigenvalues /= len(variants)
+
+    PrincipalComponents.save(path, samples, pcs, eigenvalues, info)
+
+    return PrincipalComponents(path)
+
+
+def _grm_product(blocks, q):
+    product = np.zeros_like(q)
+    for z in blocks:
+        product += np.dot(z, np.dot(z.T, q))
+    return product
+
+
+class PrincipalComponents(object):
+    """Principal components written by
+       :py:func:`compute_principal_components`.
+
+    :param path: The directory containing the PCs.
+    :type path: str
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self.samples = [
+            str(i) for i in np.load(os.path.join(path, "samples.npy"))
+        ]
+        self.pcs = np.load(os.path.join(path, "pcs.npy"))
+        self.eigenvalues = np.load(os.path.join(path, "eigenvalues.npy"))
+
+        with open(os.path.join(path, "info.json"), "r") as f:
+            self.info = json.load(f)
+
+    def __len__(self):
+        return self.pcs.shape[1]
+
+    def get_names(self, prefix="PC"):
+        """Get the names of the PCs (`e.g.` PC1, PC2, ...)."""
+        return ["{}{}".format(prefix, i + 1) for i in range(len(self))]
+
+    @classmethod
+    def load(cls, path):
+        """Load the PCs if they were already computed (or return None)."""
+        if not os.path.isfile(os.path.join(path, "info.json")):
+            return None
+        return cls(path)
+
+    @staticmethod
+    def save(path, samples, pcs, eigenvalues, info):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        np.save(os.path.join(path, "samples.npy"),
+                np.array(samples, dtype=str))
+        np.save(os.path.join(path, "pcs.npy"), pcs)
+        np.save(os.path.join(path, "eigenvalues.npy"), eigenvalues)
+
+        with open(os.path.join(path, "info.json"), "w") as f:
+            json.dump(info, f)
@@ -19,7 +19,7 @@ import pandas as pd
 import numpy as np
 
 from ..statistics.utilities import inverse_normal_transformation
-from ..utils import abstract, dispatch_methods, expand
+from ..utils import abstract, dispatch_methods, expand, SampleIndex
 
 __all__ = ["ExcelPhenotypeDatabase"]
 
@@ -178,6 +178,18 @@ class AbstractPhenotypeDatabase(object):
             raise ValueError("Some of the given samples are not in the "
                              "phenotype database ({}).".format(extra))
 
+    def add_phenotype(self, name, values):
+        """Add a phenotype computed by forward (`e.g.` genotype PCs).
+
+        :param name: The name of the phenotype.
+        :type name: str
+
+        :param values: The values in the current sample order.
+        :type values: numpy.ndarray
+
+        """
+        raise NotImplementedError()
+
     def get_correlation_matrix(self, names):
         """Get a correlation matrix for the specified names.
 
@@ -259,7 +271,9 @@ class PandasPhenotypeDatabase(AbstractPhenotypeDatabase):
             allow_subset
         )
 
-        self.data = self.data.loc[sequence, :]
+        # Realign all the columns at once using an integer gather array.
+        rows = SampleIndex(self.data.index).get_indexer(sequence)
+        self.data = self.data.take(rows)
         self._order_is_set = True
 
     def get_sample_order(self, warn=True):
@@ -307,6 +321,17 @@ class PandasPhenotypeDatabase(AbstractPhenotypeDatabase):
     def get_phenotype_relation_threshold(self):
         return getattr(self, "_exclusion_threshold", None)
 
+    def add_phenotype(self, name, values):
+        if name in self.data.columns:
+            raise ValueError("'{}' is already in the database.".format(name))
+
+        if len(values) != self.data.shape[0]:
+            raise ValueError("Expected {} values for '{}' (got {}).".format(
+                self.data.shape[0], name, len(values)
+            ))
+
+        self.data[name] = values
+
     def get_correlation_matrix(self, names):
         return self.data[names].corr().values
 
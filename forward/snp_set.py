@@ -0,0 +1,174 @@
+# This file is part of forward.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial
+# 4.0 International License. To view a copy of this license, visit
+# http://creativecommons.org/licenses/by-nc/4.0/ or send a letter to Creative
+# Commons, PO Box 1866, Mountain View, CA 94042, USA.
+
+"""
+This module provides an index of SNP sets for the set-based tests.
+
+The (set, variant) pairs are compiled once into a compressed sparse row
+structure: the variants of the i-th set are the columns
+``indices[indptr[i]:indptr[i + 1]]`` of the (ordered) list of analyzed
+variants. The variants of consecutive sets are then gathered using integer
+arrays instead of scanning the SNP set file for every set.
+
+"""
+
+from __future__ import division
+
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+
+__all__ = ["SNPSetIndex"]
+
+
+class SNPSetIndex(object):
+    """Index of the variants of every SNP set.
+
+    :param names: The names of the sets.
+    :type names: np.ndarray
+
+    :param variants: The analyzed variants (the columns of the index).
+    :type variants: np.ndarray
+
+    :param indptr: The boundaries of the sets in ``indices``.
+    :type indptr: np.ndarray
+
+    :param indices: The columns (in ``variants``) of the variants of the sets.
+    :type indices: np.ndarray
+
+    Use :py:meth:`from_frame` to build the index from a parsed SNP set file.
+
+    """
+    def __init__(self, names, variants, indptr, indices):
+        self.names = np.asarray(names)
+        self.variants = np.asarray(variants)
+        self.indptr = np.asarray(indptr, dtype=int)
+        self.indices = np.asarray(indices, dtype=int)
+
+    @classmethod
+    def from_frame(cls, data, variants):
+        """Build the index from a DataFrame with a `variant` and a `set`
+           column.
+
+        :param data: The (variant, set) pairs.
+        :type data: :py:class:`pandas.DataFrame`
+
+        :param variants: The analyzed variants, usually in the order of the
+                         genotype database. Variants of the sets that are not
+                         in this list are ignored.
+        :type variants: list
+
+        :returns: The index. Sets without analyzed variants are dropped.
+        :rtype: :py:class:`SNPSetIndex`
+
+        """
+        variants = pd.Index(variants)
+        sets = pd.Categorical(data["set"])
+        columns = variants.get_indexer(data["variant"])
+
+        found = columns != -1
+        if not np.all(found):
+            logger.info("Ignoring {} variants (from the SNP sets) that are "
+                        "not analyzed.".format(np.sum(~found)))
+
+        codes = sets.codes[found]
+        columns = columns[found]
+
+        # Sort by set and by position of the variants (duplicated pairs are
+        # removed).
+        order = np.lexsort((columns, codes))
+        codes = codes[order]
+        columns = columns[order]
+
+        keep = np.ones(codes.shape[0], dtype=bool)
+        keep[1:] = (np.diff(codes) != 0) | (np.diff(columns) != 0)
+        codes = codes[keep]
+        columns = columns[keep]
+
+        # Only keep the non-empty sets.
+        counts = np.bincount(codes, minlength=len(sets.categories))
+        non_empty = counts > 0
+
+        indptr = np.zeros(np.sum(non_empty) + 1, dtype=int)
+        np.cumsum(counts[non_empty], out=indptr[1:])
+
+        return cls(
+            np.asarray(sets.categories)[non_empty], np.asarray(variants),
+            indptr, columns
+        )
+
+    def __len__(self):
+        return self.names.shape[0]
+
+    @property
+    def sizes(self):
+        """The number of variants in every set."""
+        return np.diff(self.indptr)
+
+    def get_columns(self, i):
+        """Get the columns of the variants of the i-th set."""
+        return self.indices[self.indptr[i]:self.indptr[i + 1]]
+
+    def get_variants(self, i):
+        """Get the names of the variants of the i-th set."""
+        return self.variants[self.get_columns(i)]
+
+    def get_membership(self, start=0, end=None):
+        """Get the membership matrix of consecutive sets.
+
+        :param start: The first set.
+        :type start: int
+
+        :param end: (optional) The last set (excluded).
+        :type end: int
+
+        :returns: The columns of the variants of the sets (sorted) and the
+                  sparse (sets x columns) membership matrix.
+        :rtype: tuple
+
+        """
+        if end is None:
+            end = len(self)
+
+        columns = self.indices[self.indptr[start]:self.indptr[end]]
+        columns, inverse = np.unique(columns, return_inverse=True)
+
+        membership = scipy.sparse.csr_matrix(
+            (np.ones(inverse.shape[0]), inverse,
+             self.indptr[start:(end + 1)] - self.indptr[start]),
+            shape=(end - start, columns.shape[0])
+        )
+
+        return columns, membership
+
+    def get_chunks(self, max_variants):
+        """Split the sets in chunks of consecutive sets with a similar number
+           of variants.
+
+        :param max_variants: The (approximate) number of variants in a chunk.
+                             Sets that are larger than this are in their own
+                             chunk.
+        :type max_variants: int
+
+        :returns: A list of (start, end) tuples of the sets of every chunk.
+        :rtype: list
+
+        """
+        if len(self) == 0:
+            return []
+
+        # The chunk of a set is given by the cumulative number of variants
+        # before it.
+        chunk_ids = self.indptr[:-1] // max_variants
+        boundaries = np.flatnonzero(np.diff(chunk_ids)) + 1
+        boundaries = np.concatenate(([0], boundaries, [len(self)]))
+
+        return list(zip(boundaries[:-1], boundaries[1:]))
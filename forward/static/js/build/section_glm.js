@@ -13,8 +13,9 @@ fwdGLM.resultsProviderFactory = function(task, taskType) {
     throw "A 'taskType' parameter is required.";
   }
 
-  var columns = ["Variant", "Outcome", "p-value *"];
-  var serverColumns = ["variant", "phenotype", "significance", "coefficient"];
+  var columns = ["Variant", "Gene", "Outcome", "p-value *", "q-value"];
+  var serverColumns = ["variant", "gene", "phenotype", "significance",
+                       "q_value", "coefficient"];
 
   if (taskType === "linear") {
     columns.push("\u03B2 (95% CI)");
@@ -32,6 +33,7 @@ fwdGLM.resultsProviderFactory = function(task, taskType) {
   }
 
   var threshold;
+  var qThreshold;
   var isBonferonni;
   var reactRef;
 
@@ -58,6 +60,11 @@ fwdGLM.resultsProviderFactory = function(task, taskType) {
         break;
     }
 
+    // Filter by q-value (precomputed by the experiment).
+    if (qThreshold !== undefined) {
+      requestData["qthresh"] = qThreshold;
+    }
+
     $.ajax({
       url: window.location.pathname + "/tasks/results.json",
       data: $.extend(requestData, {"task": task, "pthresh": threshold}),
@@ -95,11 +102,28 @@ fwdGLM.resultsProviderFactory = function(task, taskType) {
               case "significance":
                 value = forward.formatPValue(value);
                 break;
+              case "q_value":
+                value = (value === null)? "": forward.formatPValue(value);
+                break;
               case "delta_rsquared":
                 value = d3.format(".2e")(value);
                 break;
               case "variant":
                 value = value.name;
+                break;
+              case "gene":
+                // Nearest gene (with the distance if the variant is not in
+                // the gene).
+                if (!value) {
+                  value = "";
+                }
+                else if (value.distance > 0) {
+                  value = value.gene_name + " (" +
+                          d3.format(".3s")(value.distance) + "b)";
+                }
+                else {
+                  value = value.gene_name;
+                }
             }
 
             return value;
@@ -117,6 +141,8 @@ fwdGLM.resultsProviderFactory = function(task, taskType) {
     "provider": provider,
     "setThreshold": function(t) { threshold=t; },
     "getThreshold": function() { return threshold; },
+    "setQThreshold": function(t) { qThreshold=t; },
+    "getQThreshold": function() { return qThreshold; },
     "isBonferonni": function(b) {
       if (b === undefined) {
         return isBonferonni;
@@ -256,6 +282,43 @@ fwdGLM.renderResultsTable = function(nodeId, taskName, modelType) {
     button.innerHTML = "Change threshold";
     description.appendChild(button);
 
+    var qDescription = document.createElement("p");
+    var qThresholdNode = document.createElement("span");
+    qThresholdNode.innerHTML = "none ";
+    qDescription.innerHTML = "<em>q</em>-values &leq; ";
+    qDescription.appendChild(qThresholdNode);
+    node.appendChild(qDescription);
+
+    var qButton = document.createElement("a");
+    qButton.className = "button";
+    qButton.innerHTML = "Change q-value threshold";
+    qDescription.appendChild(qButton);
+
+    $(qButton).click(function() {
+      var thresh = window.prompt(
+        "What should the q-value threshold be (leave empty for none)?",
+        provider.getQThreshold() || ""
+      );
+
+      if (thresh === null) {
+        return;
+      }
+
+      if (thresh == "") {
+        provider.setQThreshold(undefined);
+        provider.provider("update");
+        qThresholdNode.innerHTML = "none ";
+      }
+      else {
+        thresh = parseFloat(thresh);
+        if (thresh) {
+          provider.setQThreshold(thresh);
+          provider.provider("update");
+          qThresholdNode.innerHTML = thresh + " ";
+        }
+      }
+    });
+
     $(button).click(function() {
       var thresh = window.prompt(
         "What should the new threshold be (leave empty for Bonferonni)?",
@@ -17,51 +17,290 @@ alpha is a nominal p-value threshold (e.g. 5%), SNP_eff is the effective
 number of variant when taking LD into account and Phenotype_eff is the
 effective number of tested phenotypes when taking correlation into account.
 
-The effective numbers are derived from principal component analysis. We take
-the number of principal components required to retain a certain fraction of
-the variance (e.g. 99.5%).
+The effective numbers are derived from the eigenvalues of the correlation
+matrix. We take the number of principal components required to retain a
+certain fraction of the variance (e.g. 99.5%). As in the original
+implementation, the variants are analyzed by blocks of consecutive variants
+and the effective numbers are summed over the blocks and the chromosomes.
 
 """
 
+from __future__ import division
+
+import os
 import bisect
 import logging
 logger = logging.getLogger(__name__)
 
 import numpy as np
-import sklearn.decomposition
+import pandas as pd
+
+from ..utils import Parallel
+from ..genotype import Variant, VariantSelector
+from ..ld import ld_correlation
 
 
-def effective_number(x, variance_t=0.995):
+def effective_number(x, variance_t=0.995, method="eigh", seed=None):
     """Given a design matrix, this computes the effective number of variables.
 
     :param x: A genotype matrix with rows representing samples and columns
               representing variables.
     :type x: np.ndarray
 
+    :param variance_t: The fraction of the variance to retain.
+    :type variance_t: float
+
+    :param method: The method used to compute the eigenvalues ("eigh" or
+                   "randomized").
+    :type method: str
+
+    :param seed: (optional) The seed of the random number generator (used by
+                 the "randomized" method).
+    :type seed: int
+
     :returns: A tuple of the real number of variables and the effective number
               retaining the specified amount of variability.
     :rtype: tuple
 
-    In the original (Gao) implementation, the analysis is made by block. Here,
-    we will do it in a single block, but it is conveivable to implement a
-    similar approach if this one becomes too slow on larger datasets.
+    This analyzes all the variables in a single block. Use
+    :py:func:`genotype_effective_number` to analyze the variants of a
+    genotype database by blocks.
 
     """
-
     logger.info("Design matrix has {} variables for {} samples.".format(
         x.shape[1], x.shape[0],
     ))
 
-    # Compute the correlation.
-    corr_mat = np.corrcoef(x)
-
-    # Compute the PCA on this matrix.
-    pca = sklearn.decomposition.PCA()
-    fit = pca.fit(corr_mat)
+    # Compute the correlation between the variables.
+    corr_mat = np.corrcoef(x, rowvar=False)
 
-    variance_sum = np.cumsum(fit.explained_variance_ratio_)
-    n_vars = bisect.bisect_right(variance_sum, variance_t) + 1
+    n_vars = correlation_effective_number(corr_mat, variance_t, method, seed)
 
     logger.info("{} effective variables.".format(n_vars))
 
     return (x.shape[1], n_vars)
+
+
+def correlation_effective_number(corr_mat, variance_t=0.995, method="eigh",
+                                 seed=None):
+    """Compute the effective number of variables from a correlation matrix.
+
+    :param corr_mat: A correlation matrix.
+    :type corr_mat: np.ndarray
+
+    :param variance_t: The fraction of the variance to retain.
+    :type variance_t: float
+
+    :param method: The method used to compute the eigenvalues ("eigh" or
+                   "randomized").
+    :type method: str
+
+    :param seed: (optional) The seed of the random number generator (used by
+                 the "randomized" method).
+    :type seed: int
+
+    :returns: The number of eigenvalues needed to retain the specified
+              fraction of the variance.
+    :rtype: int
+
+    Missing correlations (`e.g.` for monomorphic variants) are set to 0. With
+    the "randomized" method, only the largest eigenvalues are computed (the
+    number of computed eigenvalues is doubled until the fraction of the
+    variance is reached).
+
+    """
+    corr_mat = np.nan_to_num(np.asarray(corr_mat, dtype=float))
+    n = corr_mat.shape[0]
+    if n == 0:
+        return 0
+
+    # The total variance is the trace of the correlation matrix.
+    total = np.trace(corr_mat)
+    if total <= 0:
+        return 0
+
+    if method == "eigh":
+        eigenvalues = np.linalg.eigvalsh(corr_mat)
+
+    elif method == "randomized":
+        random_state = np.random.RandomState(seed)
+        k = min(n, 50)
+        while True:
+            eigenvalues = _randomized_eigenvalues(corr_mat, k, random_state)
+            explained = np.sum(np.clip(eigenvalues, 0, None)) / total
+            if k == n or explained > variance_t:
+                break
+            k = min(n, 2 * k)
+
+    else:
+        raise ValueError("Invalid method '{}' to compute the eigenvalues "
+                         "(use 'eigh' or 'randomized').".format(method))
+
+    eigenvalues = np.sort(np.clip(eigenvalues, 0, None))[::-1]
+    variance_sum = np.cumsum(eigenvalues) / total
+
+    return min(n, bisect.bisect_right(variance_sum, variance_t) + 1)
+
+
+def _randomized_eigenvalues(mat, k, random_state, n_oversamples=10,
+                            n_iter=4):
+    """Approximate the k largest eigenvalues of a symmetric PSD matrix."""
+    n = mat.shape[0]
+    if k + n_oversamples >= n:
+        return np.linalg.eigvalsh(mat)
+
+    omega = random_state.normal(size=(n, k + n_oversamples))
+    q, _ = np.linalg.qr(np.dot(mat, omega))
+    for i in range(n_iter):
+        q, _ = np.linalg.qr(np.dot(mat, q))
+
+    return np.sort(np.linalg.eigvalsh(np.dot(q.T, np.dot(mat, q))))[-k:]
+
+
+def genotype_effective_number(genotypes, session, variance_t=0.995,
+                              block_size=1000, method="eigh", cpu=1,
+                              selector=None, ld_store=None, seed=None):
+    """Compute the effective number of variants of a genotype database.
+
+    :param genotypes: An initialized genotype database.
+    :type genotypes: :py:class:`forward.genotype.AbstractGenotypeDatabase`
+
+    :param session: A session object to interface with the Variant table.
+    :type session: :py:class:`sqlalchemy.orm.session.Session`
+
+    :param variance_t: The fraction of the variance to retain.
+    :type variance_t: float
+
+    :param block_size: The number of consecutive variants in a block.
+    :type block_size: int
+
+    :param method: The method used to compute the eigenvalues ("eigh" or
+                   "randomized").
+    :type method: str
+
+    :param cpu: The number of processes used to analyze the blocks.
+    :type cpu: int
+
+    :param selector: (optional) A selection of variants (all the variants
+                     are used by default).
+    :type selector: :py:class:`forward.genotype.VariantSelector`
+
+    :param ld_store: (optional) A LD store. If it is given, the correlation
+                     matrices are read from the store instead of being
+                     computed from the genotypes.
+    :type ld_store: :py:class:`forward.ld.LDStore`
+
+    :param seed: (optional) The seed of the random number generator (used by
+                 the "randomized" method, every block has its own stream).
+    :type seed: int
+
+    :returns: A DataFrame with the number of variants and the effective
+              number of variants for every chromosome.
+    :rtype: :py:class:`pandas.DataFrame`
+
+    Blocks are made of consecutive variants (by position) on a chromosome and
+    the effective numbers of the blocks are summed. The correlation matrices
+    are computed by the worker processes and at most one block by process is
+    waiting in the queue.
+
+    """
+    if selector is None:
+        selector = VariantSelector()
+
+    variants = selector.query(session, [Variant.name, Variant.chrom])
+
+    parallel = Parallel(cpu, _block_effective_number)
+
+    results = []
+    n_pending = 0
+    for i, (chrom, block) in enumerate(_iter_blocks(variants, block_size)):
+        if n_pending == cpu:
+            results.append(parallel.get_result())
+            n_pending -= 1
+
+        if ld_store is not None:
+            mat = ld_store.get_matrix(block)
+        else:
+            mat = genotypes.get_genotype_block(block)
+
+        block_seed = None if seed is None else [seed, i]
+        parallel.push_work((chrom, mat, ld_store is not None, variance_t,
+                            method, block_seed))
+        n_pending += 1
+
+    parallel.done_pushing()
+
+    while n_pending > 0:
+        results.append(parallel.get_result())
+        n_pending -= 1
+
+    results = pd.DataFrame(results, columns=["chrom", "n", "n_effective"])
+    results = results.groupby("chrom").sum()
+
+    logger.info("{} effective variants (out of {}).".format(
+        results.n_effective.sum(), results.n.sum(),
+    ))
+
+    return results
+
+
+def _iter_blocks(variants, block_size):
+    """Generate blocks of consecutive variants on the same chromosome."""
+    block = []
+    block_chrom = None
+    for name, chrom in variants:
+        if block and (chrom != block_chrom or len(block) == block_size):
+            yield block_chrom, block
+            block = []
+
+        block_chrom = chrom
+        block.append(name)
+
+    if block:
+        yield block_chrom, block
+
+
+def _block_effective_number(chrom, mat, is_correlation, variance_t, method,
+                            seed):
+    """Compute the effective number of a block (genotypes or correlation)."""
+    corr_mat = mat if is_correlation else ld_correlation(mat)
+    return (
+        chrom, corr_mat.shape[0],
+        correlation_effective_number(corr_mat, variance_t, method, seed)
+    )
+
+
+def phenotype_effective_number(experiment_name, variance_t=0.995,
+                               method="eigh", seed=None):
+    """Compute the effective number of phenotypes of an experiment.
+
+    :param experiment_name: The experiment's directory.
+    :type experiment_name: str
+
+    :param variance_t: The fraction of the variance to retain.
+    :type variance_t: float
+
+    :param method: The method used to compute the eigenvalues ("eigh" or
+                   "randomized").
+    :type method: str
+
+    :param seed: (optional) The seed of the random number generator (used by
+                 the "randomized" method).
+    :type seed: int
+
+    :returns: A tuple of the real number of phenotypes and the effective
+              number retaining the specified amount of variability.
+    :rtype: tuple
+
+    This uses the correlation matrix between the outcomes that is serialized
+    when the experiment is initialized.
+
+    """
+    filename = os.path.join(experiment_name, "phen_correlation_matrix.npy")
+    corr_mat = np.load(filename)
+
+    n_vars = correlation_effective_number(corr_mat, variance_t, method, seed)
+
+    logger.info("{} effective phenotypes.".format(n_vars))
+
+    return (corr_mat.shape[0], n_vars)
@@ -0,0 +1,164 @@
+# This file is part of forward.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial
+# 4.0 International License. To view a copy of this license, visit
+# http://creativecommons.org/licenses/by-nc/4.0/ or send a letter to Creative
+# Commons, PO Box 1866, Mountain View, CA 94042, USA.
+
+"""
+This module implements the linear mixed model used for association testing
+with related samples, following:
+
+Lippert, C. et al. (2011), FaST linear mixed models for genome-wide
+association studies. Nat. Methods, 8: 833-835. doi: 10.1038/nmeth.1681
+
+The covariance of the outcome is :math:`\\sigma_g^2 (K + \\delta I)` where
+:math:`K` is the genetic relationship matrix. Using the eigendecomposition
+:math:`K = USU^T`, the rotated data (:math:`U^Ty`, :math:`U^TX`) have a
+diagonal covariance, so the likelihood and the generalized least squares
+estimates for a given :math:`\\delta` are computed in linear time.
+
+The variance ratio :math:`\\delta` is estimated once under the null model (by
+maximum likelihood) and it is kept fixed when testing the variants.
+
+"""
+
+from __future__ import division
+
+import numpy as np
+import scipy.optimize
+import scipy.stats
+
+
+def fit_null_model(s, uy, ux, log_delta_bounds=(-10, 10), n_grid=100):
+    """Estimate the variance ratio under the null model.
+
+    :param s: The eigenvalues of the genetic relationship matrix.
+    :type s: np.ndarray
+
+    :param uy: The rotated outcome (:math:`U^Ty`).
+    :type uy: np.ndarray
+
+    :param ux: The rotated covariates (:math:`U^TX`, including the
+               intercept).
+    :type ux: np.ndarray
+
+    :param log_delta_bounds: The bounds for :math:`\\log \\delta`.
+    :type log_delta_bounds: tuple
+
+    :param n_grid: The number of points in the initial grid search.
+    :type n_grid: int
+
+    :returns: A dict with the variance ratio (delta), the genetic and residual
+              variances, the heritability and the log-likelihood.
+    :rtype: dict
+
+    The log-likelihood is evaluated on a grid of :math:`\\log \\delta` and the
+    best point is refined using Brent's method.
+
+    """
+    def _negative_ll(log_delta):
+        return -_log_likelihood(s, uy, ux, np.exp(log_delta))[0]
+
+    grid = np.linspace(log_delta_bounds[0], log_delta_bounds[1], n_grid)
+    values = np.array([_negative_ll(i) for i in grid])
+    best = np.argmin(values)
+
+    lower = grid[max(best - 1, 0)]
+    upper = grid[min(best + 1, n_grid - 1)]
+    res = scipy.optimize.minimize_scalar(
+        _negative_ll, bounds=(lower, upper), method="bounded"
+    )
+
+    log_delta = res.x if res.fun < values[best] else grid[best]
+    delta = np.exp(log_delta)
+    ll, sigma_g2 = _log_likelihood(s, uy, ux, delta)
+
+    return {
+        "delta": delta,
+        "genetic_variance": sigma_g2,
+        "residual_variance": sigma_g2 * delta,
+        "heritability": 1 / (1 + delta),
+        "log_likelihood": ll,
+    }
+
+
+def _log_likelihood(s, uy, ux, delta):
+    """The (maximum likelihood) log-likelihood for a given delta."""
+    n = uy.shape[0]
+    w = 1 / (s + delta)
+
+    beta = _gls(ux, uy, w)
+    r = uy - np.dot(ux, beta)
+    sigma_g2 = np.sum(w * r ** 2) / n
+
+    ll = -0.5 * (n * np.log(2 * np.pi * sigma_g2) +
+                 np.sum(np.log(s + delta)) + n)
+
+    return ll, sigma_g2
+
+
+def _gls(x, y, w):
+    xw = x * w[:, np.newaxis]
+    return np.linalg.solve(np.dot(xw.T, x), np.dot(xw.T, y))
+
+
+def association_test(s, uy, ux, ug, delta):
+    """Test the association between rotated genotypes and the outcome.
+
+    :param s: The eigenvalues of the genetic relationship matrix.
+    :type s: np.ndarray
+
+    :param uy: The rotated outcome (:math:`U^Ty`).
+    :type uy: np.ndarray
+
+    :param ux: The rotated covariates (:math:`U^TX`, including the
+               intercept).
+    :type ux: np.ndarray
+
+    :param ug: The rotated genotypes (:math:`U^TG`, samples x variants).
+    :type ug: np.ndarray
+
+    :param delta: The variance ratio estimated under the null model.
+    :type delta: float
+
+    :returns: A dict of arrays (one value per variant) with the coefficient,
+              standard error, t statistic, p-value and confidence interval.
+    :rtype: dict
+
+    The covariates are projected out of the genotypes and of the outcome (in
+    the metric of the null covariance) so that all the variants of the block
+    are tested at once.
+
+    """
+    n, p = ux.shape
+    w = 1 / (s + delta)
+
+    # Residuals of y and of the genotypes given the covariates.
+    y_res = uy - np.dot(ux, _gls(ux, uy, w))
+    g_res = ug - np.dot(ux, _gls(ux, ug, w))
+
+    g_w = g_res * w[:, np.newaxis]
+    g_var = np.sum(g_w * g_res, axis=0)
+    g_y = np.dot(g_w.T, y_res)
+    y_var = np.sum(w * y_res ** 2)
+
+    df = n - p - 1
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        beta = g_y / g_var
+        scale = (y_var - beta * g_y) / df
+        se = np.sqrt(scale / g_var)
+        t = beta / se
+
+    p_values = 2 * scipy.stats.t.sf(np.abs(t), df)
+    ci = scipy.stats.t.ppf(0.975, df) * se
+
+    return {
+        "coefficient": beta,
+        "standard_error": se,
+        "test_statistic": t,
+        "significance": p_values,
+        "confidence_interval_min": beta - ci,
+        "confidence_interval_max": beta + ci,
+    }
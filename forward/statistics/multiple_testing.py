@@ -0,0 +1,99 @@
+# This file is part of forward.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial
+# 4.0 International License. To view a copy of this license, visit
+# http://creativecommons.org/licenses/by-nc/4.0/ or send a letter to Creative
+# Commons, PO Box 1866, Mountain View, CA 94042, USA.
+
+"""
+This module implements the false discovery rate (FDR) corrections of a set of
+p-values: the Benjamini-Hochberg adjusted p-values and Storey's q-values.
+
+Both are computed using a single sort of the p-values. Missing p-values (NaN)
+are not counted as tests and have missing adjusted values.
+
+Benjamini, Y. and Hochberg, Y. (1995), Controlling the false discovery rate:
+a practical and powerful approach to multiple testing. J. R. Stat. Soc. B,
+57: 289-300.
+
+Storey, J.D. and Tibshirani, R. (2003), Statistical significance for
+genomewide studies. PNAS, 100: 9440-9445.
+
+"""
+
+from __future__ import division
+
+import numpy as np
+
+
+__all__ = ["bh_adjusted_p_values", "storey_pi0", "q_values"]
+
+
+def bh_adjusted_p_values(p):
+    """Compute the Benjamini-Hochberg adjusted p-values.
+
+    :param p: The p-values.
+    :type p: np.ndarray
+
+    :returns: The adjusted p-values ``min_{j >= i} (m p_(j) / j)`` (capped at
+              1) in the order of the p-values.
+    :rtype: np.ndarray
+
+    """
+    p = np.asarray(p, dtype=float)
+    adjusted = np.full(p.shape, np.nan)
+
+    tested = np.flatnonzero(~np.isnan(p))
+    m = tested.shape[0]
+    if m == 0:
+        return adjusted
+
+    order = tested[np.argsort(p[tested])]
+    ranked = p[order] * m / np.arange(1, m + 1)
+
+    # The cumulative minimum from the largest p-value.
+    ranked = np.minimum.accumulate(ranked[::-1])[::-1]
+    adjusted[order] = np.minimum(ranked, 1)
+
+    return adjusted
+
+
+def storey_pi0(p, lambda_=0.5):
+    """Estimate the proportion of true null hypotheses.
+
+    :param p: The p-values.
+    :type p: np.ndarray
+
+    :param lambda_: The tuning parameter (the p-values larger than lambda are
+                    mostly from true null hypotheses).
+    :type lambda_: float
+
+    :returns: The estimate ``#{p > lambda} / (m (1 - lambda))`` (capped at 1).
+    :rtype: float
+
+    """
+    p = np.asarray(p, dtype=float)
+    p = p[~np.isnan(p)]
+    if p.shape[0] == 0:
+        return 1.0
+
+    pi0 = np.sum(p > lambda_) / (p.shape[0] * (1 - lambda_))
+    return float(min(pi0, 1))
+
+
+def q_values(p, lambda_=0.5):
+    """Compute Storey's q-values.
+
+    :param p: The p-values.
+    :type p: np.ndarray
+
+    :param lambda_: The tuning parameter of the estimation of the proportion
+                    of true null hypotheses (see :py:func:`storey_pi0`).
+    :type lambda_: float
+
+    :returns: The q-values (the Benjamini-Hochberg adjusted p-values scaled
+              by the proportion of true null hypotheses).
+    :rtype: np.ndarray
+
+    """
+    return storey_pi0(p, lambda_) * bh_adjusted_p_values(p)
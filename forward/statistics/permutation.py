@@ -0,0 +1,374 @@
+# This file is part of forward.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial
+# 4.0 International License. To view a copy of this license, visit
+# http://creativecommons.org/licenses/by-nc/4.0/ or send a letter to Creative
+# Commons, PO Box 1866, Mountain View, CA 94042, USA.
+
+"""
+This module implements permutation procedures to control the family-wise
+error rate (FWER) of the linear regression tests.
+
+The residuals of the null model (``y ~ covariates``) are permuted B times,
+by blocks of permutations stored as (samples x permutations) matrices. For a
+block of variants (also residualized on the covariates), the statistics of
+all the variants for a block of permutations are given by a single matrix
+product. Only the maximum statistic of every permutation is kept (the max-T
+procedure of Westfall and Young). The permutations are generated from random
+keys shared by all the outcomes, so that the correlation between the outcomes
+is kept when they have the same samples.
+
+The logistic regression tests use adaptive permutations instead: the
+permutation p-value of every variant is estimated separately, and the
+variants stop being permuted as soon as they are clearly not significant.
+
+"""
+
+from __future__ import division
+
+import numpy as np
+import scipy.special
+import scipy.stats
+
+from .regression import _fit_null
+
+
+__all__ = ["SamplePermutations", "LinearMaxT", "LogisticScorePermutations",
+           "empirical_threshold", "adjusted_p_values"]
+
+
+class SamplePermutations(object):
+    """Random permutations of the samples.
+
+    :param n_samples: The number of samples.
+    :type n_samples: int
+
+    :param n_permutations: The number of permutations (B).
+    :type n_permutations: int
+
+    :param seed: The seed of the permutations.
+    :type seed: int
+
+    :param block_size: The number of permutations generated at once.
+    :type block_size: int
+
+    Every permutation is given by sorting random keys. The keys of a block of
+    permutations are generated from their own random stream (given by the
+    seed and the index of the block), so that only the requested blocks are
+    in memory. The permutations of a subset of the samples (`e.g.` without
+    the missing outcomes) are the samples of the subset in the same order.
+    The permutations of the outcomes with the same samples are the same.
+
+    """
+    def __init__(self, n_samples, n_permutations, seed, block_size=100):
+        self.n_samples = n_samples
+        self.n_permutations = n_permutations
+        self.seed = seed
+        self.block_size = block_size
+
+    def get_orders(self, block):
+        """Get the permutations (of all the samples) of a block.
+
+        :returns: A (samples x permutations) matrix of indices.
+        :rtype: np.ndarray
+
+        """
+        start = block * self.block_size
+        end = min(start + self.block_size, self.n_permutations)
+
+        # The keys are generated by permutation, so that the last (truncated)
+        # block starts with the same permutations.
+        random_state = np.random.RandomState([self.seed, block])
+        keys = random_state.random_sample((end - start, self.n_samples))
+        return np.argsort(keys.T, axis=0)
+
+    def get_permutations(self, keep, start, end):
+        """Get the permutations (of a subset of the samples) start to end.
+
+        :param keep: The samples of the subset (boolean mask).
+        :type keep: np.ndarray
+
+        :returns: A (subset samples x permutations) matrix of indices (in the
+                  subset).
+        :rtype: np.ndarray
+
+        """
+        first = start // self.block_size
+        last = (end - 1) // self.block_size
+        orders = np.hstack([self.get_orders(block)
+                            for block in range(first, last + 1)])
+
+        offset = first * self.block_size
+        orders = orders[:, (start - offset):(end - offset)]
+
+        # The positions of the samples in the subset.
+        positions = np.cumsum(keep) - 1
+
+        kept = keep[orders]
+        orders = orders.T[kept.T].reshape(end - start, np.sum(keep)).T
+        return positions[orders]
+
+
+class LinearMaxT(object):
+    """Maximum linear regression statistics of permuted outcomes.
+
+    :param y: The outcome (missing values are NaN).
+    :type y: np.ndarray
+
+    :param x: The covariates (including the intercept).
+    :type x: np.ndarray
+
+    :param permutations: The permutations of the samples (use the same
+                         permutations for all the outcomes).
+    :type permutations: :py:class:`SamplePermutations`
+
+    The statistics are computed by blocks of permutations (the blocks of
+    :py:class:`SamplePermutations`). Samples with a missing outcome or
+    covariate are excluded. Missing genotypes are replaced by the mean dosage
+    of the variant.
+
+    """
+    def __init__(self, y, x, permutations):
+        self.keep = ~(np.isnan(y) | np.isnan(x).any(axis=1))
+        self.permutations = permutations
+        self.n_permutations = permutations.n_permutations
+        self.block_size = permutations.block_size
+
+        x = x[self.keep]
+        self._q, _ = np.linalg.qr(x)
+
+        y = y[self.keep]
+        self._residuals = y - np.dot(self._q, np.dot(self._q.T, y))
+
+        self.df = x.shape[0] - x.shape[1] - 1
+        self.max_t = np.zeros(self.n_permutations)
+
+    def get_permutations(self, start, end):
+        """Get the permutations (of the analyzed samples) start to end."""
+        return self.permutations.get_permutations(self.keep, start, end)
+
+    def update(self, g):
+        """Update the maximum statistics with a block of variants.
+
+        :param g: The genotypes (samples x variants), for all the samples.
+        :type g: np.ndarray
+
+        """
+        g = g[self.keep]
+        g = np.where(np.isnan(g), np.nanmean(g, axis=0), g)
+        g = g - np.dot(self._q, np.dot(self._q.T, g))
+
+        # Monomorphic variants (or variants collinear with the covariates)
+        # are not tested.
+        g_var = np.sum(g ** 2, axis=0)
+        tested = g_var > 1e-10 * g.shape[0]
+        if not np.any(tested):
+            return
+
+        g = g[:, tested]
+        g_var = g_var[tested, np.newaxis]
+
+        for start in range(0, self.n_permutations, self.block_size):
+            end = min(start + self.block_size, self.n_permutations)
+            y = self._residuals[self.get_permutations(start, end)]
+
+            # The residual sum of squares of the null model (the permuted
+            # residuals are not orthogonal to the covariates).
+            rss = (np.sum(y ** 2, axis=0) -
+                   np.sum(np.dot(self._q.T, y) ** 2, axis=0))
+
+            gy = np.dot(g.T, y)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                t2 = gy ** 2 * self.df / (rss * g_var - gy ** 2)
+
+            np.maximum(self.max_t[start:end],
+                       np.sqrt(np.nanmax(t2, axis=0)),
+                       out=self.max_t[start:end])
+
+    @property
+    def min_p(self):
+        """The minimum p-value of every permutation."""
+        return 2 * scipy.stats.t.sf(self.max_t, self.df)
+
+
+class LogisticScorePermutations(object):
+    """Adaptive permutation p-values of the logistic regression score test.
+
+    :param y: The binary outcome (0 or 1, missing values are NaN).
+    :type y: np.ndarray
+
+    :param x: The covariates (including the intercept).
+    :type x: np.ndarray
+
+    :param seed: The seed of the permutations.
+    :type seed: int
+
+    :param max_permutations: The maximum number of permutations of a variant.
+    :type max_permutations: int
+
+    :param min_permutations: The number of permutations of the first batch
+                             (done for all the variants).
+    :type min_permutations: int
+
+    :param max_exceedances: The number of permuted statistics at least as
+                            large as the observed statistic after which a
+                            variant stops being permuted.
+    :type max_exceedances: int
+
+    :param block_size: The maximum number of permutations computed at once.
+    :type block_size: int
+
+    The null model ``y ~ covariates`` is fitted once and its residuals
+    ``r = y - mu`` are permuted. The score statistic of a variant is
+    ``U = g'r``, where the genotypes are adjusted for the covariates (using
+    the weights of the null model). Its variance does not depend on the
+    permutation, so the permuted statistics are compared using ``|U|``.
+
+    The permutations are done by batches (a single matrix product for all the
+    variants that are still permuted), the size of the batches doubling up
+    to ``block_size``. A variant stops being permuted once it has
+    ``max_exceedances`` exceedances and its p-value is then ``h / n``
+    (Besag and Clifford, 1991). Otherwise, the variant gets all the
+    permutations and its p-value is ``(h + 1) / (n + 1)``.
+
+    Samples with a missing outcome or covariate are excluded. Missing
+    genotypes are replaced by the mean dosage of the variant.
+
+    """
+    def __init__(self, y, x, seed, max_permutations, min_permutations=100,
+                 max_exceedances=10, block_size=1000):
+        self.keep = ~(np.isnan(y) | np.isnan(x).any(axis=1))
+        self.seed = seed
+        self.max_permutations = max_permutations
+        self.min_permutations = min(min_permutations, max_permutations)
+        self.max_exceedances = max_exceedances
+        self.block_size = max(block_size, self.min_permutations)
+
+        y = y[self.keep]
+        self._x = x[self.keep]
+
+        mu = scipy.special.expit(
+            np.dot(self._x, _fit_null(y, self._x, max_iter=25, tol=1e-8))
+        )
+        self._w = mu * (1 - mu)
+        self._residuals = y - mu
+
+        # Projection used to adjust the genotypes for the covariates.
+        x_w = self._x.T * self._w
+        self._projection = np.linalg.solve(np.dot(x_w, self._x), x_w)
+
+    def get_permutations(self, batch, n_permutations):
+        """Get the permutations (of the analyzed samples) of a batch.
+
+        :returns: A (samples x permutations) matrix of indices.
+        :rtype: np.ndarray
+
+        """
+        random_state = np.random.RandomState([self.seed, batch])
+        keys = random_state.random_sample(
+            (self._residuals.shape[0], n_permutations)
+        )
+        return np.argsort(keys, axis=0)
+
+    def p_values(self, g):
+        """Compute the permutation p-values of a block of variants.
+
+        :param g: The genotypes (samples x variants), for all the samples.
+        :type g: np.ndarray
+
+        :returns: The p-values and the number of permutations of every variant
+                  (monomorphic variants, or variants collinear with the
+                  covariates, have a NaN p-value and no permutations).
+        :rtype: tuple
+
+        """
+        g = g[self.keep]
+        g = np.where(np.isnan(g), np.nanmean(g, axis=0), g)
+        g = g - np.dot(self._x, np.dot(self._projection, g))
+
+        n_variants = g.shape[1]
+        exceedances = np.zeros(n_variants, dtype=int)
+        n_permutations = np.zeros(n_variants, dtype=int)
+
+        g_var = np.sum(self._w[:, np.newaxis] * g ** 2, axis=0)
+        tested = g_var > 1e-10 * g.shape[0]
+
+        # The permuted statistics equal to the observed statistic (up to the
+        # rounding errors) are exceedances.
+        observed = np.abs(np.dot(g.T, self._residuals)) * (1 - 1e-10)
+
+        active = tested.copy()
+        batch = 0
+        n_done = 0
+        n_batch = self.min_permutations
+        while n_done < self.max_permutations and np.any(active):
+            n_batch = min(n_batch, self.max_permutations - n_done)
+            r = self._residuals[self.get_permutations(batch, n_batch)]
+
+            u = np.abs(np.dot(g[:, active].T, r))
+            exceedances[active] += np.sum(
+                u >= observed[active, np.newaxis], axis=1
+            )
+            n_permutations[active] += n_batch
+
+            # The variants with enough exceedances are not significant.
+            active &= exceedances < self.max_exceedances
+
+            n_done += n_batch
+            batch += 1
+            n_batch = min(2 * n_batch, self.block_size)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            p = np.where(
+                exceedances >= self.max_exceedances,
+                exceedances / n_permutations,
+                (exceedances + 1) / (n_permutations + 1),
+            )
+        p[~tested] = np.nan
+
+        return p, n_permutations
+
+
+def empirical_threshold(min_p, alpha):
+    """Get the p-value threshold controlling the FWER.
+
+    :param min_p: The minimum p-value of every permutation.
+    :type min_p: np.ndarray
+
+    :param alpha: The family-wise error rate.
+    :type alpha: float
+
+    :returns: The largest threshold such that at most a fraction alpha of the
+              permutations have a p-value smaller or equal to it (0 if there
+              are not enough permutations).
+    :rtype: float
+
+    """
+    min_p = np.sort(min_p)
+    k = int(np.floor(alpha * min_p.shape[0]))
+    if k == 0:
+        return 0.0
+    return float(min_p[k - 1])
+
+
+def adjusted_p_values(p, min_p):
+    """Compute the FWER adjusted p-values (single-step max-T).
+
+    :param p: The (observed) p-values.
+    :type p: np.ndarray
+
+    :param min_p: The minimum p-value of every permutation.
+    :type min_p: np.ndarray
+
+    :returns: The adjusted p-values ``(1 + #{min_p <= p}) / (B + 1)`` (NaN
+              for missing p-values).
+    :rtype: np.ndarray
+
+    """
+    p = np.asarray(p, dtype=float)
+    min_p = np.sort(min_p)
+    count = np.searchsorted(min_p, p, side="right")
+
+    adjusted = (1 + count) / (min_p.shape[0] + 1)
+    adjusted[np.isnan(p)] = np.nan
+    return adjusted
@@ -0,0 +1,200 @@
+# This file is part of forward.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial
+# 4.0 International License. To view a copy of this license, visit
+# http://creativecommons.org/licenses/by-nc/4.0/ or send a letter to Creative
+# Commons, PO Box 1866, Mountain View, CA 94042, USA.
+
+"""
+This module implements batched regression tests: the same outcome and
+covariates are used to test many genetic predictors (the columns of a matrix)
+at once, one model ``y ~ covariates + g_j`` for every column.
+
+The linear regression uses the Frisch-Waugh-Lovell theorem (the covariates
+are projected out of the outcome and of all the predictors). The logistic
+regression fits all the models simultaneously using Newton-Raphson with
+batched linear solves. The results are the same as fitting every model
+separately (`e.g.` using statsmodels).
+
+"""
+
+from __future__ import division
+
+import numpy as np
+import scipy.special
+import scipy.stats
+
+
+def linear_test(y, x, g):
+    """Test the predictors using linear regressions.
+
+    :param y: The outcome.
+    :type y: np.ndarray
+
+    :param x: The covariates (including the intercept).
+    :type x: np.ndarray
+
+    :param g: The predictors (samples x predictors).
+    :type g: np.ndarray
+
+    :returns: A dict of arrays (one value per predictor) with the coefficient,
+              standard error, t statistic, p-value and 95% confidence
+              interval. Predictors that are collinear with the covariates
+              have NaN statistics.
+    :rtype: dict
+
+    """
+    n, p = x.shape
+    q, _ = np.linalg.qr(x)
+
+    y_res = y - np.dot(q, np.dot(q.T, y))
+    g_res = g - np.dot(q, np.dot(q.T, g))
+
+    g_var = np.sum(g_res ** 2, axis=0)
+    g_y = np.dot(g_res.T, y_res)
+
+    df = n - p - 1
+
+    # Predictors without residual variance can't be tested.
+    g_var[g_var <= 1e-10 * np.sum(g ** 2, axis=0)] = np.nan
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        beta = g_y / g_var
+        se = np.sqrt((np.sum(y_res ** 2) - beta * g_y) / df / g_var)
+        t = beta / se
+
+    p_values = 2 * scipy.stats.t.sf(np.abs(t), df)
+    ci = scipy.stats.t.ppf(0.975, df) * se
+
+    return {
+        "coefficient": beta,
+        "standard_error": se,
+        "test_statistic": t,
+        "significance": p_values,
+        "confidence_interval_min": beta - ci,
+        "confidence_interval_max": beta + ci,
+    }
+
+
+def logistic_test(y, x, g, max_iter=25, tol=1e-8):
+    """Test the predictors using logistic regressions (Wald tests).
+
+    :param y: The outcome (0 or 1).
+    :type y: np.ndarray
+
+    :param x: The covariates (including the intercept).
+    :type x: np.ndarray
+
+    :param g: The predictors (samples x predictors).
+    :type g: np.ndarray
+
+    :param max_iter: The maximum number of Newton-Raphson iterations.
+    :type max_iter: int
+
+    :param tol: The convergence criterion (on the change of the
+                coefficients).
+    :type tol: float
+
+    :returns: A dict of arrays (one value per predictor) with the coefficient,
+              standard error, z statistic, p-value and 95% confidence
+              interval. Models that did not converge (`e.g.` because of
+              separation) have NaN statistics.
+    :rtype: dict
+
+    All the models start from the null model (``y ~ covariates``) and are
+    updated together. At every iteration, the (p + 1) x (p + 1) information
+    matrices of all the models are computed using a single ``einsum`` and the
+    Newton steps using a batched solve.
+
+    The Newton steps are not halved. With a (quasi-)complete separation, the
+    coefficient diverges and the model does not converge in ``max_iter``
+    iterations: its statistics are NaN (statsmodels reports a very large
+    coefficient and standard error instead).
+
+    """
+    n, p = x.shape
+    k = g.shape[1]
+
+    # The design matrices share the covariates, the predictor is the last
+    # column.
+    params = np.zeros((k, p + 1))
+    params[:, :p] = _fit_null(y, x, max_iter, tol)
+
+    # Constant predictors can't be tested.
+    active = np.std(g, axis=0) > 0
+    converged = np.zeros(k, dtype=bool)
+    information = np.zeros((k, p + 1, p + 1))
+
+    for i in range(max_iter):
+        idx = np.flatnonzero(active & ~converged)
+        if idx.shape[0] == 0:
+            break
+
+        g_idx = g[:, idx]
+        eta = np.dot(x, params[idx, :p].T) + g_idx * params[idx, p]
+        mu = scipy.special.expit(eta)
+        w = mu * (1 - mu)
+        r = y[:, np.newaxis] - mu
+
+        score = np.empty((idx.shape[0], p + 1))
+        score[:, :p] = np.dot(r.T, x)
+        score[:, p] = np.sum(r * g_idx, axis=0)
+
+        info = np.empty((idx.shape[0], p + 1, p + 1))
+        info[:, :p, :p] = np.einsum("ni,nk,nj->kij", x, w, x)
+        info[:, :p, p] = np.dot((w * g_idx).T, x)
+        info[:, p, :p] = info[:, :p, p]
+        info[:, p, p] = np.sum(w * g_idx ** 2, axis=0)
+
+        try:
+            step = np.linalg.solve(info, score[:, :, np.newaxis])[:, :, 0]
+        except np.linalg.LinAlgError:
+            # Solve the models one at a time to find the singular ones.
+            step = np.full(score.shape, np.nan)
+            for j in range(idx.shape[0]):
+                try:
+                    step[j] = np.linalg.solve(info[j], score[j])
+                except np.linalg.LinAlgError:
+                    pass
+
+        singular = np.isnan(step).any(axis=1)
+        active[idx[singular]] = False
+
+        params[idx] += np.nan_to_num(step)
+        information[idx] = info
+        converged[idx] = np.max(np.abs(step), axis=1) < tol
+
+    tested = active & converged
+
+    beta = np.full(k, np.nan)
+    se = np.full(k, np.nan)
+    if np.any(tested):
+        beta[tested] = params[tested, p]
+        covariance = np.linalg.inv(information[tested])
+        se[tested] = np.sqrt(covariance[:, p, p])
+
+    z = beta / se
+    p_values = 2 * scipy.stats.norm.sf(np.abs(z))
+    ci = scipy.stats.norm.ppf(0.975) * se
+
+    return {
+        "coefficient": beta,
+        "standard_error": se,
+        "test_statistic": z,
+        "significance": p_values,
+        "confidence_interval_min": beta - ci,
+        "confidence_interval_max": beta + ci,
+    }
+
+
+def _fit_null(y, x, max_iter, tol):
+    """Fit the logistic regression of the null model."""
+    beta = np.zeros(x.shape[1])
+    for i in range(max_iter):
+        mu = scipy.special.expit(np.dot(x, beta))
+        w = mu * (1 - mu)
+        step = np.linalg.solve(np.dot(x.T * w, x), np.dot(x.T, y - mu))
+        beta += step
+        if np.max(np.abs(step)) < tol:
+            break
+    return beta
@@ -0,0 +1,503 @@
+# This file is part of forward.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial
+# 4.0 International License. To view a copy of this license, visit
+# http://creativecommons.org/licenses/by-nc/4.0/ or send a letter to Creative
+# Commons, PO Box 1866, Mountain View, CA 94042, USA.
+
+"""
+This module implements the sequence kernel association test (SKAT) and its
+optimal unified version (SKAT-O) using numpy and scipy. It follows the
+implementation of the SKAT R package:
+
+Wu, M. C. et al. (2011), Rare-variant association testing for sequencing data
+with the sequence kernel association test. Am. J. Hum. Genet., 89: 82-93.
+
+Lee, S. et al. (2012), Optimal unified approach for rare-variant association
+testing with application to small-sample case-control whole-exome sequencing
+studies. Am. J. Hum. Genet., 91: 224-237.
+
+The score statistic follows a mixture of chi-squared distributions whose
+weights are the eigenvalues of the (small) kernel of the set of variants. The
+R package uses Davies' method to compute the p-value of the mixture. Here, we
+use Imhof's method (numerical inversion of the characteristic function, which
+gives the same exact distribution) and, as in the R package, fall back to
+Liu's moment matching approximation when the numerical integration fails.
+
+"""
+
+from __future__ import division
+
+import warnings
+
+import numpy as np
+import scipy.stats
+import scipy.sparse
+import scipy.integrate
+
+
+# The grid of rho used by SKAT-O (the "optimal.adj" method of the R package).
+SKAT_O_RHO = (0, 0.01, 0.04, 0.09, 0.16, 0.25, 0.5, 1)
+
+
+def beta_weights(maf, a=1, b=25):
+    """Compute the variant weights using the beta density of the MAF.
+
+    :param maf: The minor allele frequencies.
+    :type maf: np.ndarray
+
+    :param a: The first parameter of the beta distribution.
+    :type a: float
+
+    :param b: The second parameter of the beta distribution.
+    :type b: float
+
+    The default parameters (1, 25) are the default weights of SKAT which
+    upweight rare variants.
+
+    """
+    return scipy.stats.beta.pdf(maf, a, b)
+
+
+def genotype_maf(g):
+    """Compute the minor allele frequency of the columns of a dosage
+       matrix (missing values are ignored).
+
+    Sparse matrices (without missing values) are also supported.
+
+    """
+    if scipy.sparse.issparse(g):
+        freq = np.asarray(g.mean(axis=0)).ravel() / 2
+    else:
+        with np.errstate(invalid="ignore"):
+            freq = np.nanmean(g, axis=0) / 2
+    return np.minimum(freq, 1 - freq)
+
+
+class SKATNullModel(object):
+    """The null model (y ~ covariates) used by SKAT.
+
+    :param y: The outcome.
+    :type y: np.ndarray
+
+    :param x: The covariates (including the intercept).
+    :type x: np.ndarray
+
+    :param outcome_type: Either "C" (continuous) or "D" (dichotomous).
+    :type outcome_type: str
+
+    Continuous outcomes are fitted using least squares and dichotomous
+    outcomes using a logistic regression (Newton-Raphson).
+
+    """
+    def __init__(self, y, x, outcome_type="C"):
+        self.y = np.asarray(y, dtype=float)
+        self.x = np.asarray(x, dtype=float)
+        self.outcome_type = outcome_type
+        n, p = self.x.shape
+
+        if outcome_type == "C":
+            beta = np.linalg.lstsq(self.x, self.y, rcond=None)[0]
+            self.mu = np.dot(self.x, beta)
+            self.residuals = self.y - self.mu
+            self.s2 = np.sum(self.residuals ** 2) / (n - p)
+            self.v = np.ones(n)
+
+        elif outcome_type == "D":
+            self.mu = _fit_logistic(self.y, self.x)
+            self.residuals = self.y - self.mu
+            self.s2 = 1
+            self.v = self.mu * (1 - self.mu)
+
+        else:
+            raise ValueError("Invalid outcome type '{}' (use 'C' or "
+                             "'D').".format(outcome_type))
+
+        # Used to project the covariates out of the genotypes.
+        sqrt_v = np.sqrt(self.v)
+        self._sqrt_v = sqrt_v
+        self._x_v = self.x * sqrt_v[:, np.newaxis]
+        self._xvx_inv = np.linalg.inv(np.dot(self._x_v.T, self._x_v))
+
+    def __len__(self):
+        return self.y.shape[0]
+
+    def kernel(self, z):
+        """Compute :math:`Z^TP_0Z` where :math:`P_0` is the projection matrix
+           of the null model.
+
+        :param z: The (weighted) genotypes. Sparse matrices are supported and
+                  only sparse-dense products are used.
+        :type z: np.ndarray or :py:class:`scipy.sparse.spmatrix`
+
+        :returns: The (variants x variants) kernel.
+        :rtype: np.ndarray
+
+        The kernel is computed as :math:`Z^TVZ - Z^TVX(X^TVX)^{-1}X^TVZ`,
+        so the (samples x variants) projected matrix is never built.
+
+        """
+        if scipy.sparse.issparse(z):
+            z_v = scipy.sparse.diags(self.v).dot(z)
+            zvz = z.T.dot(z_v).toarray()
+            xvz = np.asarray(z_v.T.dot(self.x)).T
+        else:
+            z_v = z * self.v[:, np.newaxis]
+            zvz = np.dot(z.T, z_v)
+            xvz = np.dot(self.x.T, z_v)
+
+        return zvz - np.dot(xvz.T, np.dot(self._xvx_inv, xvz))
+
+    def score(self, z):
+        """Compute the score vector :math:`Z^T(y - \\hat{\\mu})`."""
+        return np.asarray(z.T.dot(self.residuals)).ravel()
+
+    def project(self, z):
+        """Compute :math:`V^{1/2} (I - X(X^TVX)^{-1}X^TV) Z`.
+
+        The cross-product of the projected matrix is :math:`Z^TP_0Z` where
+        :math:`P_0` is the projection matrix of the null model.
+
+        """
+        z_v = z * self._sqrt_v[:, np.newaxis]
+        return z_v - np.dot(self._x_v,
+                            np.dot(self._xvx_inv, np.dot(self._x_v.T, z_v)))
+
+
+def _fit_logistic(y, x, max_iter=100, tol=1e-10):
+    """Fit a logistic regression and return the fitted probabilities."""
+    beta = np.zeros(x.shape[1])
+    for i in range(max_iter):
+        mu = 1 / (1 + np.exp(-np.dot(x, beta)))
+        w = mu * (1 - mu)
+        step = np.linalg.solve(np.dot(x.T * w, x), np.dot(x.T, y - mu))
+        beta += step
+        if np.max(np.abs(step)) < tol:
+            break
+
+    return 1 / (1 + np.exp(-np.dot(x, beta)))
+
+
+def skat(null_model, g, weights=None):
+    """Compute the SKAT statistic and p-value for a set of variants.
+
+    :param null_model: The null model.
+    :type null_model: :py:class:`SKATNullModel`
+
+    :param g: The genotypes (samples x variants, without missing values).
+    :type g: np.ndarray
+
+    :param weights: (optional) The variant weights (beta weights of the MAF
+                    by default).
+    :type weights: np.ndarray
+
+    :returns: The Q statistic and the p-value.
+    :rtype: tuple
+
+    """
+    z = _weighted(g, weights)
+
+    q = np.sum(null_model.score(z) ** 2) / (2 * null_model.s2)
+    lambdas = _eigenvalues(null_model.kernel(z) / 2)
+
+    return q, mixture_chi2_pvalue(q, lambdas)
+
+
+def skat_o(null_model, g, weights=None, rho=SKAT_O_RHO):
+    """Compute the SKAT-O p-value for a set of variants.
+
+    :param null_model: The null model.
+    :type null_model: :py:class:`SKATNullModel`
+
+    :param g: The genotypes (samples x variants, without missing values).
+    :type g: np.ndarray
+
+    :param weights: (optional) The variant weights (beta weights of the MAF
+                    by default).
+    :type weights: np.ndarray
+
+    :param rho: The grid of correlations between the variant effects (0 is
+                SKAT and 1 is the burden test).
+    :type rho: tuple
+
+    :returns: The p-value and the p-values for every rho.
+    :rtype: tuple
+
+    """
+    z = _weighted(g, weights)
+    n_variants = z.shape[1]
+
+    # As in the R package, rho is capped to keep the kernels invertible.
+    rho = np.minimum(np.asarray(rho, dtype=float), 0.999)
+
+    # The statistics for every rho.
+    score = null_model.score(z)
+    q_rho = ((1 - rho) * np.sum(score ** 2) +
+             rho * n_variants ** 2 * np.mean(score) ** 2)
+    q_rho = q_rho / 2 / null_model.s2
+
+    a = null_model.kernel(z) / 2
+
+    lambdas_rho = []
+    for r in rho:
+        corr = (1 - r) * np.eye(n_variants) + r
+        chol = np.linalg.cholesky(corr)
+        lambdas_rho.append(_eigenvalues(np.dot(chol.T, np.dot(a, chol))))
+
+    params = _skat_o_params(a, rho)
+
+    # The p-value for every rho and the quantile of the minimal p-value in
+    # every distribution.
+    p_rho = np.array([
+        mixture_chi2_pvalue(q, lambdas)
+        for q, lambdas in zip(q_rho, lambdas_rho)
+    ])
+    p_min = np.min(p_rho)
+
+    q_min = np.zeros(len(rho))
+    for i, lambdas in enumerate(lambdas_rho):
+        mu_q, sigma_q, df, _ = _liu_params(lambdas, modified=True)
+        quantile = scipy.stats.chi2.isf(p_min, df)
+        q_min[i] = (quantile - df) / np.sqrt(2 * df) * sigma_q + mu_q
+
+    p = _skat_o_integrate(q_min, params, rho, p_min)
+
+    # SKAT-O is between SKAT and the burden test, the R package corrects
+    # the p-value conservatively.
+    multi = 3 if len(rho) >= 3 else 2
+    if p <= 0 or np.any(p_rho <= 0):
+        p = p_min * multi
+
+    return p, p_rho
+
+
+def _skat_o_params(a, rho):
+    """Parameters of the mixture used to integrate the SKAT-O p-value.
+
+    The R package decomposes the projected genotypes :math:`Z_1` (with
+    :math:`A = Z_1^TZ_1`) using their mean :math:`\\bar{z}`. All the
+    quantities only depend on :math:`A`: with :math:`b = A1 / m` and
+    :math:`s = 1^TA1 / m^2`, the kernel of the residual part is
+    :math:`A - bb^T/s`.
+
+    """
+    n_variants = a.shape[0]
+
+    b = np.sum(a, axis=1) / n_variants
+    z_mean_ss = np.sum(b) / n_variants
+    coefficients = b / z_mean_ss
+
+    item1 = np.outer(b, b) / z_mean_ss
+    w = a - item1
+
+    lambdas = _eigenvalues(w)
+    var_remain = np.sum(item1 * w) * 4
+
+    mu_q = np.sum(lambdas)
+    var_q = np.sum(lambdas ** 2) * 2 + var_remain
+
+    tau = (n_variants ** 2 * rho + np.sum(coefficients ** 2) * (1 - rho))
+    tau = tau * z_mean_ss
+
+    return {
+        "mu_q": mu_q,
+        "var_q": var_q,
+        "var_remain": var_remain,
+        "lambdas": lambdas,
+        "tau": tau,
+    }
+
+
+def _skat_o_integrate(q_min, params, rho, p_min, n_nodes=64):
+    """Integrate the SKAT-O p-value over the distribution of the burden
+       component (a chi-squared with 1 df).
+
+    The R package computes one minus the integral of the cumulative
+    distribution function on (0, 40). We integrate the survival function
+    instead (which avoids the cancellation for small p-values) using a
+    Gauss-Legendre rule after the change of variable :math:`x = t^2` (which
+    removes the singularity of the chi-squared density at 0). The mixture
+    p-values for all the nodes are computed at once.
+
+    """
+    lambdas = params["lambdas"]
+    sd = np.sqrt(params["var_q"] - params["var_remain"])
+    sd /= np.sqrt(params["var_q"])
+
+    nodes, node_weights = np.polynomial.legendre.leggauss(n_nodes)
+    upper = np.sqrt(40)
+    t = (nodes + 1) * upper / 2
+    node_weights = node_weights * upper / 2
+    x = t ** 2
+
+    q = np.min(
+        (q_min[:, np.newaxis] - np.outer(params["tau"], x)) /
+        (1 - rho[:, np.newaxis]),
+        axis=0
+    )
+
+    # The survival function is 0 for very large values.
+    sf = np.zeros_like(q)
+    compute = q <= np.sum(lambdas) * 1e4
+    if np.any(compute):
+        q = (q[compute] - params["mu_q"]) * sd + params["mu_q"]
+        sf[compute] = np.minimum(
+            mixture_chi2_pvalue(q, lambdas, epsabs=1e-6), 1
+        )
+
+    # The density of x = t^2 (chi-squared, 1 df) in the scale of t.
+    density = 2 * scipy.stats.norm.pdf(t)
+
+    p = np.sum(node_weights * sf * density) + scipy.stats.chi2.sf(40, 1)
+    return min(p, p_min * len(rho))
+
+
+def _weighted(g, weights):
+    if not scipy.sparse.issparse(g):
+        g = np.asarray(g, dtype=float)
+    if weights is None:
+        weights = beta_weights(genotype_maf(g))
+    if scipy.sparse.issparse(g):
+        return scipy.sparse.csc_matrix(g.dot(scipy.sparse.diags(weights)))
+    return g * weights
+
+
+def _eigenvalues(k):
+    """The positive eigenvalues of a kernel (as filtered by SKAT)."""
+    lambdas = np.linalg.eigvalsh(k)
+    positive = lambdas[lambdas >= 0]
+    if positive.shape[0] == 0:
+        return positive
+    return lambdas[lambdas > np.mean(positive) / 1e5]
+
+
+def mixture_chi2_pvalue(q, lambdas, epsabs=1e-10):
+    """Compute the p-value of a mixture of chi-squared distributions.
+
+    :param q: The observed statistic(s).
+    :type q: float or np.ndarray
+
+    :param lambdas: The weights of the (1 df) chi-squared variables.
+    :type lambdas: np.ndarray
+
+    :param epsabs: The absolute accuracy of the numerical integration.
+    :type epsabs: float
+
+    :returns: :math:`P(\\sum_j \\lambda_j \\chi^2_1 > q)`
+    :rtype: float or np.ndarray
+
+    Imhof's method is used. Liu's approximation is used if there is a single
+    weight, if the integration fails or if the p-value is not in (0, 1].
+
+    """
+    lambdas = np.asarray(lambdas, dtype=float)
+    is_scalar = np.ndim(q) == 0
+    q = np.atleast_1d(np.asarray(q, dtype=float))
+
+    if lambdas.shape[0] == 0:
+        p = np.full(q.shape, np.nan)
+
+    elif lambdas.shape[0] == 1:
+        p = liu_pvalue(q, lambdas)
+
+    else:
+        # The weights are positive, so the p-value is 1 for q <= 0.
+        p = np.ones(q.shape)
+        for i in np.flatnonzero(q > 0):
+            value = q[i]
+            p[i], converged = imhof_pvalue(value, lambdas, epsabs=epsabs)
+            if not converged or p[i] > 1 or p[i] <= 0:
+                p[i] = liu_pvalue(value, lambdas)
+
+    return p[0] if is_scalar else p
+
+
+def imhof_pvalue(q, lambdas, epsabs=1e-10):
+    """Compute the p-value of a mixture of chi-squared using Imhof's method.
+
+    :returns: The p-value and a flag that is False if the integration did
+              not converge.
+    :rtype: tuple
+
+    The oscillating integrand :math:`\\sin(\\theta(u) - qu/2) / u\\rho(u)`
+    is integrated on a small interval near 0 and the (infinite) tail is split
+    in two Fourier integrals (in :math:`\\cos(qu/2)` and :math:`\\sin(qu/2)`)
+    that are computed by QUADPACK's QAWF routine.
+
+    """
+    lambdas = np.asarray(lambdas, dtype=float)
+
+    def _modulus(u):
+        return u * np.exp(0.25 * np.sum(np.log1p((lambdas * u) ** 2)))
+
+    def _theta(u):
+        return 0.5 * np.sum(np.arctan(lambdas * u))
+
+    def _f(u):
+        if u == 0:
+            # The limit of the integrand at 0.
+            return 0.5 * (np.sum(lambdas) - q)
+        return np.sin(_theta(u) - 0.5 * q * u) / _modulus(u)
+
+    def _f_cos(u):
+        return np.sin(_theta(u)) / _modulus(u)
+
+    def _f_sin(u):
+        return np.cos(_theta(u)) / _modulus(u)
+
+    split = 1 / np.max(np.abs(lambdas))
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        results = [
+            scipy.integrate.quad(_f, 0, split, epsabs=epsabs, limit=200,
+                                 full_output=True),
+            scipy.integrate.quad(_f_cos, split, np.inf, weight="cos",
+                                 wvar=q / 2, epsabs=epsabs, full_output=True),
+            scipy.integrate.quad(_f_sin, split, np.inf, weight="sin",
+                                 wvar=q / 2, epsabs=epsabs, full_output=True),
+        ]
+
+    # QUADPACK returns an additional message if the integration failed.
+    converged = all(len(res) == 3 for res in results)
+
+    value = results[0][0] + results[1][0] - results[2][0]
+    return 0.5 + value / np.pi, converged
+
+
+def liu_pvalue(q, lambdas, modified=True):
+    """Compute the p-value of a mixture of chi-squared using Liu's moment
+       matching approximation.
+
+    :param modified: Use the modified version of the SKAT package (the
+                     degrees of freedom are matched to the skewness instead of
+                     the kurtosis).
+    :type modified: bool
+
+    """
+    mu_q, sigma_q, df, delta = _liu_params(lambdas, modified)
+    sigma_x = np.sqrt(2 * df + 4 * delta)
+    mu_x = df + delta
+
+    q_norm = (q - mu_q) / sigma_q * sigma_x + mu_x
+    if delta == 0:
+        return scipy.stats.chi2.sf(q_norm, df)
+    return scipy.stats.ncx2.sf(q_norm, df, delta)
+
+
+def _liu_params(lambdas, modified=True):
+    c = [np.sum(lambdas ** i) for i in range(1, 5)]
+
+    mu_q = c[0]
+    sigma_q = np.sqrt(2 * c[1])
+    s1 = c[2] / c[1] ** 1.5
+    s2 = c[3] / c[1] ** 2
+
+    if s1 ** 2 > s2:
+        a = 1 / (s1 - np.sqrt(s1 ** 2 - s2))
+        delta = s1 * a ** 3 - a ** 2
+        df = a ** 2 - 2 * delta
+    else:
+        delta = 0
+        df = 1 / s1 ** 2 if modified else 1 / s2
+
+    return mu_q, sigma_q, df, delta
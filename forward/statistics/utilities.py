@@ -12,6 +12,8 @@ tasks.
 
 from __future__ import division
 
+import numpy as np
+import scipy.special
 import scipy.stats
 
 def inverse_normal_transformation(x, c=3/8):
@@ -20,3 +22,118 @@ def inverse_normal_transformation(x, c=3/8):
     """
     r = scipy.stats.rankdata(x, "average")
     return scipy.stats.norm.ppf((r - c) / (len(x) - 2 * c + 1))
+
+
+def hwe_exact_midp(n_hom1, n_het, n_hom2, max_cells=int(1e7)):
+    """Exact test for Hardy-Weinberg equilibrium (mid p-value).
+
+    :param n_hom1: The number of homozygotes for the first allele.
+    :type n_hom1: np.ndarray
+
+    :param n_het: The number of heterozygotes.
+    :type n_het: np.ndarray
+
+    :param n_hom2: The number of homozygotes for the second allele.
+    :type n_hom2: np.ndarray
+
+    :param max_cells: The maximum size of the matrix of genotype
+                      configurations that is evaluated at once.
+    :type max_cells: int
+
+    :returns: The mid p-values (one per variant).
+    :rtype: np.ndarray
+
+    The exact test is described by Wigginton, Cutler and Abecasis (2005). The
+    mid p-value is the exact p-value minus half of the probability of the
+    observed configuration (Graffelman and Moreno, 2013).
+
+    Variants are evaluated together as a (variants x heterozygote counts)
+    matrix. They are sorted by minor allele count so that rare variants are
+    evaluated in large batches.
+
+    """
+    n_hom1 = np.atleast_1d(np.asarray(n_hom1, dtype=int))
+    n_het = np.atleast_1d(np.asarray(n_het, dtype=int))
+    n_hom2 = np.atleast_1d(np.asarray(n_hom2, dtype=int))
+
+    n = n_hom1 + n_het + n_hom2
+    n_rare = np.minimum(2 * n_hom1 + n_het, 2 * n_hom2 + n_het)
+
+    p = np.ones(n.shape[0])
+
+    order = np.argsort(n_rare, kind="mergesort")
+    widths = n_rare[order] // 2 + 1
+    start = 0
+    while start < order.shape[0]:
+        # Number of variants so that the matrix has at most max_cells cells.
+        cells = np.arange(1, order.shape[0] - start + 1) * widths[start:]
+        end = start + max(1, np.searchsorted(cells, max_cells, "right"))
+
+        idx = order[start:end]
+        p[idx] = _hwe_midp_batch(n[idx], n_rare[idx], n_het[idx])
+        start = end
+
+    return p
+
+
+def _hwe_midp_batch(n, n_rare, n_het):
+    parity = n_rare % 2
+    k = np.arange(n_rare.max() // 2 + 1)
+
+    # All the possible heterozygote counts given the allele counts.
+    het = parity[:, np.newaxis] + 2 * k
+    valid = het <= n_rare[:, np.newaxis]
+    het = np.where(valid, het, 0)
+    hom_rare = (n_rare[:, np.newaxis] - het) // 2
+    hom_common = n[:, np.newaxis] - het - hom_rare
+
+    # Log probabilities up to a constant (that only depends on the allele
+    # counts).
+    log_p = (het * np.log(2) - scipy.special.gammaln(het + 1) -
+             scipy.special.gammaln(hom_rare + 1) -
+             scipy.special.gammaln(hom_common + 1))
+    log_p[~valid] = -np.inf
+    log_p -= log_p.max(axis=1)[:, np.newaxis]
+
+    probs = np.exp(log_p)
+    probs /= probs.sum(axis=1)[:, np.newaxis]
+
+    observed = probs[np.arange(n.shape[0]), (n_het - parity) // 2]
+    as_extreme = probs <= observed[:, np.newaxis] * (1 + 1e-7)
+
+    p = np.sum(np.where(as_extreme, probs, 0), axis=1) - 0.5 * observed
+    return np.clip(p, 0, 1)
+
+
+def impute_info(dosage, variance):
+    """Compute the IMPUTE info measure of imputation quality.
+
+    :param dosage: The expected allele counts (variants x samples). Missing
+                   values are NaN.
+    :type dosage: np.ndarray
+
+    :param variance: The variance of the genotype distribution of every
+                     sample (`i.e.` E[G^2] - E[G]^2).
+    :type variance: np.ndarray
+
+    :returns: The info measure of every variant.
+    :rtype: np.ndarray
+
+    The info is 1 minus the ratio of the observed variance of the genotype
+    distributions to the expected binomial variance given the allele
+    frequency. It is set to 1 for monomorphic variants (as in IMPUTE2).
+
+    """
+    dosage = np.atleast_2d(dosage)
+    variance = np.atleast_2d(variance)
+
+    n = np.sum(~np.isnan(dosage), axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        theta = np.nansum(dosage, axis=1) / (2 * n)
+        info = 1 - (np.nansum(np.where(np.isnan(dosage), 0, variance), axis=1) /
+                    (2 * n * theta * (1 - theta)))
+
+    info[(theta == 0) | (theta == 1)] = 1
+    info[n == 0] = np.nan
+
+    return info
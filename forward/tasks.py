@@ -10,6 +10,7 @@ This module provides actual implementations of the genetic tests.
 """
 
 import os
+import functools
 import collections
 import logging
 logger = logging.getLogger()
@@ -19,6 +20,8 @@ from sqlalchemy import Column, Float, ForeignKey, Integer
 from six.moves import cPickle as pickle
 import numpy as np
 import pandas as pd
+import scipy.sparse
+import scipy.stats
 
 
 try:  # pragma: no cover
@@ -29,12 +32,18 @@ except ImportError:  # pragma: no cover
 
 
 from .phenotype.variables import DiscreteVariable, ContinuousVariable
-from .genotype import MemoryImpute2Geno
-from .utils import abstract, Parallel, check_rpy2
+from .genotype import MemoryImpute2Geno, Variant, VariantSelector
+from .grm import compute_grm, GeneticRelationshipMatrix
+from .snp_set import SNPSetIndex
+from .annotation import GeneAnnotation
+from .statistics import skat, regression, permutation
+from .statistics.lmm import fit_null_model, association_test
+from .utils import abstract, expand, float_or_none, Parallel, check_rpy2
 from .experiment import ExperimentResult, result_table
 
 
-__all__ = ["LogisticTest", "LinearTest", "SKATTest"]
+__all__ = ["LogisticTest", "LinearTest", "SKATTest", "BurdenTest",
+           "ACATTest", "LinearMixedTest"]
 
 
 @abstract
@@ -49,13 +58,18 @@ class AbstractTask(object):
                        covariates.
     :type covariates: list or str
 
-    :param variants: List of variants. For now, we can't subset at the task
-                     level, so this should either not be passed or be "all".
-    :type variants: str
+    :param variants: (optional) The variants to analyze. Either "all" or a
+                     dict of selection criteria with the ``names``,
+                     ``regions``, ``maf`` and ``completion`` keys (`e.g.`
+                     ``{"regions": ["3:1234-5678"], "maf": [0.01, 0.05]}``).
+                     See :py:class:`forward.genotype.VariantSelector`.
+    :type variants: str or dict
 
     :param correction: The multiple hypothesis testing correction. This will be
                        automatically serialized in the task metadata (if the
-                       parent's method is called).
+                       parent's method is called). The FDR corrections of
+                       the results are computed by the experiment when all
+                       the tasks are done.
     :type correction: str
 
     :param alpha: Significance threshold (default: 0.05). This will be
@@ -124,8 +138,8 @@ class AbstractTask(object):
             self.covariates = [i for i in experiment.variables
                                if i.name in self.covariates]
 
-        if self.variants != "all":
-            raise NotImplementedError()
+        # Compile the variant selection criteria.
+        self.variant_selector = VariantSelector.from_config(self.variants)
 
         # Set meta information for serialization.
         for meta_key in ("outcomes", "covariates", "variants"):
@@ -142,6 +156,16 @@ class AbstractTask(object):
         for meta_key in ("correction", "alpha"):
             self.set_meta(meta_key, getattr(self, meta_key))
 
+    def get_variants(self, experiment):
+        """Get the names of the variants to analyze for this task.
+
+        The variants are sorted by chromosome and position. If selection
+        criteria were given, they are applied using a single query on the
+        variants table.
+
+        """
+        return self.variant_selector.get_variants(experiment.session)
+
     def set_meta(self, key, value):
         """Set meta information about this task.
 
@@ -179,7 +203,31 @@ class InvalidSNPSet(Exception):
 
 
 class SKATTest(AbstractTask):
-    """Binding to SKAT (using rpy2)."""
+    """Binding to SKAT (using rpy2).
+
+    The ``engine`` argument can be set to ``numpy`` to use the
+    implementation from :py:mod:`forward.statistics.skat` instead of the R
+    package.
+
+    Null models are fitted once for every outcome and set of analyzed
+    samples. Sets without missing genotypes reuse the null model of the
+    outcome. If ``impute`` is set, missing genotypes are replaced by the
+    mean dosage so that there is a single null model by outcome.
+
+    Instead of (or in addition to) a SNP set file, gene-based SNP sets can be
+    built from an Ensembl GTF file using the ``gene_annotation`` argument.
+    The variants within a gene (extended by ``gene_flank`` bases on both
+    sides) are in its set. The compiled gene index is saved to
+    ``gene_index`` (see
+    :py:meth:`forward.annotation.GeneAnnotation.from_gtf`).
+    This is also available for the other set-based tasks.
+
+    """
+
+    # Approximate number of variants read from the genotype database at once
+    # (the sets are tested by chunks of this size).
+    block_size = 1000
+
     def __init__(self, *args, **kwargs):
 
         # Task specific arguments.
@@ -194,13 +242,28 @@ class SKATTest(AbstractTask):
                          self.snp_set["set"].nunique())
             logger.info(m)
 
+        _init_gene_sets(self, kwargs)
+
         self.skat_o = kwargs.pop("SKAT-O", False)
         if self.skat_o:
             logger.info("Using the SKAT-O test.")
 
+        self.impute = kwargs.pop("impute", False)
+        if self.impute:
+            logger.info("Missing genotypes will be mean imputed.")
+
+        self.engine = kwargs.pop("engine", "R")
+        if self.engine not in ("R", "numpy"):
+            raise ValueError("Invalid SKAT engine '{}' (use 'R' or "
+                             "'numpy').".format(self.engine))
+
         # Task initalization using the abstract implementation.
         super(SKATTest, self).__init__(*args, **kwargs)
 
+        if self.engine == "numpy":
+            logger.info("Using the numpy implementation of SKAT.")
+            return
+
         # Check installation.
         SKATTest.check_skat()
 
@@ -224,7 +287,8 @@ class SKATTest(AbstractTask):
                 "SKATTest."
             )
 
-    def _parse_snp_set(self, filename):
+    @staticmethod
+    def _parse_snp_set(filename):
         """Parse a SNP set file with a `variant` and a `set` column."""
         data = pd.read_csv(filename, delim_whitespace=True, header=0)
         data.columns = [i.lower() for i in data.columns]
@@ -246,88 +310,202 @@ class SKATTest(AbstractTask):
         logger.info("Running the SKAT analysis.")
 
         # Check if the snp set was correctly initialized.
-        if getattr(self, "snp_set") is None:
+        snp_set = _get_snp_sets(self, experiment)
+        if snp_set is None:
             raise InvalidSNPSet("You need to provide a snp set for SKAT "
-                                "analyses. Use the `snp_set_file` command "
-                                "in the SKATTest definition.")
+                                "analyses. Use the `snp_set_file` or the "
+                                "`gene_annotation` command in the SKATTest "
+                                "definition.")
 
-        set_names = set(self.snp_set["set"].unique())
+        # Index the variants of the sets (only considering the variants
+        # selected for this task).
+        index = SNPSetIndex.from_frame(snp_set,
+                                       self.get_variants(experiment))
+        rows = experiment.genotypes.get_variant_rows(index.variants)
 
         # Check if we have dosage or genotypes.
         is_dosage = isinstance(experiment.genotypes, MemoryImpute2Geno)
 
         # Build the covariate matrix.
+        n = len(experiment.phenotypes.get_sample_order())
         covar_matrix = np.array([
             experiment.phenotypes.get_phenotype_vector(covar)
             for covar in self.covariates
-        ]).T
+        ]).T.reshape(n, len(self.covariates))
         missing_covar = np.isnan(covar_matrix).any(axis=1)
 
+        outcomes = []
         for phenotype in self.outcomes:
             y = experiment.phenotypes.get_phenotype_vector(phenotype)
-            missing_outcome = np.isnan(y)
-
             outcome_type = ("D" if isinstance(phenotype, DiscreteVariable)
                             else "C")
+            outcomes.append(
+                (phenotype.name, y, missing_covar | np.isnan(y), outcome_type)
+            )
 
-            for set_name in set_names:
-                # Get the variants in the current set.
-                variants = self.snp_set.loc[
-                    self.snp_set["set"] == set_name, "variant"
-                ]
+        # The R session can't be shared by the worker processes.
+        cpu = experiment.cpu if self.engine == "numpy" else 1
+        self.parallel = Parallel(cpu, functools.partial(self._work,
+                                                        is_dosage=is_dosage))
+
+        # The null models of the outcomes (using all the samples without
+        # missing outcome or covariate), shared by all the chunks.
+        self._null_models = {}
+        self.n_null_models = 0
+
+        # The sets are split in chunks with a similar number of variants. The
+        # genotypes of a chunk are read at once and every worker tests a
+        # chunk.
+        chunks = index.get_chunks(self.block_size)
+        for i in range(0, len(chunks), cpu):
+            n_pushed = 0
+            for start, end in chunks[i:(i + cpu)]:
+                self.parallel.push_work(self._get_chunk(
+                    experiment, index, rows, start, end, outcomes,
+                    covar_matrix
+                ))
+                n_pushed += 1
+
+            for j in range(n_pushed):
+                for set_name, phenotype, statistic, p in \
+                        self.parallel.get_result():
+                    experiment.add_result(
+                        tested_entity="snp-set",
+                        results_type="GenericResults",
+                        entity_name=set_name,
+                        phenotype=phenotype,
+                        coefficient=None,
+                        test_statistic=statistic,
+                        significance=p,
+                        task_name=task_name,
+                    )
 
-                # x is the genotype matrix
-                x = np.array([
-                    experiment.genotypes.get_genotypes(variant)
-                    for variant
-                    in variants
-                ]).T
-                missing_geno = np.isnan(x).any(axis=1)
+        self.parallel.done_pushing()
 
-                # Handle missing values on the Python side (to be safe).
-                missing = (missing_covar | missing_outcome | missing_geno)
-                not_missing = ~missing
+        logger.info("Tested {} SNP sets using {} null models.".format(
+            len(index), self.n_null_models
+        ))
 
-                # Pass stuff to the R global environment.
-                self.robjects.globalenv["y"] = y[not_missing]
-                self.robjects.globalenv["covar"] = covar_matrix[not_missing, :]
+    def _get_chunk(self, experiment, index, rows, start, end, outcomes,
+                   covar_matrix):
+        """Read the genotypes of a chunk of sets and get the null models.
 
-                # For now, we build a null model for every set because we
-                # might have to exclude extra samples (because of genotype
-                # NAs).
-                null_model = self.skat.SKAT_Null_Model(
-                    self.robjects.Formula("y ~ covar"), out_type=outcome_type
-                )
+        :returns: A tuple of the null models (by id) and of the tests
+                  (set name, outcome, null model id and genotypes).
+        :rtype: tuple
 
-                db_results = {
-                    "tested_entity": "snp-set",
-                    "results_type": "GenericResults",
-                    "entity_name": set_name,
-                    "phenotype": phenotype.name,
-                    "coefficient": None,
-                    "task_name": task_name,
-                }
-
-                if not self.skat_o:
-                    results = self.r.SKAT(
-                        x[not_missing, :], null_model, is_dosage=is_dosage
-                    )
-                    db_results["test_statistic"] = results.rx("Q")[0][0]
+        """
+        # All the variants of the chunk are read at once. If they are all rare
+        # variants in the sparse genotype matrix, the tests use sparse
+        # matrices (with the numpy engine).
+        columns = index.indices[index.indptr[start]:index.indptr[end]]
+        columns, inverse = np.unique(columns, return_inverse=True)
+        names = index.variants[columns]
+        if (self.engine == "numpy" and
+                experiment.genotypes.is_sparse(names).all()):
+            block = experiment.genotypes.get_sparse_block(names)
+        else:
+            block = experiment.genotypes.get_genotype_block(
+                names, rows=None if rows is None else rows[columns],
+            )
+
+        # The null models of the sets with missing genotypes are only shared
+        # by the sets of the chunk (the samples differ between the sets, so
+        # keeping them would grow with the number of chunks).
+        chunk_null_models = {}
+
+        null_models = {}
+        tests = []
+        for i in range(start, end):
+            x = block[:, inverse[(index.indptr[i] - index.indptr[start]):
+                                 (index.indptr[i + 1] - index.indptr[start])]]
+
+            for phenotype, y, missing, outcome_type in outcomes:
+                # Handle missing values on the Python side (to be safe).
+                cache = self._null_models
+                if self.impute:
+                    x_set = _mean_impute(x[~missing, :])
                 else:
-                    results = self.r.SKAT(
-                        x[not_missing, :], null_model, is_dosage=is_dosage,
-                        method="optimal.adj"
+                    missing_genotypes = _missing_genotypes(x) & ~missing
+                    if missing_genotypes.any():
+                        missing = missing | missing_genotypes
+                        cache = chunk_null_models
+                    x_set = x[~missing, :]
+
+                not_missing = ~missing
+
+                key = (phenotype, not_missing.tobytes())
+                if key not in cache:
+                    cache[key] = (
+                        self.n_null_models,
+                        self._null_model(y[not_missing],
+                                         covar_matrix[not_missing, :],
+                                         outcome_type),
                     )
+                    self.n_null_models += 1
 
-                db_results["significance"] = results.rx("p.value")[0][0]
+                model_id, null_model = cache[key]
+                null_models[model_id] = null_model
 
-                experiment.add_result(**db_results)
+                tests.append((index.names[i], phenotype, model_id, x_set))
 
+        return null_models, tests
+
+    def _work(self, null_models, tests, is_dosage):
+        """Test a chunk of sets."""
+        results = []
+        for set_name, phenotype, model_id, x in tests:
+            if self.engine == "R":
+                statistic, p = self._run_r(x, null_models[model_id],
+                                           is_dosage)
+            else:
+                statistic, p = self._run_numpy(x, null_models[model_id])
+
+            results.append((set_name, phenotype, statistic, p))
+
+        return results
+
+    def _null_model(self, y, covar_matrix, outcome_type):
+        """Fit the null model (using the selected engine)."""
+        if self.engine == "numpy":
+            design = np.hstack((np.ones((y.shape[0], 1)), covar_matrix))
+            return skat.SKATNullModel(y, design, outcome_type)
+
+        # Pass stuff to the R global environment.
+        self.robjects.globalenv["y"] = y
+        self.robjects.globalenv["covar"] = covar_matrix
+
+        return self.skat.SKAT_Null_Model(
+            self.robjects.Formula("y ~ covar"), out_type=outcome_type
+        )
+
+    def _run_r(self, x, null_model, is_dosage):
+        """Compute the SKAT statistic and p-value using the R package."""
+        if not self.skat_o:
+            results = self.r.SKAT(x, null_model, is_dosage=is_dosage)
+            statistic = results.rx("Q")[0][0]
+        else:
+            results = self.r.SKAT(
+                x, null_model, is_dosage=is_dosage, method="optimal.adj"
+            )
+            statistic = None
+
+        return statistic, results.rx("p.value")[0][0]
+
+    def _run_numpy(self, x, null_model):
+        """Compute the SKAT statistic and p-value using
+           :py:mod:`forward.statistics.skat`.
+
+        """
+        if not self.skat_o:
+            return skat.skat(null_model, x)
+
+        return None, skat.skat_o(null_model, x)[0]
 
     @staticmethod
     def check_skat():
         """Check if SKAT is installed."""
-        if not check_rpy2:
+        if not check_rpy2():
             raise ImportError("rpy2 is required to run SKAT analyses.")
 
         from rpy2.robjects.packages import importr
@@ -339,12 +517,398 @@ class SKATTest(AbstractTask):
         return True
 
 
+class BurdenTest(AbstractTask):
+    """Burden (collapsing) test of SNP sets.
+
+    :param snp_set_file: The SNP set file (see :py:class:`SKATTest`).
+    :type snp_set_file: str
+
+    :param gene_annotation: (optional) A GTF file used to build gene-based
+                            SNP sets (see :py:class:`SKATTest`).
+    :type gene_annotation: str
+
+    :param gene_flank: The number of bases added on both sides of the genes.
+    :type gene_flank: int
+
+    :param burden: Either "weighted" (the weighted sum of the minor allele
+                   dosages) or "cast" (an indicator of carrying at least one
+                   minor allele).
+    :type burden: str
+
+    :param weights: The parameters of the beta distribution used to weight the
+                    variants using their MAF (default: [1, 25], as SKAT) or
+                    "none" for equal weights.
+    :type weights: list or str
+
+    The burden scores of a chunk of sets are computed at once as the product
+    of the (weighted) genotype matrix and of the sparse set membership
+    matrix. Missing genotypes are replaced by the mean dosage. Continuous
+    outcomes are tested using linear regressions and discrete outcomes using
+    logistic regressions, all the sets of a chunk being tested together (see
+    :py:mod:`forward.statistics.regression`).
+
+    """
+
+    # Approximate number of variants read from the genotype database at once.
+    block_size = 1000
+
+    def __init__(self, *args, **kwargs):
+        self.snp_set = kwargs.pop("snp_set_file", None)
+        if self.snp_set:
+            filename = self.snp_set
+            self.snp_set = SKATTest._parse_snp_set(self.snp_set)
+            logger.info("Using SNP sets from '{}' ({} sets).".format(
+                filename, self.snp_set["set"].nunique()
+            ))
+
+        _init_gene_sets(self, kwargs)
+
+        self.burden = kwargs.pop("burden", "weighted")
+        if self.burden not in ("weighted", "cast"):
+            raise ValueError("Invalid burden '{}' (use 'weighted' or "
+                             "'cast').".format(self.burden))
+
+        self.weights = kwargs.pop("weights", [1, 25])
+        if self.weights != "none" and len(self.weights) != 2:
+            raise ValueError("The weights need to be the two parameters of "
+                             "the beta distribution or 'none'.")
+
+        super(BurdenTest, self).__init__(*args, **kwargs)
+
+    def run_task(self, experiment, task_name, work_dir):
+        """Run the burden tests."""
+        super(BurdenTest, self).run_task(experiment, task_name, work_dir)
+        logger.info("Running the burden tests ({}).".format(self.burden))
+
+        snp_set = _get_snp_sets(self, experiment)
+        if snp_set is None:
+            raise InvalidSNPSet("You need to provide a snp set for burden "
+                                "tests. Use the `snp_set_file` or the "
+                                "`gene_annotation` command in the BurdenTest "
+                                "definition.")
+
+        self.set_meta("burden", self.burden)
+        self.set_meta("weights", self.weights)
+
+        index = SNPSetIndex.from_frame(snp_set,
+                                       self.get_variants(experiment))
+        rows = experiment.genotypes.get_variant_rows(index.variants)
+
+        # Build the covariate matrix (with the intercept).
+        n = len(experiment.phenotypes.get_sample_order())
+        covar_matrix = np.hstack((np.ones((n, 1)), np.array([
+            experiment.phenotypes.get_phenotype_vector(covar)
+            for covar in self.covariates
+        ]).T.reshape(n, len(self.covariates))))
+        missing_covar = np.isnan(covar_matrix).any(axis=1)
+
+        outcomes = []
+        for phenotype in self.outcomes:
+            y = experiment.phenotypes.get_phenotype_vector(phenotype)
+            if isinstance(phenotype, DiscreteVariable):
+                engine = regression.logistic_test
+            else:
+                engine = regression.linear_test
+            outcomes.append(
+                (phenotype.name, y, ~(missing_covar | np.isnan(y)), engine)
+            )
+
+        for start, end in index.get_chunks(self.block_size):
+            scores = self._burden_scores(experiment, index, rows, start, end)
+
+            for phenotype, y, keep, engine in outcomes:
+                results = engine(y[keep], covar_matrix[keep, :],
+                                 scores[keep, :])
+
+                for i in range(end - start):
+                    experiment.add_result(
+                        tested_entity="snp-set",
+                        results_type="GenericResults",
+                        entity_name=index.names[start + i],
+                        phenotype=phenotype,
+                        task_name=task_name,
+                        **{k: float_or_none(v[i])
+                           for k, v in results.items()}
+                    )
+
+        logger.info("Tested {} SNP sets.".format(len(index)))
+
+    def _burden_scores(self, experiment, index, rows, start, end):
+        """Compute the burden scores (samples x sets) of a chunk of sets."""
+        columns, membership = index.get_membership(start, end)
+        names = index.variants[columns]
+
+        if experiment.genotypes.is_sparse(names).all():
+            g = experiment.genotypes.get_sparse_block(names)
+        else:
+            g = experiment.genotypes.get_genotype_block(
+                names, rows=None if rows is None else rows[columns]
+            )
+
+        g = _mean_impute(g)
+
+        if self.weights == "none":
+            weights = np.ones(len(names))
+        else:
+            weights = skat.beta_weights(skat.genotype_maf(g), *self.weights)
+
+        # The weighted sum for every set (using sparse-dense products).
+        weighted = membership.multiply(weights).T
+        if scipy.sparse.issparse(g):
+            scores = g.dot(weighted).toarray()
+        else:
+            scores = np.asarray(weighted.T.dot(g.T)).T
+
+        if self.burden == "cast":
+            scores = (scores > 0).astype(float)
+
+        return scores
+
+
+class ACATTest(AbstractTask):
+    """Aggregated Cauchy association test (ACAT) of SNP sets.
+
+    :param snp_set_file: The SNP set file (see :py:class:`SKATTest`).
+    :type snp_set_file: str
+
+    :param gene_annotation: (optional) A GTF file used to build gene-based
+                            SNP sets (see :py:class:`SKATTest`).
+    :type gene_annotation: str
+
+    :param gene_flank: The number of bases added on both sides of the genes.
+    :type gene_flank: int
+
+    :param tasks: (optional) The names of the tasks (`e.g.`
+                  ``task0_LinearTest``) with the per-variant results to
+                  combine. By default, all the variant results of the
+                  previous tasks are used.
+    :type tasks: list
+
+    :param weights: The parameters of the beta distribution used to weight
+                    the variants (default: [1, 25]) or "none" for equal
+                    weights (the Cauchy combination test).
+    :type weights: list or str
+
+    The p-values of the variants of every set are combined using the Cauchy
+    distribution (Liu, Y. et al. (2019), ACAT: a fast and powerful p value
+    combination method for rare-variant analysis in sequencing studies. Am.
+    J. Hum. Genet., 104: 410-421). As in ACAT-V, the weight of a variant is
+    :math:`Beta(MAF; a, b)^2 MAF (1 - MAF)`. No model is fitted: the results
+    are loaded once and aggregated by (set, outcome) using a group-by.
+
+    """
+    def __init__(self, *args, **kwargs):
+        self.snp_set = kwargs.pop("snp_set_file", None)
+        if self.snp_set:
+            filename = self.snp_set
+            self.snp_set = SKATTest._parse_snp_set(self.snp_set)
+            logger.info("Using SNP sets from '{}' ({} sets).".format(
+                filename, self.snp_set["set"].nunique()
+            ))
+
+        _init_gene_sets(self, kwargs)
+
+        self.source_tasks = kwargs.pop("tasks", None)
+
+        self.weights = kwargs.pop("weights", [1, 25])
+        if self.weights != "none" and len(self.weights) != 2:
+            raise ValueError("The weights need to be the two parameters of "
+                             "the beta distribution or 'none'.")
+
+        super(ACATTest, self).__init__(*args, **kwargs)
+
+    def run_task(self, experiment, task_name, work_dir):
+        """Combine the variant p-values of every set."""
+        super(ACATTest, self).run_task(experiment, task_name, work_dir)
+        logger.info("Running the ACAT analysis.")
+
+        snp_set = _get_snp_sets(self, experiment)
+        if snp_set is None:
+            raise InvalidSNPSet("You need to provide a snp set for ACAT "
+                                "analyses. Use the `snp_set_file` or the "
+                                "`gene_annotation` command in the ACATTest "
+                                "definition.")
+
+        self.set_meta("tasks", self.source_tasks)
+        self.set_meta("weights", self.weights)
+
+        results = self._get_variant_results(experiment)
+
+        # Only consider the variants selected for this task.
+        if self.variants != "all":
+            results = results[
+                results["variant"].isin(self.get_variants(experiment))
+            ]
+
+        data = results.merge(snp_set, on="variant")
+        data = data.dropna(subset=["p"])
+
+        if data.shape[0] == 0:
+            logger.warning("No variant results to combine.")
+            return
+
+        if self.weights == "none":
+            data["w"] = 1.0
+        else:
+            maf = data["maf"].values
+            data["w"] = (skat.beta_weights(maf, *self.weights) ** 2 *
+                         maf * (1 - maf))
+
+        # The Cauchy transformation (using the approximation for small
+        # p-values, as in the ACAT package).
+        p = data["p"].values
+        small = p < 1e-16
+        with np.errstate(divide="ignore"):
+            data["cauchy"] = np.where(small, 1 / (p * np.pi),
+                                      np.tan((0.5 - p) * np.pi))
+        data["cauchy"] *= data["w"]
+        data["is_zero"] = p == 0
+        data["is_one"] = p == 1
+
+        combined = data.groupby(["set", "phenotype"], observed=True).agg({
+            "cauchy": "sum", "w": "sum", "is_zero": "any", "is_one": "any",
+        })
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            statistic = (combined["cauchy"] / combined["w"]).values
+            p = scipy.stats.cauchy.sf(statistic)
+
+            large = statistic > 1e15
+            p[large] = 1 / (statistic[large] * np.pi)
+
+        p[combined["is_zero"].values] = 0
+        p[combined["is_one"].values] = 1
+
+        for (set_name, phenotype), t, p_value in zip(combined.index,
+                                                     statistic, p):
+            experiment.add_result(
+                tested_entity="snp-set",
+                results_type="GenericResults",
+                entity_name=set_name,
+                phenotype=phenotype,
+                task_name=task_name,
+                test_statistic=float_or_none(t),
+                significance=float_or_none(p_value),
+            )
+
+        logger.info("Combined the p-values of {} SNP sets.".format(
+            combined.shape[0]
+        ))
+
+    def _get_variant_results(self, experiment):
+        """Get the variant p-values (and MAF) of the source tasks."""
+        query = experiment.session.query(
+            ExperimentResult.task_name, ExperimentResult.entity_name,
+            ExperimentResult.phenotype, ExperimentResult.significance,
+            Variant.mac, Variant.n_non_missing,
+        ).join(
+            Variant, Variant.name == ExperimentResult.entity_name
+        ).filter(
+            ExperimentResult.tested_entity == "variant"
+        ).filter(
+            ExperimentResult.phenotype.in_([i.name for i in self.outcomes])
+        )
+
+        if self.source_tasks is not None:
+            query = query.filter(
+                ExperimentResult.task_name.in_(self.source_tasks)
+            )
+
+        results = pd.DataFrame(
+            query.all(),
+            columns=["task", "variant", "phenotype", "p", "mac", "n"]
+        )
+
+        # An outcome needs to be tested by a single task.
+        n_tasks = results.groupby("phenotype")["task"].nunique()
+        if (n_tasks > 1).any():
+            raise ValueError(
+                "Outcome '{}' was tested by multiple tasks. Use the 'tasks' "
+                "parameter to select the results.".format(
+                    n_tasks.index[n_tasks > 1][0]
+                )
+            )
+
+        results["p"] = results["p"].astype(float)
+        results["maf"] = results["mac"] / (2 * results["n"])
+
+        return results[["variant", "phenotype", "p", "maf"]]
+
+
+@result_table
+class LogisticTestResults(ExperimentResult):
+    """Table for the permutation p-values of the logistic regression.
+
+    +------------------------+--------------------------------------+---------+
+    | Column                 | Description                          | Type    |
+    +========================+======================================+=========+
+    | pk                     | The primary key, the same as the     | Integer |
+    |                        | results table                        |         |
+    +------------------------+--------------------------------------+---------+
+    | empirical_significance | The adaptive permutation p-value     | Float   |
+    +------------------------+--------------------------------------+---------+
+    | permutations           | The number of permutations of the    | Integer |
+    |                        | variant                              |         |
+    +------------------------+--------------------------------------+---------+
+
+    This table is only used if the task is run with adaptive permutations
+    (the results are generic results otherwise). The permutation columns are
+    null for the variants that could not be permuted.
+
+    """
+    __tablename__ = "logistic_results"
+
+    pk = Column(Integer(), ForeignKey("results.pk"), primary_key=True)
+
+    empirical_significance = Column(Float())
+    permutations = Column(Integer())
+
+    __mapper_args__ = {
+        "polymorphic_identity": "LogisticTest",
+    }
+
+
 class LogisticTest(AbstractTask):
-    """Logistic regression genetic test."""
+    """Logistic regression genetic test.
+
+    :param adaptive_permutations: (optional) The maximum number of
+                                  permutations used to compute the
+                                  empirical p-values (`e.g.` 1000000,
+                                  default: 0, no permutations).
+    :type adaptive_permutations: int
+
+    :param permutation_seed: (optional) The seed of the permutations.
+    :type permutation_seed: int
+
+    If adaptive permutations are used, the empirical p-value of every variant
+    is computed using
+    :py:class:`forward.statistics.permutation.LogisticScorePermutations`.
+    All the variants start with a small number of permutations and only the
+    variants that could still be significant get more permutations (up to
+    ``adaptive_permutations``). The genotypes are read a second time once the
+    regressions are done, and the blocks of variants are permuted (for all
+    the outcomes) by the worker pool.
+
+    """
+
+    # Number of variants read from the genotype database at once.
+    block_size = 1000
+
+    # Maximum number of permutations computed at once (one matrix product by
+    # block of variants).
+    permutation_block_size = 1000
+
     def __init__(self, *args, **kwargs):
         if not STATSMODELS_AVAILABLE:  # pragma: no cover
             raise ImportError("LogisticTest class requires statsmodels. "
                               "Install the package first (and patsy).")
+
+        self.adaptive_permutations = int(
+            kwargs.pop("adaptive_permutations", 0)
+        )
+        self.permutation_seed = kwargs.pop("permutation_seed", None)
+        self._score_permutations = collections.OrderedDict()
+
         super(LogisticTest, self).__init__(*args, **kwargs)
 
     def filter_variables(self):
@@ -353,9 +917,25 @@ class LogisticTest(AbstractTask):
                          isinstance(i, DiscreteVariable)]
 
     def prep_task(self, experiment, *args):
-        self._add_result = experiment.add_result
         logger.info("Running a logistic regression analysis.")
 
+        # Without permutations, the results are generic results.
+        if not self.adaptive_permutations:
+            self._add_result = experiment.add_result
+            return
+
+        logger.info("Using up to {} adaptive permutations to compute the "
+                    "empirical p-values.".format(self.adaptive_permutations))
+        if self.permutation_seed is None:
+            self.permutation_seed = np.random.randint(2 ** 31 - 1)
+
+        def _f(**params):
+            params["results_type"] = "LogisticTest"
+            result = LogisticTestResults(**params)
+            experiment.session.add(result)
+
+        self._add_result = _f
+
     def run_task(self, experiment, task_name, work_dir):
         """Run the logistic regression."""
         super(LogisticTest, self).run_task(experiment, task_name, work_dir)
@@ -364,13 +944,8 @@ class LogisticTest(AbstractTask):
         # Keep only discrete or continuous variables.
         self.filter_variables()
 
-        # Get a database session from the experiment.
-        session = experiment.session
-
         # Get the list of variants to analyze.
-        # No extra filtering for now (TODO).
-        variants = experiment.genotypes.query_variants(session, "name").all()
-        variants = [i[0] for i in variants]  # Keep only the names.
+        variants = self.get_variants(experiment)
 
         self.parallel = Parallel(experiment.cpu, self._work)
 
@@ -398,45 +973,138 @@ class LogisticTest(AbstractTask):
             missing_covar = ~covar_matrix.astype(bool)
             covar_matrix.shape = (n, 1)
 
+        outcomes = []
         for phenotype in self.outcomes:
             y = experiment.phenotypes.get_phenotype_vector(phenotype)
-            missing_outcome = np.isnan(y)
 
             # For GLMs where we want to compare the variance explained by a
             # null model of the covariates without the genetics effect to the
             # genetic model, we can hookup this function.
-            # Note: This is used by the linear test.
+            # Note: This is used by the linear test and by the permutations.
             if hasattr(self, "_compute_null_model"):
                 self._compute_null_model(phenotype.name, y, covar_matrix)
 
-            for variant in variants:
-                # Get the genotype vector.
-                x = experiment.genotypes.get_genotypes(variant)
-                missing_genotypes = np.isnan(x)
+            outcomes.append((phenotype, y, missing_covar | np.isnan(y)))
 
-                x.shape = (x.shape[0], 1)
-                x = np.hstack((x, covar_matrix))
+        # Genotypes are read by blocks of variants and shared by all the
+        # outcomes.
+        for i in range(0, len(variants), self.block_size):
+            block_variants = variants[i:(i + self.block_size)]
+            block = experiment.genotypes.get_genotype_block(block_variants)
 
-                missing = (missing_covar | missing_genotypes | missing_outcome)
+            # Hook for the statistics computed on the whole block.
+            # Note: This is used by the linear test's permutations.
+            if hasattr(self, "_handle_genotype_block"):
+                self._handle_genotype_block(block)
 
-                self.parallel.push_work(
-                    (variant, phenotype, x[~missing, :], y[~missing], 0)
-                )
-                num_tests += 1
+            for j, variant in enumerate(block_variants):
+                x = block[:, j]
+                missing_genotypes = np.isnan(x)
+                x = np.hstack((x[:, np.newaxis], covar_matrix))
+
+                for phenotype, y, missing_outcome in outcomes:
+                    missing = missing_genotypes | missing_outcome
+
+                    self.parallel.push_work(
+                        (variant, phenotype, x[~missing, :], y[~missing], 0)
+                    )
+                    num_tests += 1
 
         self.parallel.done_pushing()
 
         # We can start parsing the results.
+        results = []
         while num_tests > 0:
-            results = self.parallel.get_result()
-            # Process the result.
-            self._add_result(
-                tested_entity="variant",
-                task_name=task_name,
-                **results
+            results.append(self.parallel.get_result())
+            num_tests -= 1
+
+            # The results are added with their empirical p-value, once the
+            # permutations are done.
+            if not self._score_permutations:
+                self._add_result(
+                    tested_entity="variant",
+                    task_name=task_name,
+                    **results.pop()
+                )
+
+        if self._score_permutations:
+            self._add_empirical_p_values(experiment, variants, results)
+            for res in results:
+                self._add_result(
+                    tested_entity="variant",
+                    task_name=task_name,
+                    **res
+                )
+
+    def _compute_null_model(self, phenotype, y, covar_matrix):
+        """Fit the null model used by the adaptive permutations."""
+        if not self.adaptive_permutations:
+            return
+
+        try:
+            self._score_permutations[phenotype] = \
+                permutation.LogisticScorePermutations(
+                    y, covar_matrix, self.permutation_seed,
+                    self.adaptive_permutations,
+                    block_size=self.permutation_block_size,
+                )
+        except np.linalg.LinAlgError:
+            logger.warning("Could not fit the null model of '{}', the "
+                           "permutations will be skipped.".format(phenotype))
+
+    def _add_empirical_p_values(self, experiment, variants, results):
+        """Compute the adaptive permutation p-values of the results."""
+        parallel = Parallel(
+            experiment.cpu,
+            functools.partial(self._permutation_work,
+                              self._score_permutations)
+        )
+
+        # The permutations of a block of variants (for all the outcomes) are
+        # done by a worker. At most one block by worker is in the queue.
+        empirical = {}
+        starts = list(range(0, len(variants), self.block_size))
+        for i in range(0, len(starts), experiment.cpu):
+            n_pushed = 0
+            for start in starts[i:(i + experiment.cpu)]:
+                block_variants = variants[start:(start + self.block_size)]
+                block = experiment.genotypes.get_genotype_block(
+                    block_variants
+                )
+                parallel.push_work((block_variants, block))
+                n_pushed += 1
+
+            for j in range(n_pushed):
+                for phenotype, names, p, n in parallel.get_result():
+                    for variant, variant_p, variant_n in zip(names, p, n):
+                        empirical[(variant, phenotype)] = (
+                            None if np.isnan(variant_p) else float(variant_p),
+                            int(variant_n),
+                        )
+
+        parallel.done_pushing()
+
+        for res in results:
+            p, n = empirical.get(
+                (res["entity_name"], res["phenotype"]), (None, None)
             )
+            res["empirical_significance"] = p
+            res["permutations"] = n
 
-            num_tests -= 1
+    @staticmethod
+    def _permutation_work(score_permutations, variants, block):
+        results = []
+        for phenotype, permutations in score_permutations.items():
+            p, n = permutations.p_values(block)
+            results.append((phenotype, variants, p, n))
+        return results
+
+    def done(self, *args):
+        if self._score_permutations:
+            self.set_meta("adaptive_permutations", self.adaptive_permutations)
+            self.set_meta("permutation_seed", self.permutation_seed)
+
+        super(LogisticTest, self).done(*args)
 
     def handle_sm_results(self, res, genetic_col):
         conf_int = res.conf_int()
@@ -514,13 +1182,46 @@ class LinearTestResults(ExperimentResult):
 
 
 class LinearTest(LogisticTest):
-    """Linear regression genetic test."""
+    """Linear regression genetic test.
+
+    :param permutations: (optional) The number of permutations used to
+                         control the family-wise error rate (default: 0, no
+                         permutations).
+    :type permutations: int
+
+    :param permutation_seed: (optional) The seed of the permutations.
+    :type permutation_seed: int
+
+    If permutations are used, the residuals of the null model of every
+    outcome are permuted and the maximum statistic (over all the variants and
+    outcomes) of every permutation is computed using
+    :py:class:`forward.statistics.permutation.LinearMaxT`. The minimum
+    p-value of every permutation and the empirical p-value threshold (at the
+    task's ``alpha``) are saved in the task's metadata. Missing genotypes are
+    replaced by the mean dosage for the permutations.
+
+    """
+
+    # Number of permutations computed at once (one matrix product by block
+    # of variants).
+    permutation_block_size = 100
+
     def __init__(self, *args, **kwargs):
         if not STATSMODELS_AVAILABLE:  # pragma: no cover
             raise ImportError("LinearTest class requires statsmodels. "
                               "Install the package first (and patsy).")
+
+        self.permutations = int(kwargs.pop("permutations", 0))
+        self._permutations = None
+        self._max_t = collections.OrderedDict()
+
+        # The seed of the permutations is parsed by the logistic test.
         super(LinearTest, self).__init__(*args, **kwargs)
 
+        if self.adaptive_permutations:
+            raise ValueError("Adaptive permutations are only available for "
+                             "the logistic regression test.")
+
         # Check if we need to report the standardized beta.
         self._compute_std_beta = kwargs.get(
             "compute_standardized_beta", True
@@ -531,6 +1232,12 @@ class LinearTest(LogisticTest):
     def prep_task(self, experiment, task_name, work_dir):
         logger.info("Running a linear regression analysis.")
 
+        if self.permutations:
+            logger.info("Using {} permutations to compute the empirical "
+                        "FWER threshold.".format(self.permutations))
+            if self.permutation_seed is None:
+                self.permutation_seed = np.random.randint(2 ** 31 - 1)
+
         def _f(**params):
             result = LinearTestResults(**params)
             experiment.session.add(result)
@@ -549,6 +1256,22 @@ class LinearTest(LogisticTest):
         fit = ols.fit()
         self.null_rsquared[phenotype] = fit.rsquared_adj
 
+        if self.permutations:
+            if self._permutations is None:
+                self._permutations = permutation.SamplePermutations(
+                    y.shape[0], self.permutations, self.permutation_seed,
+                    block_size=self.permutation_block_size,
+                )
+
+            self._max_t[phenotype] = permutation.LinearMaxT(
+                y, covar_matrix, self._permutations
+            )
+
+    def _handle_genotype_block(self, block):
+        """Update the maximum statistics of the permutations."""
+        for max_t in self._max_t.values():
+            max_t.update(block)
+
     def _work(self, variant, phenotype, x, y, genetic_col):
         try:
             ols = sm.OLS(y, x)
@@ -588,4 +1311,288 @@ class LinearTest(LogisticTest):
 
     def done(self, *args):
         self.set_meta("null_model_rsquared", self.null_rsquared)
+
+        if self._max_t:
+            # The minimum p-value of every permutation (over all the
+            # outcomes).
+            min_p = np.min([i.min_p for i in self._max_t.values()], axis=0)
+            threshold = permutation.empirical_threshold(min_p, self.alpha)
+            logger.info("The empirical FWER threshold (alpha={}) is "
+                        "{:.3g}.".format(self.alpha, threshold))
+
+            self.set_meta("permutations", self.permutations)
+            self.set_meta("permutation_seed", self.permutation_seed)
+            self.set_meta("permutation_min_p", [float(i) for i in min_p])
+            self.set_meta("empirical_threshold", threshold)
+
         super(LinearTest, self).done(*args)
+
+
+@result_table
+class LinearMixedTestResults(ExperimentResult):
+    """Table for extra statistical reporting for linear mixed models.
+
+    +-------------------+-------------------------------------------+---------+
+    | Column            | Description                               | Type    |
+    +===================+===========================================+=========+
+    | pk                | The primary key, the same as the          | Integer |
+    |                   | :py:class:`experiment.ExperimentResult`   |         |
+    +-------------------+-------------------------------------------+---------+
+    | heritability      | The fraction of the variance explained by | Float   |
+    |                   | the GRM under the null model              |         |
+    +-------------------+-------------------------------------------+---------+
+    | genetic_variance  | The genetic variance under the null model | Float   |
+    +-------------------+-------------------------------------------+---------+
+    | residual_variance | The residual variance under the null      | Float   |
+    |                   | model                                     |         |
+    +-------------------+-------------------------------------------+---------+
+
+    The variance components are estimated once for every outcome, so they are
+    the same for all the variants.
+
+    """
+    __tablename__ = "lmm_results"
+
+    pk = Column(Integer(), ForeignKey("results.pk"), primary_key=True)
+
+    heritability = Column(Float())
+    genetic_variance = Column(Float())
+    residual_variance = Column(Float())
+
+    __mapper_args__ = {
+        "polymorphic_identity": "LinearMixedTest",
+    }
+
+
+class LinearMixedTest(AbstractTask):
+    """Linear mixed model genetic test (for related samples).
+
+    :param grm: (optional) The directory of a genetic relationship matrix
+                computed by :py:func:`forward.grm.compute_grm`. If it is not
+                given, the GRM is computed in the experiment's directory.
+    :type grm: str
+
+    :param grm_variants: (optional) The variants used to compute the GRM
+                         (same format as the ``variants`` parameter).
+    :type grm_variants: str or dict
+
+    The GRM is eigendecomposed once for every set of samples (outcomes with
+    the same missing values share the decomposition). The outcome, the
+    covariates and the blocks of genotypes are rotated in the eigenbasis, the
+    variance ratio is estimated once under the null model and every variant
+    is then tested in linear time (see :py:mod:`forward.statistics.lmm`).
+
+    Missing genotypes are replaced by the mean dosage of the variant.
+
+    """
+
+    # Number of variants read from the genotype database at once.
+    block_size = 1000
+
+    def __init__(self, *args, **kwargs):
+        self.grm = kwargs.pop("grm", None)
+        self.grm_variants = kwargs.pop("grm_variants", "all")
+        super(LinearMixedTest, self).__init__(*args, **kwargs)
+
+        self.null_models = {}
+
+    def filter_variables(self):
+        # Filter outcomes to remove non continuous variables.
+        self.outcomes = [i for i in self.outcomes if
+                         isinstance(i, ContinuousVariable)]
+
+    def get_grm(self, experiment):
+        """Get the GRM (it is computed if needed)."""
+        if self.grm is not None:
+            grm = GeneticRelationshipMatrix(expand(self.grm))
+
+        else:
+            path = os.path.join(experiment.name, "grm")
+            if os.path.isfile(os.path.join(path, "grm.npy")):
+                grm = GeneticRelationshipMatrix(path)
+            else:
+                logger.info("Computing the genetic relationship matrix.")
+                grm = compute_grm(
+                    experiment.genotypes, experiment.session, path,
+                    selector=VariantSelector.from_config(self.grm_variants),
+                    cpu=getattr(experiment, "cpu", 1)
+                )
+
+        samples = [str(i) for i in experiment.genotypes.get_sample_order()]
+        if grm.samples != samples:
+            raise ValueError("The samples of the GRM ('{}') are not the "
+                             "samples of the genotype container.".format(
+                                 grm.path
+                             ))
+
+        return grm
+
+    def run_task(self, experiment, task_name, work_dir):
+        """Run the linear mixed model analysis."""
+        super(LinearMixedTest, self).run_task(experiment, task_name, work_dir)
+        logger.info("Running a linear mixed model analysis.")
+
+        # Keep only continuous variables.
+        self.filter_variables()
+
+        # Get the list of variants to analyze.
+        variants = self.get_variants(experiment)
+
+        grm = self.get_grm(experiment)
+
+        # Build the covariate matrix (with the intercept).
+        n = len(experiment.genotypes.get_sample_order())
+        covar_matrix = np.ones((n, len(self.covariates) + 1))
+        for i, covar in enumerate(self.covariates):
+            covar_matrix[:, i + 1] = \
+                experiment.phenotypes.get_phenotype_vector(covar)
+        missing_covar = np.isnan(covar_matrix).any(axis=1)
+
+        # Group the outcomes by set of samples.
+        sample_sets = collections.OrderedDict()
+        for phenotype in self.outcomes:
+            y = experiment.phenotypes.get_phenotype_vector(phenotype)
+            keep = ~(missing_covar | np.isnan(y))
+            key = keep.tobytes()
+            if key not in sample_sets:
+                sample_sets[key] = (keep, [])
+            sample_sets[key][1].append((phenotype, y[keep]))
+
+        # Eigendecomposition of the GRM and null models.
+        models = []
+        for keep, outcomes in sample_sets.values():
+            s, u = np.linalg.eigh(grm.get_matrix(keep))
+            s = np.clip(s, 0, None)
+            ux = np.dot(u.T, covar_matrix[keep, :])
+
+            rotated = []
+            for phenotype, y in outcomes:
+                uy = np.dot(u.T, y)
+                null_model = fit_null_model(s, uy, ux)
+                self.null_models[phenotype.name] = null_model
+                rotated.append((phenotype, uy, null_model))
+
+            models.append((keep, u, s, ux, rotated))
+
+        # Genotypes are read by blocks of variants and rotated once for every
+        # set of samples.
+        for i in range(0, len(variants), self.block_size):
+            block_variants = variants[i:(i + self.block_size)]
+            block = experiment.genotypes.get_genotype_block(block_variants)
+
+            for keep, u, s, ux, rotated in models:
+                g = block[keep, :]
+                missing = np.isnan(g)
+                if missing.any():
+                    g = np.where(missing, np.nanmean(g, axis=0), g)
+                ug = np.dot(u.T, g)
+
+                for phenotype, uy, null_model in rotated:
+                    results = association_test(
+                        s, uy, ux, ug, null_model["delta"]
+                    )
+
+                    for j, variant in enumerate(block_variants):
+                        params = {
+                            k: float_or_none(v[j])
+                            for k, v in results.items()
+                        }
+                        params.update({
+                            "tested_entity": "variant",
+                            "results_type": "LinearMixedTest",
+                            "task_name": task_name,
+                            "entity_name": variant,
+                            "phenotype": phenotype.name,
+                            "heritability": null_model["heritability"],
+                            "genetic_variance": null_model["genetic_variance"],
+                            "residual_variance": null_model[
+                                "residual_variance"
+                            ],
+                        })
+                        experiment.session.add(
+                            LinearMixedTestResults(**params)
+                        )
+
+    def done(self, *args):
+        self.set_meta("null_models", self.null_models)
+        super(LinearMixedTest, self).done(*args)
+
+
+def _init_gene_sets(task, kwargs):
+    """Parse the gene annotation arguments of the set-based tasks."""
+    task.gene_flank = kwargs.pop("gene_flank", 0)
+    task.genes = kwargs.pop("gene_annotation", None)
+    gene_index = kwargs.pop("gene_index", None)
+
+    if task.genes:
+        task.genes = GeneAnnotation.from_gtf(task.genes, index=gene_index)
+        logger.info("Using the SNP sets of {} genes (flank of {} "
+                    "bases).".format(len(task.genes), task.gene_flank))
+
+
+def _get_snp_sets(task, experiment):
+    """Get the SNP sets of a set-based task.
+
+    The sets from the SNP set file are combined with the gene-based sets
+    (built by joining the variants table with the gene index).
+
+    """
+    snp_sets = []
+    if task.snp_set is not None:
+        snp_sets.append(task.snp_set)
+
+    if task.genes is not None:
+        variants = pd.DataFrame(
+            experiment.session.query(
+                Variant.name, Variant.chrom, Variant.pos
+            ).all(),
+            columns=["name", "chrom", "pos"]
+        )
+        snp_sets.append(task.genes.get_snp_sets(
+            variants["name"], variants["chrom"], variants["pos"],
+            flank=task.gene_flank
+        ))
+
+    if not snp_sets:
+        return None
+
+    if len(snp_sets) == 1:
+        return snp_sets[0]
+
+    snp_set = pd.concat(snp_sets, ignore_index=True)
+    snp_set["set"] = snp_set["set"].astype(str).astype("category")
+    return snp_set
+
+
+def _missing_genotypes(x):
+    """Get the samples with a missing genotype (dense or sparse matrix)."""
+    if not scipy.sparse.issparse(x):
+        return np.isnan(x).any(axis=1)
+
+    x = scipy.sparse.csc_matrix(x)
+    missing = np.zeros(x.shape[0], dtype=bool)
+    missing[x.indices[np.isnan(x.data)]] = True
+    return missing
+
+
+def _mean_impute(x):
+    """Replace the missing genotypes by the mean dosage of the variants."""
+    if not scipy.sparse.issparse(x):
+        return np.where(np.isnan(x), np.nanmean(x, axis=0), x)
+
+    x = scipy.sparse.csc_matrix(x, copy=True)
+    nan = np.isnan(x.data)
+    if not nan.any():
+        return x
+
+    # The column of every stored value.
+    x_columns = np.repeat(np.arange(x.shape[1]), np.diff(x.indptr))
+
+    sums = np.bincount(x_columns[~nan], weights=x.data[~nan],
+                       minlength=x.shape[1])
+    counts = x.shape[0] - np.bincount(x_columns[nan], minlength=x.shape[1])
+
+    with np.errstate(invalid="ignore"):
+        x.data[nan] = (sums / counts)[x_columns[nan]]
+
+    return x
@@ -22,7 +22,8 @@ import numpy as np
 from . import dummies
 from ..phenotype.variables import (Variable, ContinuousVariable,
                                    DiscreteVariable)
-from ..genotype import Variant, FrozenDatabaseError
+from ..genotype import Variant, VariantSelector, FrozenDatabaseError
+from ..statistics.utilities import hwe_exact_midp
 from ..experiment import Experiment
 
 
@@ -282,6 +283,43 @@ class TestAbstractGenoDB(object):
         self.assertRaises(ValueError, self.db.query_variants, session, ["name",
                           "test"])
 
+    def test_query_region(self):
+        """Test querying variants by genomic region."""
+        self.db.experiment_init(self.experiment)
+        query = self.experiment.session.query
+        for var in query(Variant):
+            names = self.db.query_region(var.chrom, var.pos, var.pos)
+            self.assertTrue(var.name in names)
+
+            # The index should give the same results as the SQL query.
+            expected = query(Variant.name).filter(
+                Variant.in_region(var.chrom, var.pos - 1000, var.pos + 1000)
+            ).all()
+            self.assertEqual(
+                set(self.db.query_region(var.chrom, var.pos - 1000,
+                                         var.pos + 1000)),
+                set([i[0] for i in expected])
+            )
+
+        self.assertEqual(len(self.db.query_region("_testz", 1, 1e9)), 0)
+
+    def test_genotype_block(self):
+        """Test getting the genotypes of many variants at once."""
+        self.db.experiment_init(self.experiment)
+        names = VariantSelector().get_variants(self.experiment.session)
+        names = names[::-1] + names[:1]
+
+        expected = np.vstack([self.db.get_genotypes(i) for i in names]).T
+        block = self.db.get_genotype_block(names)
+        self.assertEqual(block.shape, expected.shape)
+        np.testing.assert_array_equal(block, expected)
+
+        # Using the rows of the dosage store.
+        rows = self.db.get_variant_rows(names)
+        np.testing.assert_array_equal(
+            self.db.get_genotype_block(names, rows), expected
+        )
+
     def test_filter_maf(self):
         should_be_removed = set()
         info = []
@@ -304,6 +342,25 @@ class TestAbstractGenoDB(object):
         expected = set(self._variants) - should_be_removed
         self.compare_variant_db(expected)
 
+    def test_filter_hwe(self):
+        info = []
+        for var in self._variants:
+            geno = np.rint(self.db.get_genotypes(var))
+            p = hwe_exact_midp(np.sum(geno == 0), np.sum(geno == 1),
+                               np.sum(geno == 2))[0]
+            info.append((var, p))
+
+        hwe_thresh = sorted([p for _, p in info])[len(info) // 2]
+        self.db.filter_hwe(hwe_thresh)
+        self.db.experiment_init(self.experiment)
+
+        expected = dict([(var, p) for var, p in info if p >= hwe_thresh])
+        self.compare_variant_db(set(expected.keys()))
+
+        query = self.experiment.session.query
+        for name, hwe_p in query(Variant.name, Variant.hwe_p):
+            self.assertAlmostEqual(hwe_p, expected[name])
+
     def test_filter_completion(self):
         should_be_removed = set()
         for var in self._variants:
@@ -446,6 +503,9 @@ class TestAbstractTask(object):
         )
 
     def tearDown(self):
+        # An open transaction would delete the journal of the next test's
+        # database (same path) when it is garbage collected.
+        self.experiment.session.close()
         shutil.rmtree(".fwd_test_tasks")
 
     def test_constructor_outcomes(self):
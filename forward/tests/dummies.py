@@ -17,6 +17,8 @@ from ..phenotype.db import AbstractPhenotypeDatabase
 from ..genotype import AbstractGenotypeDatabase, Variant
 from ..tasks import AbstractTask
 from ..experiment import Experiment
+from ..utils import SampleIndex
+from ..statistics.utilities import hwe_exact_midp
 from .. import SQLAlchemySession
 
 
@@ -96,7 +98,7 @@ class DummyPhenDatabase(AbstractPhenotypeDatabase):
         )
 
         # We need to change the order of the actual data.
-        new_idx = [self.samples.index(i) for i in sequence]
+        new_idx = SampleIndex(self.samples).get_indexer(sequence)
         for k in self.data.keys():
             self.data[k] = self.data[k][new_idx]
 
@@ -105,6 +107,9 @@ class DummyPhenDatabase(AbstractPhenotypeDatabase):
     def get_sample_order(self):
         return self.samples
 
+    def add_phenotype(self, name, values):
+        self.data[name] = np.asarray(values, dtype=float)
+
     def get_correlation_matrix(self, names):
         v = None
         for name in names:
@@ -136,6 +141,7 @@ class DummyGenotypeDatabase(AbstractGenotypeDatabase):
         self.include_names = []
         self.maf_filter = 0
         self.completion_filter = 0
+        self.hwe_filter = 0
 
         # Create genotypes for 5 fictional markers.
         self.mafs = [0.05, 0.10, 0.15, 0.20, 0.25]
@@ -188,6 +194,11 @@ class DummyGenotypeDatabase(AbstractGenotypeDatabase):
                 excludes.add(snp)
                 continue
 
+            # hwe filtering
+            if self._hwe_p(snp) < self.hwe_filter:
+                excludes.add(snp)
+                continue
+
         # name based filtering
         if self.include_names:
             excludes |= set(self.genotypes.keys()) - set(self.include_names)
@@ -205,7 +216,8 @@ class DummyGenotypeDatabase(AbstractGenotypeDatabase):
                 pos=random.randint(100, 9999999),
                 mac=float(np.nansum(self.genotypes[snp])),
                 n_missing=int(np.sum(np.isnan(self.genotypes[snp]))),
-                n_non_missing=int(np.sum(~np.isnan(self.genotypes[snp])))
+                n_non_missing=int(np.sum(~np.isnan(self.genotypes[snp]))),
+                hwe_p=float(self._hwe_p(snp))
             )
             variants.append(var)
 
@@ -232,6 +244,14 @@ class DummyGenotypeDatabase(AbstractGenotypeDatabase):
     def filter_completion(self, rate):
         self.completion_filter = rate
 
+    def filter_hwe(self, p):
+        self.hwe_filter = p
+
+    def _hwe_p(self, snp):
+        geno = self.genotypes[snp]
+        return hwe_exact_midp(np.sum(geno == 0), np.sum(geno == 1),
+                              np.sum(geno == 2))[0]
+
 
 class DummyExperiment(Experiment):
     """Dummy experiment to use for testing.
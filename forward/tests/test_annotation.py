@@ -0,0 +1,176 @@
+# This file is part of forward.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial
+# 4.0 International License. To view a copy of this license, visit
+# http://creativecommons.org/licenses/by-nc/4.0/ or send a letter to Creative
+# Commons, PO Box 1866, Mountain View, CA 94042, USA.
+
+"""
+Tests for the gene annotation store.
+"""
+
+import unittest
+import tempfile
+import shutil
+import os
+
+import numpy as np
+
+from ..annotation import GeneAnnotation
+
+
+class TestGeneAnnotation(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.gtf = os.path.join(self.tmp_dir, "genes.gtf")
+
+        lines = [
+            ("1", "gene", 1000, 2000,
+             'gene_id "G1"; gene_name "A"; gene_biotype "protein_coding";'),
+            ("1", "transcript", 1000, 2000,
+             'gene_id "G1"; transcript_id "T1"; gene_name "A";'),
+            ("1", "gene", 1500, 3000, 'gene_id "G2"; gene_name "B";'),
+            ("2", "gene", 10, 20, 'gene_id "G3";'),
+            # A gene without a gene line (its span is given by the
+            # transcripts).
+            ("chr2", "transcript", 500, 600,
+             'gene_id "G4"; transcript_id "T2"; gene_name "D";'),
+            ("chr2", "transcript", 550, 700,
+             'gene_id "G4"; transcript_id "T3"; gene_name "D";'),
+        ]
+        with open(self.gtf, "w") as f:
+            for chrom, feature, start, end, attributes in lines:
+                f.write("\t".join([chrom, "ensembl", feature, str(start),
+                                   str(end), ".", "+", ".", attributes]))
+                f.write("\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_from_gtf(self):
+        genes = GeneAnnotation.from_gtf(self.gtf)
+        self.assertEqual(len(genes), 4)
+
+        # The genes are sorted by chromosome and position.
+        self.assertEqual(list(genes.gene_ids), ["G1", "G2", "G3", "G4"])
+        self.assertEqual(list(genes.gene_names), ["A", "B", "G3", "D"])
+        self.assertEqual(list(genes.biotypes),
+                         ["protein_coding", "", "", ""])
+        self.assertEqual(list(genes.chroms), ["1", "1", "2", "2"])
+        self.assertEqual(list(genes.starts), [1000, 1500, 10, 500])
+        self.assertEqual(list(genes.ends), [2000, 3000, 20, 700])
+
+    def test_index(self):
+        index = os.path.join(self.tmp_dir, "genes.npz")
+        genes = GeneAnnotation.from_gtf(self.gtf, index=index)
+        self.assertTrue(os.path.isfile(index))
+
+        # The index is used instead of an (older) GTF file.
+        invalid = os.path.join(self.tmp_dir, "invalid.gtf")
+        with open(invalid, "w") as f:
+            f.write("invalid\n")
+        os.utime(invalid, (0, 0))
+
+        cached = GeneAnnotation.from_gtf(invalid, index=index)
+        for attr in ("gene_ids", "gene_names", "biotypes", "chroms",
+                     "starts", "ends"):
+            np.testing.assert_array_equal(getattr(genes, attr),
+                                          getattr(cached, attr))
+
+        # Outdated indexes are rebuilt.
+        os.utime(index, (0, 0))
+        GeneAnnotation.from_gtf(self.gtf, index=index)
+        self.assertTrue(os.path.getmtime(index) > 0)
+
+    def test_default_index(self):
+        GeneAnnotation.from_gtf(self.gtf)
+        self.assertTrue(os.path.isfile(self.gtf + ".genes.npz"))
+
+    def test_get_snp_sets(self):
+        genes = GeneAnnotation.from_gtf(self.gtf)
+        data = genes.get_snp_sets(
+            ["v1", "v2", "v3", "v4", "v5", "v6", "v7"],
+            ["1", "1", "chr1", "2", "2", "3", "1"],
+            [3000, 1000, 1700, 15, 650, 15, 999],
+        )
+        pairs = set(zip(data["variant"], data["set"]))
+        self.assertEqual(pairs, {("v1", "B"), ("v2", "A"), ("v3", "A"),
+                                 ("v3", "B"), ("v4", "G3"), ("v5", "D")})
+
+        # Using flanking regions.
+        data = genes.get_snp_sets(["v1", "v2"], ["1", "2"], [999, 21],
+                                  flank=1)
+        pairs = set(zip(data["variant"], data["set"]))
+        self.assertEqual(pairs, {("v1", "A"), ("v2", "G3")})
+
+    def test_no_variants(self):
+        genes = GeneAnnotation.from_gtf(self.gtf)
+        data = genes.get_snp_sets([], [], [])
+        self.assertEqual(data.shape[0], 0)
+        self.assertEqual(list(data.columns), ["variant", "set"])
+
+    def test_get_overlaps(self):
+        genes = GeneAnnotation(["1", "1", "2"], [100, 150, 100],
+                               [200, 300, 200], ["G1", "G2", "G3"])
+        variants, gene_idx = genes.get_overlaps(
+            ["1", "1", "1", "2", "X"], [175, 250, 400, 100, 150]
+        )
+        self.assertEqual(list(zip(variants, gene_idx)),
+                         [(0, 0), (0, 1), (1, 1), (3, 2)])
+
+    def test_get_nearest(self):
+        genes = GeneAnnotation(
+            ["1", "1", "1", "2"], [100, 150, 1000, 100], [500, 300, 1100, 200],
+            ["G1", "G2", "G3", "G4"]
+        )
+        nearest, distance = genes.get_nearest(
+            ["1", "1", "1", "1", "1", "2", "2", "X"],
+            [50, 200, 400, 700, 900, 150, 1000, 10]
+        )
+        # G2 is inside G1 (the gene that ends last is used).
+        self.assertEqual(list(genes.gene_ids[nearest[:7]]),
+                         ["G1", "G1", "G1", "G1", "G3", "G4", "G4"])
+        self.assertEqual(list(distance), [50, 0, 0, 200, 100, 0, 800, -1])
+        self.assertEqual(nearest[7], -1)
+
+    def test_get_nearest_random(self):
+        """Compare with a brute force search."""
+        n = 200
+        chroms = np.random.choice(["1", "2", "3"], size=n)
+        starts = np.random.randint(1, 100000, size=n)
+        ends = starts + np.random.randint(0, 5000, size=n)
+        genes = GeneAnnotation(chroms, starts, ends,
+                               ["G{}".format(i) for i in range(n)])
+
+        v_chroms = np.random.choice(["1", "2", "3", "4"], size=1000)
+        v_positions = np.random.randint(1, 110000, size=1000)
+        nearest, distance = genes.get_nearest(v_chroms, v_positions)
+
+        for i in range(1000):
+            same = genes.chroms == v_chroms[i]
+            if not same.any():
+                self.assertEqual(nearest[i], -1)
+                continue
+            d = np.maximum(np.maximum(genes.starts - v_positions[i],
+                                      v_positions[i] - genes.ends), 0)
+            self.assertEqual(distance[i], d[same].min())
+            self.assertEqual(d[nearest[i]], distance[i])
+            self.assertTrue(same[nearest[i]])
+
+        # The overlaps are the genes at a distance of 0.
+        variants, gene_idx = genes.get_overlaps(v_chroms, v_positions)
+        for i in range(1000):
+            expected = np.flatnonzero(
+                (genes.chroms == v_chroms[i]) &
+                (genes.starts <= v_positions[i]) &
+                (genes.ends >= v_positions[i])
+            )
+            self.assertEqual(sorted(gene_idx[variants == i]), list(expected))
+
+    def test_empty(self):
+        genes = GeneAnnotation([], [], [], [])
+        self.assertEqual(len(genes), 0)
+        nearest, distance = genes.get_nearest(["1"], [100])
+        self.assertEqual(list(nearest), [-1])
+        variants, gene_idx = genes.get_overlaps(["1"], [100])
+        self.assertEqual(variants.shape[0], 0)
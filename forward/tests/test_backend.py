@@ -0,0 +1,160 @@
+# This file is part of forward.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial
+# 4.0 International License. To view a copy of this license, visit
+# http://creativecommons.org/licenses/by-nc/4.0/ or send a letter to Creative
+# Commons, PO Box 1866, Mountain View, CA 94042, USA.
+
+"""
+Test for the report's backend.
+"""
+
+import unittest
+import shutil
+import os
+
+from .. import backend, FORWARD_REPORT_ROOT
+from ..backend import Backend
+from ..experiment import Experiment, ExperimentResult
+from ..phenotype.variables import ContinuousVariable
+from ..genotype import Variant
+from .dummies import DummyPhenDatabase, DummyGenotypeDatabase, DummyTask
+
+
+class BackendTestCase(object):
+    """Build a small experiment (with results) and its backend."""
+    gene_annotation = True
+
+    def setUp(self):
+        try:
+            shutil.rmtree(".fwd_test_backend")
+        except Exception:
+            pass
+
+        self.experiment = Experiment(
+            ".fwd_test_backend", DummyPhenDatabase(), DummyGenotypeDatabase(),
+            [ContinuousVariable("var1")], [DummyTask()], 1
+        )
+
+        # The variants are on chromosome 1 (snp1 at 1000, snp2 at 2000, ...),
+        # except snp3 (on chromosome 2, without genes).
+        session = self.experiment.session
+        for i in range(5):
+            session.query(Variant).filter(
+                Variant.name == "snp{}".format(i + 1)
+            ).update({"chrom": "2" if i == 2 else "1",
+                      "pos": (i + 1) * 1000})
+
+        if self.gene_annotation:
+            gtf = os.path.join(self.experiment.name, "genes.gtf")
+            with open(gtf, "w") as f:
+                for start, end, name in [(4800, 4900, "A"), (900, 2500, "B")]:
+                    f.write("\t".join([
+                        "chr1", "ensembl", "gene", str(start), str(end), ".",
+                        "+", ".",
+                        'gene_id "{0}_id"; gene_name "{0}";'.format(name)
+                    ]))
+                    f.write("\n")
+            self.experiment.gene_annotation = {"filename": gtf, "index": None}
+
+        # The results of the variants and of a SNP set.
+        for i, name in enumerate(["snp1", "snp3", "snp5"]):
+            self.experiment.add_result(
+                tested_entity="variant", results_type="GenericResults",
+                task_name="task0_DummyTask", entity_name=name,
+                phenotype="var1", significance=0.01 * (i + 1),
+            )
+        self.experiment.add_result(
+            tested_entity="snp-set", results_type="GenericResults",
+            task_name="task0_DummyTask", entity_name="set1",
+            phenotype="var1", significance=0.5,
+        )
+        self.experiment.run_tasks()
+        self.experiment.session.close()
+
+        self.backend = Backend(self.experiment.name)
+
+    def tearDown(self):
+        self.backend.session.close()
+        self.backend.hdf5_file.close()
+        shutil.rmtree(".fwd_test_backend")
+
+    def _genes(self, results):
+        """Get the gene name of every variant."""
+        return {
+            res["variant"]["name"]:
+            None if res["gene"] is None else res["gene"]["gene_name"]
+            for res in results if res["tested_entity"] == "variant"
+        }
+
+
+class TestBackendResults(BackendTestCase, unittest.TestCase):
+    def test_variant_genes(self):
+        self.assertTrue(self.backend.has_variant_genes)
+
+        results = self.backend.get_results("task0_%")
+        self.assertEqual(len(results), 4)
+
+        # The variant without a gene is kept (outer join).
+        self.assertEqual(self._genes(results),
+                         {"snp1": "B", "snp3": None, "snp5": "A"})
+
+        variant, = [res["variant"] for res in results
+                    if res.get("variant", {}).get("name") == "snp5"]
+        self.assertEqual((variant["chrom"], variant["pos"]), ("1", 5000))
+
+        # The SNP sets are not joined with the variants.
+        snp_set, = [res for res in results
+                    if res["tested_entity"] == "snp-set"]
+        self.assertEqual(snp_set["entity_name"], "set1")
+        self.assertFalse("variant" in snp_set)
+
+    def test_filters_order(self):
+        results = self.backend.get_results(
+            "task0_%", [ExperimentResult.significance <= 0.1],
+            order_by="significance", ascending=False
+        )
+        self.assertEqual([res["variant"]["name"] for res in results],
+                         ["snp5", "snp3", "snp1"])
+
+    def test_order_by_gene(self):
+        backend.www_backend = self.backend
+        self.addCleanup(setattr, backend, "www_backend", None)
+        client = backend.app.test_client()
+
+        for ascending, expected in (("true", ["snp3", "snp5", "snp1"]),
+                                    ("false", ["snp1", "snp5", "snp3"])):
+            response = client.get(
+                FORWARD_REPORT_ROOT + "/tasks/results.json",
+                query_string={"task": "task0", "pthresh": 0.1,
+                              "order_by": "gene", "ascending": ascending}
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(
+                [res["variant"]["name"] for res in response.json["results"]],
+                expected
+            )
+
+    def test_missing_variant(self):
+        """Results of unknown variants are an error."""
+        self.backend.session.add(ExperimentResult(
+            tested_entity="variant", results_type="GenericResults",
+            task_name="task0_DummyTask", entity_name="snp_unknown",
+            phenotype="var1", significance=0.2,
+        ))
+        self.backend.session.flush()
+
+        self.assertRaises(ValueError, self.backend.get_results, "task0_%")
+
+
+class TestBackendResultsNoGenes(BackendTestCase, unittest.TestCase):
+    """Test the results of an experiment without gene annotation."""
+    gene_annotation = False
+
+    def test_variant_genes(self):
+        self.assertFalse(self.backend.has_variant_genes)
+
+        results = self.backend.get_results("task0_%")
+        self.assertEqual(len(results), 4)
+        self.assertEqual(self._genes(results),
+                         {"snp1": None, "snp3": None, "snp5": None})
@@ -14,11 +14,14 @@ from __future__ import division
 import datetime
 import unittest
 import shutil
+import os
 
 from ..experiment import Experiment, ExperimentResult
 from ..phenotype.variables import (DiscreteVariable, ContinuousVariable,
                                    Variable)
 from ..genotype import Variant
+from ..annotation import VariantGene
+from ..statistics import multiple_testing
 from .dummies import DummyPhenDatabase, DummyGenotypeDatabase, DummyTask
 
 from six.moves import cPickle as pickle
@@ -147,6 +150,48 @@ class TestExperiment(unittest.TestCase):
             meta = pickle.load(f)
         self.assertTrue("executed" in meta)
 
+        # The number of tests is saved (no results).
+        self.assertEqual(self.experiment.info["n_tests"], {})
+
+    def test_correct_results(self):
+        """Check the FDR corrections of the results."""
+        np.random.seed(0)
+        p_values = {}
+        for task in ("task0_A", "task1_B"):
+            for phenotype in ("var1", "var2"):
+                p = np.random.uniform(size=20) ** 2
+                p[3] = np.nan
+                p_values[(task, phenotype)] = p
+
+                for i, p_value in enumerate(p):
+                    self.experiment.add_result(
+                        tested_entity="variant", task_name=task,
+                        entity_name="snp{}".format(i), phenotype=phenotype,
+                        significance=None if np.isnan(p_value) else p_value
+                    )
+        self.commit()
+
+        self.experiment.correct_results()
+        self.assertEqual(self.experiment.info["n_tests"],
+                         {"task0_A": 40, "task1_B": 40})
+
+        for (task, phenotype), p in p_values.items():
+            results = self.query(ExperimentResult).filter_by(
+                task_name=task, phenotype=phenotype
+            ).all()
+            results = sorted(results, key=lambda r: int(r.entity_name[3:]))
+
+            fdr = [r.fdr_significance for r in results]
+            q = [r.q_value for r in results]
+            self.assertIsNone(fdr[3])
+            self.assertIsNone(q[3])
+
+            fdr[3] = q[3] = np.nan
+            np.testing.assert_allclose(
+                fdr, multiple_testing.bh_adjusted_p_values(p)
+            )
+            np.testing.assert_allclose(q, multiple_testing.q_values(p))
+
     def test_variables(self):
         """Check that the variables database is populated."""
         # Known from the dummy database.
@@ -167,3 +212,109 @@ class TestExperiment(unittest.TestCase):
                 y = self.experiment.phenotypes.get_phenotype_vector(var)
                 prevalence = np.sum(y == 1) / np.sum(~np.isnan(y))
                 self.assertEqual(var.prevalence, prevalence)
+
+
+class TestExperimentPrincipalComponents(unittest.TestCase):
+    def setUp(self):
+        self.phen_db = DummyPhenDatabase()
+        self.variables = [
+            ContinuousVariable("var1"),
+            ContinuousVariable("var5", covariate=True),
+        ]
+
+        try:
+            shutil.rmtree(".fwd_test_experiment")
+        except Exception:
+            pass
+
+    def tearDown(self):
+        shutil.rmtree(".fwd_test_experiment")
+
+    def test_covariates(self):
+        """Check that the PCs are added as covariates."""
+        experiment = Experiment(
+            ".fwd_test_experiment", self.phen_db, DummyGenotypeDatabase(),
+            self.variables, [], 1,
+            principal_components={"n_components": 2, "seed": 1}
+        )
+
+        covariates = [v.name for v in experiment.variables if v.is_covariate]
+        self.assertEqual(covariates, ["var5", "PC1", "PC2"])
+
+        pc1 = experiment.session.query(ContinuousVariable).filter_by(
+            name="PC1"
+        ).one()
+        self.assertTrue(pc1.is_covariate)
+
+        self.assertEqual(
+            experiment.info["principal_components"]["names"], ["PC1", "PC2"]
+        )
+        self.assertTrue(os.path.isfile(os.path.join(
+            ".fwd_test_experiment", "principal_components", "pcs.npy"
+        )))
+
+    def test_invalid_parameter(self):
+        self.assertRaises(
+            ValueError, Experiment, ".fwd_test_experiment", self.phen_db,
+            DummyGenotypeDatabase(), self.variables, [], 1,
+            principal_components={"n_pcs": 2}
+        )
+
+
+class TestExperimentGeneAnnotation(unittest.TestCase):
+    def setUp(self):
+        try:
+            shutil.rmtree(".fwd_test_experiment")
+        except Exception:
+            pass
+
+        self.experiment = Experiment(
+            ".fwd_test_experiment", DummyPhenDatabase(),
+            DummyGenotypeDatabase(), [ContinuousVariable("var1")], [], 1
+        )
+
+        # The variants are on chromosome 1 (snp1 at 1000, snp2 at 2000, ...).
+        session = self.experiment.session
+        for i in range(5):
+            session.query(Variant).filter(
+                Variant.name == "snp{}".format(i + 1)
+            ).update({"chrom": "1", "pos": (i + 1) * 1000})
+        session.commit()
+
+        self.gtf = os.path.join(self.experiment.name, "genes.gtf")
+        with open(self.gtf, "w") as f:
+            for start, end, name in [(900, 2500, "A"), (4800, 4900, "B"),
+                                     (100, 200, "C")]:
+                f.write("\t".join([
+                    "chr1", "ensembl", "gene", str(start), str(end), ".", "+",
+                    ".", 'gene_id "{0}_id"; gene_name "{0}";'.format(name)
+                ]))
+                f.write("\n")
+
+    def tearDown(self):
+        shutil.rmtree(".fwd_test_experiment")
+
+    def test_annotate_variants(self):
+        self.experiment.gene_annotation = {"filename": self.gtf,
+                                           "index": None}
+        self.experiment.run_tasks()
+
+        genes = {
+            i.variant: (i.gene_name, i.gene_id, i.distance)
+            for i in self.experiment.session.query(VariantGene).all()
+        }
+        self.assertEqual(genes, {
+            "snp1": ("A", "A_id", 0),
+            "snp2": ("A", "A_id", 0),
+            "snp3": ("A", "A_id", 500),
+            "snp4": ("B", "B_id", 800),
+            "snp5": ("B", "B_id", 100),
+        })
+        self.assertEqual(self.experiment.info["gene_annotation"], self.gtf)
+
+    def test_invalid_parameter(self):
+        self.assertRaises(
+            ValueError, Experiment, ".fwd_test_experiment2",
+            DummyPhenDatabase(), DummyGenotypeDatabase(), [], [], 1,
+            gene_annotation={"gtf": self.gtf}
+        )
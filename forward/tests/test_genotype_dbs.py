@@ -13,16 +13,40 @@ from pkg_resources import resource_filename
 import unittest
 import tempfile
 import random
+import struct
+import shutil
+import zlib
 import os
 
 import numpy as np
+import pyplink
+from gepyto.formats.impute2 import Impute2File
 
-from ..genotype import (FrozenDatabaseError, MemoryImpute2Geno,
-                        PlinkGenotypeDatabase)
+from ..genotype import (Variant, FrozenDatabaseError, MemoryImpute2Geno,
+                        PlinkGenotypeDatabase, BgenGenotypeDatabase,
+                        VCFGenotypeDatabase, MultiFileGenotypeDatabase)
+from ..statistics.utilities import impute_info
 from .abstract_tests import TestAbstractGenoDB
 from . import dummies
 
 
+def impute2_info(filename, implied_bb=False):
+    """Compute the info measure of the variants of an IMPUTE2 file."""
+    info = {}
+    with Impute2File(filename) as f:
+        for line in f:
+            probs = line.probabilities
+            p_bb = probs[:, 2]
+            if implied_bb:
+                p_bb = np.clip(1 - probs[:, 0] - probs[:, 1], 0, 1)
+
+            dosage = probs[:, 1] + 2 * p_bb
+            variance = probs[:, 1] + 4 * p_bb - dosage ** 2
+            info[line.name] = impute_info(dosage, variance)[0]
+
+    return info
+
+
 class TestDummyGenotypeDatabase(TestAbstractGenoDB, unittest.TestCase):
     """Tests for DummyGenotypeDatabase."""
     def setUp(self):
@@ -73,6 +97,7 @@ class TestMemoryImpute2Geno(TestAbstractGenoDB, unittest.TestCase):
         self.assertRaises(FrozenDatabaseError, self.db.filter_maf, 0)
         self.assertRaises(FrozenDatabaseError, self.db.filter_name, 0)
         self.assertRaises(FrozenDatabaseError, self.db.exclude_samples, [])
+        self.assertRaises(FrozenDatabaseError, self.db.sparse_maf, 0.1)
 
     def test_init_method_call(self):
         """Test method calls specified during initialization.
@@ -113,6 +138,49 @@ class TestMemoryImpute2Geno(TestAbstractGenoDB, unittest.TestCase):
                 test=0.05
             )
 
+    def test_info(self):
+        """Compare the info measure with the IMPUTE2 probabilities."""
+        self.db.experiment_init(self.experiment)
+        expected = impute2_info(
+            resource_filename(__name__, "data/test_impute2_db.impute2")
+        )
+
+        query = self.experiment.session.query
+        for name, info in query(Variant.name, Variant.info):
+            self.assertAlmostEqual(info, expected[name])
+
+    def test_dosage(self):
+        """Compare the dosage and the alleles with gepyto's dosage."""
+        self.db.experiment_init(self.experiment)
+
+        filename = resource_filename(__name__, "data/test_impute2_db.impute2")
+        query = self.experiment.session.query
+        with Impute2File(filename, "dosage") as f:
+            for dosage, info in f:
+                np.testing.assert_allclose(
+                    self.db.get_genotypes(info["name"]), dosage
+                )
+
+                variant = query(Variant).filter(
+                    Variant.name == info["name"]
+                ).one()
+                self.assertEqual((variant.minor, variant.major),
+                                 (info["minor"], info["major"]))
+                self.assertAlmostEqual(variant.mac,
+                                       info["minor_allele_count"])
+
+    def test_filter_info(self):
+        expected = impute2_info(
+            resource_filename(__name__, "data/test_impute2_db.impute2")
+        )
+        thresh = sorted(expected.values())[len(expected) // 2]
+
+        self.db.filter_info(thresh)
+        self.db.experiment_init(self.experiment)
+        self.compare_variant_db(
+            set([name for name, info in expected.items() if info >= thresh])
+        )
+
     def test_probability_filter(self):
         """Test impute2 probability filter."""
         self.db = self.get_probability_filtered_db()
@@ -143,6 +211,27 @@ class TestMemoryImpute2Geno(TestAbstractGenoDB, unittest.TestCase):
         geno = self.db.get_genotypes(self._variants[0])
         self.assertTrue(geno.shape[0] == (len(samples_initial) - 1))
 
+    def test_exclude_samples_values(self):
+        """Check that the right genotypes are kept after exclusions."""
+        samples_initial = list(self.db.get_sample_order())
+        expected = {
+            name: self.db.get_genotypes(name) for name in self._variants
+        }
+        del self.db._mat
+
+        excluded = samples_initial[::3]
+        self.db.exclude_samples(excluded)
+        self.db.experiment_init(self.experiment, batch_insert_n=2)
+
+        keep = [i for i, sample in enumerate(samples_initial)
+                if sample not in excluded]
+        self.assertEqual(list(self.db.get_sample_order()),
+                         [samples_initial[i] for i in keep])
+
+        for name in self._variants:
+            np.testing.assert_array_equal(self.db.get_genotypes(name),
+                                          expected[name][keep])
+
     def test_exclude_bad_sample(self):
         self.assertRaises(ValueError, self.db.exclude_samples, ["testzzzz"])
 
@@ -203,3 +292,462 @@ class TestPlinkGenoDB(TestAbstractGenoDB, unittest.TestCase):
         with open(filename, "r") as f:
             for line in f:
                 self._variants.append(line.rstrip().split()[1])
+
+    def test_chunked_init(self):
+        """Check that chunk and batch sizes don't change the database."""
+        self.db.chunk_size = 7
+        self.db.filter_maf(0.1)
+        self.db.experiment_init(self.experiment, batch_insert_n=3)
+
+        expected = []
+        for var in self._variants:
+            geno = self.db.get_genotypes(var)
+            maf = np.nansum(geno) / (2 * np.sum(~np.isnan(geno)))
+            maf = min(maf, 1 - maf)
+            if maf >= 0.1:
+                expected.append((var, np.nansum(geno)))
+
+        variants = self.db.query_variants(
+            self.experiment.session, ["name", "mac"]
+        ).all()
+        self.assertEqual(sorted(variants), sorted(expected))
+
+    def test_no_variants(self):
+        """Check that filtering out all the variants is not an error."""
+        self.db.filter_name(["not_a_variant"])
+        self.db.experiment_init(self.experiment)
+        self.assertEqual(self.db.query_variants(self.experiment.session).all(),
+                         [])
+
+    def test_sparse(self):
+        """Check the sparse genotype matrix of the rare variants."""
+        self.db.sparse_maf(0.1)
+        self.db.experiment_init(self.experiment)
+        self.db.sparse_init(self.experiment)
+
+        variants = self.db.query_variants(
+            self.experiment.session, ["name", "mac", "n_non_missing"]
+        ).all()
+        rare = [name for name, mac, n in variants if mac <= 0.2 * n]
+        common = [name for name, mac, n in variants if mac > 0.2 * n]
+        self.assertTrue(rare and common)
+
+        self.assertTrue(self.db.is_sparse(rare).all())
+        self.assertFalse(self.db.is_sparse(common).any())
+
+        sparse = self.db.get_sparse_block(rare[::-1])
+        self.assertEqual(sparse.format, "csc")
+        np.testing.assert_array_equal(
+            sparse.toarray(), self.db.get_genotype_block(rare[::-1])
+        )
+
+        self.assertRaises(ValueError, self.db.get_sparse_block, common[:1])
+
+    def test_no_sparse(self):
+        self.db.experiment_init(self.experiment)
+        self.db.sparse_init(self.experiment)
+        self.assertFalse(self.db.is_sparse(self._variants).any())
+        self.assertRaises(ValueError, self.db.get_sparse_block,
+                          self._variants[:1])
+        self.assertRaises(FrozenDatabaseError, self.db.sparse_maf, 0.1)
+
+    def test_minor_a2(self):
+        """Check the markers for which a2 is the minor allele."""
+        # Counts of the a1 allele (-1 is missing).
+        markers = [
+            ("a1_minor", "A", "G", [0, 0, 1, 0, -1, 0, 1, 0, 0, 2]),
+            ("a2_minor", "C", "T", [2, 2, 1, 2, 2, -1, 2, 2, 1, 2]),
+            ("a2_rare", "G", "A", [2, 2, 2, 2, 2, 2, 1, 2, 2, 2]),
+        ]
+
+        tmp_dir = tempfile.mkdtemp()
+        prefix = os.path.join(tmp_dir, "flipped")
+        with pyplink.PyPlink(prefix, "w") as bed:
+            for name, a1, a2, geno in markers:
+                bed.write_genotypes(geno)
+
+        with open(prefix + ".bim", "w") as f:
+            for i, (name, a1, a2, geno) in enumerate(markers):
+                f.write("1\t{}\t0\t{}\t{}\t{}\n".format(name, i + 1, a1, a2))
+
+        with open(prefix + ".fam", "w") as f:
+            for i in range(10):
+                f.write("s{0} s{0} 0 0 0 -9\n".format(i))
+
+        try:
+            self.db = PlinkGenotypeDatabase(prefix)
+            self.db.sparse_maf(0.1)
+            self.db.experiment_init(self.experiment)
+            self.db.sparse_init(self.experiment)
+
+            variants = {
+                name: (mac, minor, major) for name, mac, minor, major in
+                self.db.query_variants(
+                    self.experiment.session, ["name", "mac", "minor", "major"]
+                )
+            }
+
+            for name, a1, a2, geno in markers:
+                geno = np.array(geno, dtype=float)
+                geno[geno == -1] = np.nan
+                if name != "a1_minor":
+                    a1, a2 = a2, a1
+                    geno = 2 - geno
+
+                # The MAC and the alleles are those of the dosage.
+                dosage = self.db.get_genotypes(name)
+                np.testing.assert_array_equal(dosage, geno)
+                self.assertEqual(variants[name],
+                                 (np.nansum(dosage), a1, a2))
+
+            # Only the rare variant is in the sparse matrix.
+            self.assertEqual(list(self.db.is_sparse(["a1_minor", "a2_minor",
+                                                     "a2_rare"])),
+                             [False, False, True])
+            self.assertEqual(self.db.get_sparse_block(["a2_rare"]).nnz, 1)
+
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+def write_bgen(filename, lines, samples, n_bits=16, compressed=True):
+    """Write a (layout 2) BGEN file from IMPUTE2 lines."""
+    def _s(s, fmt="<H"):
+        s = s.encode("utf-8")
+        return struct.pack(fmt, len(s)) + s
+
+    n = len(samples)
+    sample_block = b"".join([_s(sample) for sample in samples])
+    sample_block = struct.pack("<II", 8 + len(sample_block), n) + sample_block
+
+    flags = (1 if compressed else 0) | (2 << 2) | (1 << 31)
+    header = struct.pack("<III", 20, len(lines), n) + b"bgen"
+    header += struct.pack("<I", flags)
+
+    with open(filename, "wb") as f:
+        f.write(struct.pack("<I", len(header) + len(sample_block)))
+        f.write(header)
+        f.write(sample_block)
+
+        for line in lines:
+            f.write(_s(line.name) + _s(line.name) + _s(line.chrom))
+            f.write(struct.pack("<IH", line.pos, 2))
+            f.write(_s(line.a1, "<I") + _s(line.a2, "<I"))
+
+            # Pack the probabilities (p_AA and p_AB).
+            values = np.round(
+                line.probabilities[:, :2] * (2 ** n_bits - 1)
+            ).astype(np.uint64).ravel()
+            bits = (values[:, np.newaxis] >> np.arange(n_bits, dtype=np.uint64))
+            bits = (bits & 1).astype(np.uint8).ravel()
+
+            data = struct.pack("<IHBB", n, 2, 2, 2) + b"\x02" * n
+            data += struct.pack("<BB", 0, n_bits)
+            data += np.packbits(bits, bitorder="little").tobytes()
+
+            if compressed:
+                compressed_data = zlib.compress(data)
+                f.write(struct.pack("<II", len(compressed_data) + 4,
+                                    len(data)))
+                f.write(compressed_data)
+            else:
+                f.write(struct.pack("<I", len(data)))
+                f.write(data)
+
+
+class TestBgenGenotypeDatabase(TestAbstractGenoDB, unittest.TestCase):
+    """Tests for BgenGenotypeDatabase."""
+    n_bits = 16
+    compressed = True
+
+    def setUp(self):
+        super(TestBgenGenotypeDatabase, self).setUp()
+        self.impute2 = resource_filename(
+            __name__, "data/test_impute2_db.impute2"
+        )
+        with Impute2File(self.impute2) as f:
+            lines = list(f)
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, "test.bgen")
+        write_bgen(self.filename, lines, ["sample1", "sample2", "sample3"],
+                   self.n_bits, self.compressed)
+
+        self.db = BgenGenotypeDatabase(self.filename)
+        self._variants = ["rs12345", "rs23456", "rs23457", "rs92134"]
+
+    def tearDown(self):
+        super(TestBgenGenotypeDatabase, self).tearDown()
+        self.db.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_get_samples(self):
+        expected = np.array(["sample1", "sample2", "sample3"])
+        self.assertTrue(np.all(self.db.samples == expected))
+
+    def test_dosage(self):
+        """Compare the dosage with the IMPUTE2 file.
+
+        In BGEN files, p(BB) is implied by the two other probabilities.
+
+        """
+        with Impute2File(self.impute2) as f:
+            for line in f:
+                p_aa, p_ab = line.probabilities[:, 0], line.probabilities[:, 1]
+                dosage = 2 * (1 - p_aa - p_ab) + p_ab
+                if np.mean(dosage) > 1:
+                    dosage = 2 - dosage
+
+                np.testing.assert_array_almost_equal(
+                    dosage, self.db.get_genotypes(line.name), decimal=2
+                )
+
+    def test_index_reuse(self):
+        """The index is written to disk and reused."""
+        self.db.experiment_init(self.experiment)
+        self.assertTrue(os.path.isfile(self.filename + ".bgi"))
+
+        db = BgenGenotypeDatabase(self.filename)
+        self.assertTrue(
+            np.all(db.get_index().values == self.db.get_index().values)
+        )
+        db.close()
+
+    def test_frozens(self):
+        self.db.experiment_init(self.experiment)
+        self.assertRaises(FrozenDatabaseError, self.db.filter_completion, 0)
+        self.assertRaises(FrozenDatabaseError, self.db.filter_maf, 0)
+        self.assertRaises(FrozenDatabaseError, self.db.filter_name, 0)
+        self.assertRaises(FrozenDatabaseError, self.db.exclude_samples, [])
+        self.assertRaises(FrozenDatabaseError, self.db.sparse_maf, 0.1)
+
+    def test_exclude_samples(self):
+        self.db.exclude_samples(["sample2"])
+        self.db.experiment_init(self.experiment)
+
+        self.assertEqual(list(self.db.get_sample_order()),
+                         ["sample1", "sample3"])
+        self.assertEqual(self.db.get_genotypes(self._variants[0]).shape[0], 2)
+
+    def test_probability_filter(self):
+        self.db.close()
+        self.db = BgenGenotypeDatabase(self.filename, filter_probability=0.89)
+        self.test_mixed_filters()
+
+    def test_info(self):
+        """Compare the info measure with the IMPUTE2 probabilities."""
+        self.db.experiment_init(self.experiment)
+
+        # The BGEN file only stores p(AA) and p(AB).
+        expected = impute2_info(self.impute2, implied_bb=True)
+
+        query = self.experiment.session.query
+        for name, info in query(Variant.name, Variant.info):
+            self.assertAlmostEqual(info, expected[name], places=2)
+
+
+class TestBgenGenotypeDatabaseUncompressed(TestBgenGenotypeDatabase):
+    """Tests for BgenGenotypeDatabase (uncompressed, 10 bits)."""
+    n_bits = 10
+    compressed = False
+
+
+def write_bgzf(filename, data, block_size=65280):
+    """Write data to a BGZF (bgzip) compressed file."""
+    with open(filename, "wb") as f:
+        blocks = [data[i:(i + block_size)]
+                  for i in range(0, len(data), block_size)]
+
+        # The empty block marks the end of the file.
+        for block in blocks + [b""]:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+            cdata = compressor.compress(block) + compressor.flush()
+
+            f.write(struct.pack("<BBBBIBBHBBHH", 31, 139, 8, 4, 0, 0, 255, 6,
+                                66, 67, 2, len(cdata) + 25))
+            f.write(cdata)
+            f.write(struct.pack("<II", zlib.crc32(block) & 0xffffffff,
+                                len(block)))
+
+
+def write_vcf(filename, lines, samples, block_size=100):
+    """Write a bgzipped VCF file (DS and GT fields) from IMPUTE2 lines.
+
+    The small block size makes records span multiple BGZF blocks.
+
+    """
+    vcf = [
+        "##fileformat=VCFv4.2",
+        "##FORMAT=<ID=GT,Number=1,Type=String,Description=\"Genotype\">",
+        "##FORMAT=<ID=DS,Number=1,Type=Float,Description=\"Dosage\">",
+        "\t".join(["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER",
+                   "INFO", "FORMAT"] + samples)
+    ]
+    for line in lines:
+        dosage = line.probabilities[:, 1] + 2 * line.probabilities[:, 2]
+        calls = np.argmax(line.probabilities, axis=1)
+        genotypes = ["{}/{}:{:.3f}".format(int(call >= 1), int(call == 2), ds)
+                     for call, ds in zip(calls, dosage)]
+        vcf.append("\t".join(
+            [line.chrom, str(line.pos), line.name, line.a1, line.a2, ".",
+             "PASS", ".", "GT:DS"] + genotypes
+        ))
+
+    write_bgzf(filename, ("\n".join(vcf) + "\n").encode("utf-8"),
+               block_size)
+
+
+class TestVCFGenotypeDatabase(TestAbstractGenoDB, unittest.TestCase):
+    """Tests for VCFGenotypeDatabase."""
+    def setUp(self):
+        super(TestVCFGenotypeDatabase, self).setUp()
+        self.impute2 = resource_filename(
+            __name__, "data/test_impute2_db.impute2"
+        )
+        with Impute2File(self.impute2) as f:
+            lines = list(f)
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, "test.vcf.gz")
+        write_vcf(self.filename, lines, ["sample1", "sample2", "sample3"])
+
+        self.db = VCFGenotypeDatabase(self.filename)
+        self._variants = ["rs12345", "rs23456", "rs23457", "rs92134"]
+
+    def tearDown(self):
+        super(TestVCFGenotypeDatabase, self).tearDown()
+        self.db.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_get_samples(self):
+        expected = np.array(["sample1", "sample2", "sample3"])
+        self.assertTrue(np.all(self.db.samples == expected))
+        self.assertEqual(self.db.field, "DS")
+
+    def test_dosage(self):
+        """Compare the dosage with the IMPUTE2 file."""
+        with Impute2File(self.impute2, "dosage") as f:
+            for dosage, info in f:
+                np.testing.assert_array_almost_equal(
+                    dosage, self.db.get_genotypes(info["name"]), decimal=3
+                )
+
+    def test_hard_calls(self):
+        """Compare the GT field with the IMPUTE2 hard calls."""
+        db = VCFGenotypeDatabase(self.filename, field="GT")
+        with Impute2File(self.impute2) as f:
+            for line in f:
+                expected = np.argmax(line.probabilities, axis=1)
+                if np.mean(expected) > 1:
+                    expected = 2 - expected
+
+                np.testing.assert_array_equal(
+                    expected, db.get_genotypes(line.name)
+                )
+        db.close()
+
+    def test_index(self):
+        """Check the virtual offsets and the index reuse."""
+        index = self.db.get_index()
+        self.assertEqual(list(index["name"]), self._variants)
+        self.assertEqual(list(index["pos"]),
+                         [1231415, 3214569, 3214570, 8311148])
+
+        self.db.experiment_init(self.experiment)
+        self.assertTrue(os.path.isfile(self.filename + ".fwdidx.npz"))
+
+        db = VCFGenotypeDatabase(self.filename)
+        self.assertTrue(np.all(db.get_index().values == index.values))
+        db.close()
+
+    def test_filter_region(self):
+        self.db.filter_region(["1:3214569-3214570", "2:1-10"])
+        self.db.experiment_init(self.experiment)
+        self.compare_variant_db({"rs23456", "rs23457"})
+
+    def test_exclude_samples(self):
+        self.db.exclude_samples(["sample2"])
+        self.db.experiment_init(self.experiment)
+
+        self.assertEqual(list(self.db.get_sample_order()),
+                         ["sample1", "sample3"])
+        self.assertEqual(self.db.get_genotypes(self._variants[0]).shape[0], 2)
+
+
+class TestMultiFileGenotypeDatabase(TestAbstractGenoDB, unittest.TestCase):
+    """Tests for MultiFileGenotypeDatabase (using VCF files)."""
+    def setUp(self):
+        super(TestMultiFileGenotypeDatabase, self).setUp()
+        self.impute2 = resource_filename(
+            __name__, "data/test_impute2_db.impute2"
+        )
+        with Impute2File(self.impute2) as f:
+            lines = list(f)
+
+        self.samples = ["sample1", "sample2", "sample3"]
+        self.tmp_dir = tempfile.mkdtemp()
+        for i, part in enumerate((lines[:1], lines[1:3], lines[3:])):
+            write_vcf(os.path.join(self.tmp_dir, "part{}.vcf.gz".format(i)),
+                      part, self.samples)
+
+        self.db = MultiFileGenotypeDatabase(
+            "VCFGenotypeDatabase", os.path.join(self.tmp_dir, "*.vcf.gz")
+        )
+        self._variants = ["rs12345", "rs23456", "rs23457", "rs92134"]
+
+    def tearDown(self):
+        super(TestMultiFileGenotypeDatabase, self).tearDown()
+        self.db.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_lazy_open(self):
+        self.assertEqual(len(self.db.filenames), 3)
+        self.assertEqual(list(self.db.get_sample_order()), self.samples)
+        self.assertEqual(
+            [db is not None for db in self.db._dbs], [True, False, False]
+        )
+
+    def test_routing(self):
+        """Compare the genotypes with the single file."""
+        self.experiment.cpu = 2
+        self.db.experiment_init(self.experiment)
+        self.assertFalse(
+            os.path.exists(os.path.join(self.experiment.name,
+                                        "genotype_parts"))
+        )
+
+        with Impute2File(self.impute2, "dosage") as f:
+            for dosage, info in f:
+                np.testing.assert_array_almost_equal(
+                    dosage, self.db.get_genotypes(info["name"]), decimal=3
+                )
+
+        self.assertEqual(list(self.db.get_variant_rows(["rs92134"])), [3])
+        self.assertRaises(ValueError, self.db.get_genotypes, "rs0")
+
+    def test_exclude_samples(self):
+        self.db.get_sample_order()  # The first file is already opened.
+        self.db.exclude_samples(["sample2"])
+        self.db.experiment_init(self.experiment)
+
+        self.assertEqual(list(self.db.get_sample_order()),
+                         ["sample1", "sample3"])
+        for variant in self._variants:
+            self.assertEqual(self.db.get_genotypes(variant).shape[0], 2)
+
+    def test_different_samples(self):
+        with Impute2File(self.impute2) as f:
+            lines = list(f)
+
+        filename = os.path.join(self.tmp_dir, "other.vcf.gz")
+        write_vcf(filename, lines, ["sample1", "sample3", "sample2"])
+        db = MultiFileGenotypeDatabase(
+            VCFGenotypeDatabase,
+            [os.path.join(self.tmp_dir, "part0.vcf.gz"), filename]
+        )
+        self.assertRaises(ValueError, db.get_database, 1)
+        db.close()
+
+    def test_bad_container(self):
+        self.assertRaises(ValueError, MultiFileGenotypeDatabase,
+                          "FakeGenotypeDatabase", self.tmp_dir)
@@ -0,0 +1,157 @@
+# This file is part of forward.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial
+# 4.0 International License. To view a copy of this license, visit
+# http://creativecommons.org/licenses/by-nc/4.0/ or send a letter to Creative
+# Commons, PO Box 1866, Mountain View, CA 94042, USA.
+
+"""
+Test for the computation of the genetic relationship matrix.
+"""
+
+from __future__ import division
+
+from pkg_resources import resource_filename
+import unittest
+import os
+
+import numpy as np
+
+from ..genotype import PlinkGenotypeDatabase, VariantSelector
+from ..grm import (standardize_genotypes, compute_grm,
+                   GeneticRelationshipMatrix)
+from ..pca import compute_principal_components
+from . import dummies
+
+
+class TestStandardize(unittest.TestCase):
+    def test_standardize(self):
+        x = np.array([[0, 1, 0], [1, np.nan, 0], [2, 1, 0]])
+        z, polymorphic = standardize_genotypes(x)
+
+        self.assertEqual(z.dtype, np.float32)
+        np.testing.assert_array_equal(polymorphic, [True, True, False])
+        np.testing.assert_array_almost_equal(
+            z[:, 0], (x[:, 0] - 1) / np.sqrt(0.5)
+        )
+        np.testing.assert_array_equal(z[:, 2], 0)
+
+    def test_missing(self):
+        x = np.array([[0], [np.nan], [2], [1]])
+        z, _ = standardize_genotypes(x)
+        self.assertEqual(z[1, 0], 0)
+
+
+class TestComputeGRM(unittest.TestCase):
+    def setUp(self):
+        self.experiment = dummies.DummyExperiment()
+
+        filename = resource_filename(__name__, "data/simulated/sim.bim")
+        self.db = PlinkGenotypeDatabase(os.path.abspath(filename)[:-4])
+        self.db.experiment_init(self.experiment)
+
+        self.path = os.path.join(self.experiment.name, "grm")
+
+    def tearDown(self):
+        self.experiment.clean()
+
+    def _expected(self, names):
+        x = self.db.get_genotype_block(names)
+        p = np.nanmean(x, axis=0) / 2
+        z = (x - 2 * p) / np.sqrt(2 * p * (1 - p))
+        z[np.isnan(z)] = 0
+        return np.dot(z, z.T) / len(names)
+
+    def test_grm(self):
+        grm = compute_grm(self.db, self.experiment.session, self.path,
+                          block_size=17)
+        names = VariantSelector().get_variants(self.experiment.session)
+
+        self.assertEqual(grm.samples, self.db.get_sample_order())
+        self.assertEqual(grm.n_variants, len(names))
+        np.testing.assert_array_almost_equal(
+            grm.get_matrix(), self._expected(names), decimal=4
+        )
+
+    def test_threads(self):
+        """The number of workers does not change the GRM."""
+        compute_grm(self.db, self.experiment.session, self.path,
+                    block_size=10)
+        expected = GeneticRelationshipMatrix(self.path).get_matrix()
+
+        grm = compute_grm(self.db, self.experiment.session, self.path,
+                          block_size=10, cpu=3)
+        np.testing.assert_array_almost_equal(grm.get_matrix(), expected,
+                                             decimal=4)
+
+    def test_subset(self):
+        selector = VariantSelector(maf=0.2)
+        grm = compute_grm(self.db, self.experiment.session, self.path,
+                          selector=selector)
+        names = selector.get_variants(self.experiment.session)
+        self.assertTrue(0 < len(names) < 102)
+
+        mask = np.zeros(len(grm), dtype=bool)
+        mask[:50] = True
+        np.testing.assert_array_almost_equal(
+            grm.get_matrix(mask), self._expected(names)[:50, :50], decimal=4
+        )
+
+
+class TestPrincipalComponents(unittest.TestCase):
+    def setUp(self):
+        self.experiment = dummies.DummyExperiment()
+
+        filename = resource_filename(__name__, "data/simulated/sim.bim")
+        self.db = PlinkGenotypeDatabase(os.path.abspath(filename)[:-4])
+        self.db.experiment_init(self.experiment)
+
+        self.path = os.path.join(self.experiment.name, "pcs")
+
+    def tearDown(self):
+        self.experiment.clean()
+
+    def test_pcs(self):
+        """Compare with the eigenvectors of the GRM."""
+        # With few variants, the range of Z is found exactly.
+        names = VariantSelector().get_variants(self.experiment.session)
+        selector = VariantSelector(names=names[:8])
+
+        pcs = compute_principal_components(
+            self.db, self.experiment.session, self.path, n_components=3,
+            selector=selector, block_size=3, seed=1
+        )
+        self.assertEqual(pcs.pcs.shape, (2000, 3))
+        self.assertEqual(pcs.get_names(), ["PC1", "PC2", "PC3"])
+
+        grm = compute_grm(self.db, self.experiment.session,
+                          os.path.join(self.experiment.name, "grm"),
+                          selector=selector)
+        eigenvalues, eigenvectors = np.linalg.eigh(grm.get_matrix())
+
+        np.testing.assert_array_almost_equal(
+            pcs.eigenvalues, eigenvalues[::-1][:3], decimal=3
+        )
+        for i in range(3):
+            r = np.corrcoef(pcs.pcs[:, i], eigenvectors[:, -(i + 1)])[0, 1]
+            self.assertAlmostEqual(abs(r), 1, places=2)
+
+    def test_cache(self):
+        pcs = compute_principal_components(
+            self.db, self.experiment.session, self.path, n_components=2,
+            seed=1
+        )
+
+        # The cached PCs are returned (a different seed would change them).
+        cached = compute_principal_components(
+            self.db, self.experiment.session, self.path, n_components=2,
+            seed=2
+        )
+        np.testing.assert_array_equal(cached.pcs, pcs.pcs)
+
+        # The PCs are computed again for a different set of variants.
+        other = compute_principal_components(
+            self.db, self.experiment.session, self.path, n_components=2,
+            selector=VariantSelector(maf=0.2), seed=1
+        )
+        self.assertNotEqual(other.info, pcs.info)
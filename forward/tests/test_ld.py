@@ -0,0 +1,155 @@
+# This file is part of forward.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial
+# 4.0 International License. To view a copy of this license, visit
+# http://creativecommons.org/licenses/by-nc/4.0/ or send a letter to Creative
+# Commons, PO Box 1866, Mountain View, CA 94042, USA.
+
+"""
+Test for the computation of linkage disequilibrium.
+"""
+
+from pkg_resources import resource_filename
+import unittest
+import random
+import os
+
+import numpy as np
+import pandas as pd
+
+from ..genotype import PlinkGenotypeDatabase, VariantSelector
+from ..ld import ld_correlation, compute_ld, LDStore
+from . import dummies
+
+
+class TestLDCorrelation(unittest.TestCase):
+    def setUp(self):
+        self.x = np.random.binomial(2, 0.3, size=(200, 10)).astype(float)
+
+    def test_no_missing(self):
+        """Compare with numpy when there are no missing values."""
+        np.testing.assert_array_almost_equal(
+            ld_correlation(self.x), np.corrcoef(self.x, rowvar=False)
+        )
+
+    def test_pairwise_complete(self):
+        """Compare with pandas (pairwise complete) with missing values."""
+        self.x[np.random.random(self.x.shape) < 0.1] = np.nan
+        np.testing.assert_array_almost_equal(
+            ld_correlation(self.x[:, :4], self.x),
+            pd.DataFrame(self.x).corr().values[:4, :]
+        )
+
+    def test_monomorphic(self):
+        """Check that monomorphic variants have a NaN correlation."""
+        self.x[:, 0] = 1
+        r = ld_correlation(self.x)
+        self.assertTrue(np.all(np.isnan(r[0, :])))
+        self.assertFalse(np.any(np.isnan(r[1:, 1:])))
+
+
+class TestComputeLD(unittest.TestCase):
+    def setUp(self):
+        self.experiment = dummies.DummyExperiment()
+
+        filename = resource_filename(__name__, "data/simulated/sim.bim")
+        self.db = PlinkGenotypeDatabase(os.path.abspath(filename)[:-4])
+        self.db.experiment_init(self.experiment)
+
+        self.variants = self.db.query_variants(
+            self.experiment.session, ["name", "pos"]
+        ).order_by("pos").all()
+        self.names = [name for name, _ in self.variants]
+
+        self.path = os.path.join(self.experiment.name, "ld")
+
+    def tearDown(self):
+        self.experiment.clean()
+
+    def _expected(self, names=None):
+        names = self.names if names is None else names
+        return ld_correlation(self.db.get_genotype_block(names))
+
+    def test_window_variants(self):
+        """Check the LD with a window in number of variants."""
+        store = compute_ld(self.db, self.experiment.session, self.path,
+                           window_variants=3, block_size=7)
+
+        expected = self._expected()
+        i, j = np.indices(expected.shape)
+        expected[np.abs(i - j) > 3] = 0
+
+        self.assertEqual(list(store.names), self.names)
+        np.testing.assert_array_almost_equal(store.get_matrix(), expected,
+                                             decimal=6)
+
+    def test_window_kb(self):
+        """Check the LD with a window in kb."""
+        compute_ld(self.db, self.experiment.session, self.path,
+                   window_kb=0.005, block_size=10)
+        store = LDStore(self.path)
+
+        expected = self._expected()
+        pos = np.array([pos for _, pos in self.variants])
+        expected[np.abs(pos[:, np.newaxis] - pos) > 5] = 0
+
+        np.testing.assert_array_almost_equal(store.get_matrix(), expected,
+                                             decimal=6)
+        self.assertEqual(store.info["window_kb"], 0.005)
+
+    def test_min_r2(self):
+        """Check that pairs with a low r2 are not stored."""
+        store = compute_ld(self.db, self.experiment.session, self.path,
+                           window_variants=5, min_r2=0.01)
+        self.assertTrue(np.all(store.data ** 2 >= 0.01))
+
+        csr = store.to_csr()
+        self.assertEqual(csr.shape, (len(self.names), len(self.names)))
+        self.assertEqual(csr.nnz, store.data.shape[0])
+
+    def test_subset(self):
+        """Check the LD matrix of a subset of the variants."""
+        selector = VariantSelector(names=self.names[:20])
+        store = compute_ld(self.db, self.experiment.session, self.path,
+                           window_variants=100, selector=selector)
+        self.assertEqual(len(store), 20)
+
+        names = self.names[10:15][::-1]
+        np.testing.assert_array_almost_equal(
+            store.get_matrix(names, r2=True), self._expected(names) ** 2,
+            decimal=6
+        )
+
+        self.assertRaises(ValueError, store.get_matrix, [self.names[50]])
+
+    def test_subset_chunks(self):
+        """Check the rows of a subset selected by many (unsorted) names."""
+        names = list(self.names[:40])
+        random.shuffle(names)
+        selector = VariantSelector(names=names)
+        selector._names_chunk_size = 7
+
+        store = compute_ld(self.db, self.experiment.session, self.path,
+                           window_variants=10, selector=selector)
+        self.assertEqual(list(store.names), list(self.names[:40]))
+
+        names = self.names[20:30]
+        np.testing.assert_array_almost_equal(
+            store.get_matrix(names), self._expected(names), decimal=6
+        )
+
+    def test_no_window(self):
+        """Check that a window is required."""
+        self.assertRaises(ValueError, compute_ld, self.db,
+                          self.experiment.session, self.path)
+
+    def test_prune(self):
+        """Check that the selected variants are not in LD."""
+        store = compute_ld(self.db, self.experiment.session, self.path,
+                           window_variants=10)
+        selected = store.prune(0.002)
+        self.assertTrue(0 < len(selected) < len(self.names))
+        self.assertEqual(selected[0], self.names[0])
+
+        r2 = store.get_matrix(selected, r2=True)
+        self.assertTrue(np.all(r2[np.triu_indices_from(r2, 1)] <= 0.002))
@@ -0,0 +1,86 @@
+# This file is part of forward.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial
+# 4.0 International License. To view a copy of this license, visit
+# http://creativecommons.org/licenses/by-nc/4.0/ or send a letter to Creative
+# Commons, PO Box 1866, Mountain View, CA 94042, USA.
+
+"""
+Tests for the SNP set index.
+"""
+
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from ..snp_set import SNPSetIndex
+
+
+class TestSNPSetIndex(unittest.TestCase):
+    def setUp(self):
+        self.variants = ["snp{}".format(i + 1) for i in range(6)]
+        self.data = pd.DataFrame({
+            "variant": ["snp3", "snp1", "snp2", "snp4", "snp5", "snp6",
+                        "snp6", "rs42", "rs43", "snp1"],
+            "set": ["a", "a", "b", "b", "b", "b", "b", "c", "c", "d"],
+        })
+
+    def test_from_frame(self):
+        index = SNPSetIndex.from_frame(self.data, self.variants)
+
+        # The set 'c' has no analyzed variants.
+        self.assertEqual(list(index.names), ["a", "b", "d"])
+        self.assertEqual(len(index), 3)
+        self.assertEqual(list(index.sizes), [2, 4, 1])
+
+        # The variants are in the order of the analyzed variants and the
+        # duplicates are removed.
+        self.assertEqual(list(index.get_variants(0)), ["snp1", "snp3"])
+        self.assertEqual(list(index.get_variants(1)),
+                         ["snp2", "snp4", "snp5", "snp6"])
+        self.assertEqual(list(index.get_columns(2)), [0])
+
+    def test_subset(self):
+        index = SNPSetIndex.from_frame(self.data, ["snp6", "snp3"])
+        self.assertEqual(list(index.names), ["a", "b"])
+        self.assertEqual(list(index.get_columns(0)), [1])
+        self.assertEqual(list(index.get_columns(1)), [0])
+
+    def test_chunks(self):
+        index = SNPSetIndex.from_frame(self.data, self.variants)
+        self.assertEqual(index.get_chunks(1), [(0, 1), (1, 2), (2, 3)])
+        self.assertEqual(index.get_chunks(3), [(0, 2), (2, 3)])
+        self.assertEqual(index.get_chunks(100), [(0, 3)])
+
+        # All the sets are in a chunk.
+        sizes = np.random.randint(1, 50, size=200)
+        index = SNPSetIndex(np.arange(200), np.arange(sizes.sum()),
+                            np.concatenate(([0], np.cumsum(sizes))),
+                            np.arange(sizes.sum()))
+        chunks = index.get_chunks(100)
+        self.assertEqual(chunks[0][0], 0)
+        self.assertEqual(chunks[-1][1], 200)
+        for (_, end), (start, _) in zip(chunks[:-1], chunks[1:]):
+            self.assertEqual(end, start)
+
+        self.assertEqual(SNPSetIndex.from_frame(self.data, []).get_chunks(5),
+                         [])
+
+    def test_membership(self):
+        index = SNPSetIndex.from_frame(self.data, self.variants)
+
+        columns, membership = index.get_membership()
+        self.assertEqual(list(columns), [0, 1, 2, 3, 4, 5])
+        np.testing.assert_array_equal(membership.toarray(), [
+            [1, 0, 1, 0, 0, 0],
+            [0, 1, 0, 1, 1, 1],
+            [1, 0, 0, 0, 0, 0],
+        ])
+
+        columns, membership = index.get_membership(1, 3)
+        self.assertEqual(list(columns), [0, 1, 3, 4, 5])
+        np.testing.assert_array_equal(membership.toarray(), [
+            [0, 1, 1, 1, 1],
+            [1, 0, 0, 0, 0],
+        ])
@@ -0,0 +1,531 @@
+# This file is part of forward.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial
+# 4.0 International License. To view a copy of this license, visit
+# http://creativecommons.org/licenses/by-nc/4.0/ or send a letter to Creative
+# Commons, PO Box 1866, Mountain View, CA 94042, USA.
+
+from __future__ import division
+
+from pkg_resources import resource_filename
+import unittest
+import tempfile
+import shutil
+import math
+import os
+from fractions import Fraction
+
+import numpy as np
+import scipy.stats
+import scipy.sparse
+
+from ..genotype import PlinkGenotypeDatabase
+from ..ld import compute_ld, ld_correlation
+from ..statistics.utilities import hwe_exact_midp, impute_info
+from ..statistics import (gao, skat, regression, permutation,
+                          multiple_testing)
+from . import dummies
+
+try:
+    import statsmodels.api as sm
+    STATSMODELS_AVAILABLE = True
+except ImportError:  # pragma: no cover
+    STATSMODELS_AVAILABLE = False
+
+
+def hwe_midp_exact_fractions(n_hom1, n_het, n_hom2):
+    """Exact HWE mid p-value computed with rational numbers."""
+    f = math.factorial
+    n = n_hom1 + n_het + n_hom2
+    n_rare = min(2 * n_hom1 + n_het, 2 * n_hom2 + n_het)
+
+    probs = {}
+    for het in range(n_rare % 2, n_rare + 1, 2):
+        hom_rare = (n_rare - het) // 2
+        hom_common = n - het - hom_rare
+        probs[het] = Fraction(
+            f(n) * 2 ** het * f(n_rare) * f(2 * n - n_rare),
+            f(hom_rare) * f(het) * f(hom_common) * f(2 * n)
+        )
+
+    observed = probs[n_het]
+    return float(sum([p for p in probs.values() if p <= observed]) -
+                 observed / 2)
+
+
+class TestHWE(unittest.TestCase):
+    def setUp(self):
+        self.counts = np.array([
+            (10, 5, 1), (0, 3, 20), (30, 40, 30), (1, 0, 10), (5, 20, 3),
+            (0, 0, 10), (100, 20, 300), (250, 500, 250)
+        ])
+
+    def test_exact(self):
+        p = hwe_exact_midp(*self.counts.T)
+        for i, counts in enumerate(self.counts):
+            self.assertAlmostEqual(
+                p[i], hwe_midp_exact_fractions(*counts), places=10
+            )
+
+    def test_batches(self):
+        """The results should not depend on the size of the batches."""
+        np.testing.assert_array_almost_equal(
+            hwe_exact_midp(*self.counts.T),
+            hwe_exact_midp(*self.counts.T, max_cells=10)
+        )
+
+    def test_symmetric(self):
+        np.testing.assert_array_almost_equal(
+            hwe_exact_midp(*self.counts.T),
+            hwe_exact_midp(*self.counts[:, ::-1].T)
+        )
+
+
+class TestImputeInfo(unittest.TestCase):
+    def test_hard_calls(self):
+        """Certain genotypes have an info of 1."""
+        dosage = np.array([[0, 1, 2, 1, np.nan]])
+        self.assertEqual(impute_info(dosage, np.zeros_like(dosage))[0], 1)
+
+    def test_uncertain(self):
+        # Every sample has p = (0.25, 0.5, 0.25).
+        dosage = np.ones((1, 10))
+        variance = np.full((1, 10), 0.5)
+        self.assertAlmostEqual(impute_info(dosage, variance)[0], 0)
+
+    def test_monomorphic(self):
+        dosage = np.zeros((2, 10))
+        dosage[1, :] = np.nan
+        info = impute_info(dosage, np.zeros_like(dosage))
+        self.assertEqual(info[0], 1)
+        self.assertTrue(np.isnan(info[1]))
+
+
+class TestGao(unittest.TestCase):
+    def setUp(self):
+        # 5 independent variables, every one repeated twice.
+        self.x = np.random.normal(size=(100, 5))
+        self.x = np.hstack((self.x, self.x))
+
+    def test_independent(self):
+        corr_mat = np.eye(10)
+        self.assertEqual(gao.correlation_effective_number(corr_mat), 10)
+
+    def test_duplicated(self):
+        corr_mat = np.corrcoef(self.x, rowvar=False)
+        self.assertEqual(gao.correlation_effective_number(corr_mat), 5)
+        self.assertEqual(gao.effective_number(self.x), (10, 5))
+
+    def test_randomized(self):
+        """Both methods agree for a low rank correlation matrix."""
+        x = np.hstack([np.random.normal(size=(500, 20))] * 10)
+        corr_mat = np.corrcoef(x, rowvar=False)
+        self.assertEqual(
+            gao.correlation_effective_number(corr_mat, method="randomized"),
+            gao.correlation_effective_number(corr_mat, method="eigh"),
+        )
+
+    def test_randomized_seed(self):
+        """The randomized eigenvalues are reproducible given a seed."""
+        corr_mat = np.corrcoef(np.random.normal(size=(50, 200)),
+                               rowvar=False)
+        eigenvalues = [
+            gao._randomized_eigenvalues(corr_mat, 20,
+                                        np.random.RandomState(3))
+            for i in range(2)
+        ]
+        np.testing.assert_array_equal(eigenvalues[0], eigenvalues[1])
+
+        n_eff = [
+            gao.correlation_effective_number(corr_mat, variance_t=0.9,
+                                             method="randomized", seed=3)
+            for i in range(2)
+        ]
+        self.assertEqual(n_eff[0], n_eff[1])
+
+    def test_invalid_method(self):
+        self.assertRaises(ValueError, gao.correlation_effective_number,
+                          np.eye(2), method="pca")
+
+    def test_phenotypes(self):
+        path = tempfile.mkdtemp()
+        try:
+            np.save(os.path.join(path, "phen_correlation_matrix.npy"),
+                    np.corrcoef(self.x, rowvar=False))
+            self.assertEqual(gao.phenotype_effective_number(path), (10, 5))
+        finally:
+            shutil.rmtree(path)
+
+
+class TestGaoGenotypes(unittest.TestCase):
+    def setUp(self):
+        self.experiment = dummies.DummyExperiment()
+
+        filename = resource_filename(__name__, "data/simulated/sim.bim")
+        self.db = PlinkGenotypeDatabase(os.path.abspath(filename)[:-4])
+        self.db.experiment_init(self.experiment)
+
+        self.names = [name for name, in self.db.query_variants(
+            self.experiment.session, ["name"]
+        ).order_by("pos")]
+
+    def tearDown(self):
+        self.experiment.clean()
+
+    def _expected(self, block_size):
+        n_eff = 0
+        for i in range(0, len(self.names), block_size):
+            block = self.names[i:(i + block_size)]
+            n_eff += gao.correlation_effective_number(
+                ld_correlation(self.db.get_genotype_block(block))
+            )
+        return n_eff
+
+    def test_blocks(self):
+        results = gao.genotype_effective_number(
+            self.db, self.experiment.session, block_size=30
+        )
+        self.assertEqual(list(results.index), ["1"])
+        self.assertEqual(results.loc["1", "n"], len(self.names))
+        self.assertEqual(results.loc["1", "n_effective"], self._expected(30))
+
+    def test_multiprocessing(self):
+        results = gao.genotype_effective_number(
+            self.db, self.experiment.session, block_size=20, cpu=2
+        )
+        self.assertEqual(results.loc["1", "n_effective"], self._expected(20))
+
+    def test_randomized_multiprocessing(self):
+        """The randomized method gives the same results with workers."""
+        results = [
+            gao.genotype_effective_number(
+                self.db, self.experiment.session, block_size=20,
+                method="randomized", variance_t=0.9, cpu=cpu, seed=5
+            ) for cpu in (1, 3)
+        ]
+        self.assertEqual(results[0].loc["1", "n_effective"],
+                         results[1].loc["1", "n_effective"])
+
+    def test_ld_store(self):
+        store = compute_ld(self.db, self.experiment.session,
+                           os.path.join(self.experiment.name, "ld"),
+                           window_variants=30)
+        results = gao.genotype_effective_number(
+            self.db, self.experiment.session, block_size=30, ld_store=store
+        )
+        self.assertEqual(results.loc["1", "n_effective"], self._expected(30))
+
+
+class TestSKAT(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(42)
+        n = 500
+        self.x = np.vstack((np.ones(n), np.random.normal(size=n))).T
+        self.g = np.random.binomial(2, 0.05, size=(n, 10)).astype(float)
+        self.y = (0.3 * self.x[:, 1] + 0.5 * self.g[:, 0] +
+                  np.random.normal(size=n))
+
+    def test_mixture_equal_weights(self):
+        """A mixture with equal weights is a chi-squared distribution."""
+        for df in (2, 5, 20):
+            for q in (1, 5, 20, 60):
+                self.assertAlmostEqual(
+                    skat.mixture_chi2_pvalue(q, np.ones(df)),
+                    scipy.stats.chi2.sf(q, df), places=8
+                )
+                self.assertAlmostEqual(
+                    skat.liu_pvalue(q, np.ones(df)),
+                    scipy.stats.chi2.sf(q, df)
+                )
+
+    def test_mixture(self):
+        """Compare with the exact distribution of a sum of two exponential
+           variables.
+
+        """
+        # A chi-squared with 2 df is an exponential with a mean of 2.
+        lambdas = np.array([2, 2, 1, 1], dtype=float)
+        for q in (1, 10, 30):
+            expected = 2 * np.exp(-q / 4) - np.exp(-q / 2)
+            self.assertAlmostEqual(skat.mixture_chi2_pvalue(q, lambdas),
+                                   expected, places=8)
+
+        p = skat.mixture_chi2_pvalue(np.array([0, 1, 10]), lambdas)
+        self.assertEqual(p.shape, (3, ))
+        self.assertEqual(p[0], 1)
+
+    def test_skat(self):
+        null_model = skat.SKATNullModel(self.y, self.x)
+        q, p = skat.skat(null_model, self.g)
+
+        # The statistic is the weighted sum of the squared scores.
+        weights = skat.beta_weights(skat.genotype_maf(self.g))
+        residuals = self.y - self.x.dot(
+            np.linalg.lstsq(self.x, self.y, rcond=None)[0]
+        )
+        s2 = residuals.var(ddof=self.x.shape[1])
+        self.assertAlmostEqual(
+            q / (np.sum((residuals.dot(self.g) * weights) ** 2) / (2 * s2)), 1
+        )
+        self.assertTrue(0 < p < 0.05)
+
+    def test_skat_o(self):
+        null_model = skat.SKATNullModel(self.y, self.x)
+        p, p_rho = skat.skat_o(null_model, self.g)
+        self.assertEqual(p_rho.shape, (len(skat.SKAT_O_RHO), ))
+        self.assertAlmostEqual(p_rho[0], skat.skat(null_model, self.g)[1])
+        self.assertTrue(np.min(p_rho) <= p <= 1)
+
+    def test_sparse(self):
+        """Sparse genotypes give the same results."""
+        null_model = skat.SKATNullModel(self.y, self.x)
+        g = scipy.sparse.csc_matrix(self.g)
+
+        np.testing.assert_allclose(null_model.kernel(g),
+                                   null_model.kernel(self.g))
+        np.testing.assert_allclose(skat.skat(null_model, g),
+                                   skat.skat(null_model, self.g))
+        self.assertAlmostEqual(skat.skat_o(null_model, g, rho=(0, 1))[0],
+                               skat.skat_o(null_model, self.g, rho=(0, 1))[0])
+
+    def test_kernel(self):
+        null_model = skat.SKATNullModel(self.y, self.x)
+        z1 = null_model.project(self.g)
+        np.testing.assert_allclose(null_model.kernel(self.g), z1.T.dot(z1),
+                                   atol=1e-8)
+
+    def test_logistic_null_model(self):
+        y = (self.y > np.median(self.y)).astype(float)
+        null_model = skat.SKATNullModel(y, self.x, "D")
+
+        # The score equations are solved at the MLE.
+        self.assertTrue(np.allclose(self.x.T.dot(y - null_model.mu), 0))
+        self.assertTrue(np.allclose(null_model.v,
+                                    null_model.mu * (1 - null_model.mu)))
+
+        p = skat.skat(null_model, self.g)[1]
+        self.assertTrue(0 < p <= 1)
+
+
+@unittest.skipIf(not STATSMODELS_AVAILABLE, "statsmodels needs to be installed"
+                                            " to test the regressions.")
+class TestRegression(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(42)
+        n = 400
+        self.x = np.vstack((np.ones(n), np.random.normal(size=n))).T
+        self.g = np.random.binomial(2, 0.2, size=(n, 20)).astype(float)
+
+        # A constant predictor can't be tested.
+        self.g[:, 3] = 1
+
+        eta = self.x[:, 1] + 0.5 * self.g[:, 0] - 0.5
+        self.y = eta + np.random.normal(size=n)
+        self.y_binary = (np.random.random(n) < 1 / (1 + np.exp(-eta)))
+        self.y_binary = self.y_binary.astype(float)
+
+    def _compare(self, results, fit, j, places=7):
+        self.assertAlmostEqual(results["coefficient"][j], fit.params[-1],
+                               places=places)
+        self.assertAlmostEqual(results["standard_error"][j], fit.bse[-1],
+                               places=places)
+        self.assertAlmostEqual(results["test_statistic"][j], fit.tvalues[-1],
+                               places=places)
+        self.assertAlmostEqual(results["significance"][j], fit.pvalues[-1],
+                               places=places)
+        self.assertAlmostEqual(results["confidence_interval_min"][j],
+                               fit.conf_int()[-1, 0], places=places)
+
+    def test_linear(self):
+        results = regression.linear_test(self.y, self.x, self.g)
+        for j in (0, 1, 10):
+            x = np.hstack((self.x, self.g[:, [j]]))
+            self._compare(results, sm.OLS(self.y, x).fit(), j)
+
+        self.assertTrue(np.isnan(results["significance"][3]))
+
+    def test_logistic(self):
+        results = regression.logistic_test(self.y_binary, self.x, self.g)
+        for j in (0, 1, 10):
+            x = np.hstack((self.x, self.g[:, [j]]))
+            fit = sm.GLM(self.y_binary, x,
+                         family=sm.families.Binomial()).fit(tol=1e-12)
+            self._compare(results, fit, j, places=5)
+
+        self.assertTrue(np.isnan(results["significance"][3]))
+
+
+class TestPermutation(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(42)
+        n = 200
+        self.x = np.vstack((np.ones(n), np.random.normal(size=n))).T
+        self.g = np.random.binomial(2, 0.3, size=(n, 12)).astype(float)
+        self.g[np.random.random(self.g.shape) < 0.02] = np.nan
+        self.g[:, 5] = 1  # Monomorphic.
+
+        self.y = self.x[:, 1] + np.random.normal(size=n)
+        self.y[:10] = np.nan
+
+    def test_max_t(self):
+        permutations = permutation.SamplePermutations(200, 20, seed=1,
+                                                      block_size=7)
+        max_t = permutation.LinearMaxT(self.y, self.x, permutations)
+        max_t.update(self.g[:, :4])
+        max_t.update(self.g[:, 4:])
+
+        # Fit every permutation separately.
+        keep = ~np.isnan(self.y)
+        x = self.x[keep]
+        g = self.g[keep]
+        g = np.where(np.isnan(g), np.nanmean(g, axis=0), g)
+        y = self.y[keep]
+        residuals = y - np.dot(x, np.linalg.lstsq(x, y, rcond=None)[0])
+
+        permutations = max_t.get_permutations(0, 20)
+        for b in range(20):
+            results = regression.linear_test(
+                residuals[permutations[:, b]], x, g
+            )
+            self.assertAlmostEqual(
+                max_t.max_t[b], np.nanmax(np.abs(results["test_statistic"]))
+            )
+            self.assertAlmostEqual(
+                max_t.min_p[b], np.nanmin(results["significance"])
+            )
+
+    def test_permutations(self):
+        permutations = permutation.SamplePermutations(200, 20, seed=1,
+                                                      block_size=8)
+        keep = ~np.isnan(self.y)
+        subset = permutations.get_permutations(keep, 0, 20)
+        self.assertEqual(subset.shape, (190, 20))
+
+        orders = np.hstack([permutations.get_orders(i) for i in range(3)])
+        self.assertEqual(orders.shape, (200, 20))
+
+        for b in range(20):
+            self.assertEqual(sorted(subset[:, b]), list(range(190)))
+
+            # The samples of the subset are in the order of the complete
+            # permutation.
+            self.assertEqual(list(np.flatnonzero(keep)[subset[:, b]]),
+                             [i for i in orders[:, b] if keep[i]])
+
+        # The permutations only depend on the seed (and the blocks), also
+        # across the blocks.
+        other = permutation.SamplePermutations(200, 10, seed=1, block_size=8)
+        np.testing.assert_array_equal(
+            other.get_permutations(keep, 5, 10), subset[:, 5:10]
+        )
+
+    @unittest.skipIf(not STATSMODELS_AVAILABLE, "statsmodels needs to be "
+                                                "installed to fit the null "
+                                                "model.")
+    def test_adaptive_score(self):
+        y = (self.y > 0).astype(float)
+        y[:10] = np.nan
+        score = permutation.LogisticScorePermutations(
+            y, self.x, seed=1, max_permutations=300, max_exceedances=10,
+            block_size=200
+        )
+        p, n = score.p_values(self.g)
+
+        # The monomorphic variant is not tested.
+        self.assertTrue(np.isnan(p[5]))
+        self.assertEqual(n[5], 0)
+
+        # The score statistics using the null model fitted by statsmodels.
+        keep = ~np.isnan(y)
+        x = self.x[keep]
+        g = self.g[keep]
+        g = np.where(np.isnan(g), np.nanmean(g, axis=0), g)
+        mu = sm.GLM(y[keep], x, family=sm.families.Binomial()).fit().mu
+        w = np.sqrt(mu * (1 - mu))[:, np.newaxis]
+        g -= np.dot(x, np.linalg.lstsq(x * w, g * w, rcond=None)[0])
+        residuals = y[keep] - mu
+
+        # Batches of 100 and 200 permutations.
+        permutations = np.hstack((score.get_permutations(0, 100),
+                                  score.get_permutations(1, 200)))
+        for j in range(self.g.shape[1]):
+            if j == 5:
+                continue
+
+            observed = np.abs(np.dot(g[:, j], residuals))
+            u = np.abs(np.dot(g[:, j], residuals[permutations]))
+            exceedances = np.cumsum(u >= observed * (1 - 1e-8))
+
+            if exceedances[99] >= 10:
+                self.assertEqual(n[j], 100)
+                self.assertAlmostEqual(p[j], exceedances[99] / 100)
+            else:
+                self.assertEqual(n[j], 300)
+                h = exceedances[-1]
+                expected = h / 300 if h >= 10 else (h + 1) / 301
+                self.assertAlmostEqual(p[j], expected)
+
+    def test_empirical_threshold(self):
+        min_p = np.linspace(0.001, 1, 1000)[::-1]
+        self.assertAlmostEqual(
+            permutation.empirical_threshold(min_p, 0.05), 0.05
+        )
+        self.assertEqual(permutation.empirical_threshold(min_p[:10], 0.05), 0)
+
+    def test_adjusted_p_values(self):
+        min_p = np.array([0.01, 0.02, 0.2, 0.5])
+        adjusted = permutation.adjusted_p_values(
+            [0.001, 0.02, 0.3, np.nan], min_p
+        )
+        np.testing.assert_allclose(adjusted[:3], [0.2, 0.6, 0.8])
+        self.assertTrue(np.isnan(adjusted[3]))
+
+
+class TestMultipleTesting(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(42)
+        self.p = np.random.uniform(size=100) ** 3
+        self.p[[5, 50]] = np.nan
+
+    def test_bh(self):
+        adjusted = multiple_testing.bh_adjusted_p_values(self.p)
+        self.assertTrue(np.all(np.isnan(adjusted[[5, 50]])))
+
+        # The definition (m p_(j) / j minimized over the larger p-values).
+        p = self.p[~np.isnan(self.p)]
+        m = p.shape[0]
+        ranks = scipy.stats.rankdata(p, method="max")
+        expected = [min(1, min(p[j] * m / ranks[j] for j in range(m)
+                               if p[j] >= p[i]))
+                    for i in range(m)]
+        np.testing.assert_allclose(adjusted[~np.isnan(self.p)], expected)
+
+    @unittest.skipIf(not STATSMODELS_AVAILABLE, "statsmodels needs to be "
+                                                "installed to compare the "
+                                                "corrections.")
+    def test_bh_statsmodels(self):
+        from statsmodels.stats.multitest import multipletests
+
+        tested = ~np.isnan(self.p)
+        _, expected, _, _ = multipletests(self.p[tested], method="fdr_bh")
+        np.testing.assert_allclose(
+            multiple_testing.bh_adjusted_p_values(self.p)[tested], expected
+        )
+
+    def test_q_values(self):
+        p = self.p[~np.isnan(self.p)]
+        pi0 = np.sum(p > 0.5) / (0.5 * p.shape[0])
+        self.assertAlmostEqual(multiple_testing.storey_pi0(self.p), pi0)
+
+        np.testing.assert_allclose(
+            multiple_testing.q_values(self.p),
+            pi0 * multiple_testing.bh_adjusted_p_values(self.p)
+        )
+
+        # The proportion of true null hypotheses is at most 1.
+        self.assertEqual(multiple_testing.storey_pi0([0.9, 0.95]), 1)
+        self.assertEqual(multiple_testing.storey_pi0([np.nan]), 1)
+
+    def test_no_tests(self):
+        adjusted = multiple_testing.q_values([np.nan, np.nan])
+        self.assertTrue(np.all(np.isnan(adjusted)))
@@ -14,19 +14,43 @@ from __future__ import division
 from pkg_resources import resource_filename
 import unittest
 import shutil
+import tempfile
+import collections
 import random
 import os
 
 import pandas as pd
 import numpy as np
 
-from ..tasks import LogisticTest, STATSMODELS_AVAILABLE
+from ..tasks import (LogisticTest, LogisticTestResults, LinearMixedTest,
+                     LinearMixedTestResults, SKATTest, BurdenTest, ACATTest,
+                     LinearTest, STATSMODELS_AVAILABLE)
+from ..grm import compute_grm
+from ..annotation import GeneAnnotation
+from ..statistics import lmm, skat, permutation
 from ..experiment import Experiment, ExperimentResult
 from ..phenotype.variables import ContinuousVariable, DiscreteVariable
-from ..genotype import Variant, PlinkGenotypeDatabase
+from ..genotype import Variant, VariantSelector, PlinkGenotypeDatabase
+from ..utils import check_rpy2
 from .dummies import DummyPhenDatabase, DummyGenotypeDatabase, DummyTask
 from .abstract_tests import TestAbstractTask
 
+if STATSMODELS_AVAILABLE:
+    import statsmodels.api as sm
+
+
+def _skat_r_available():
+    """Check if rpy2 and the SKAT R package are installed."""
+    if not check_rpy2():
+        return False
+    try:
+        return SKATTest.check_skat()
+    except Exception:
+        return False
+
+
+SKAT_R_AVAILABLE = _skat_r_available()
+
 
 class TestTask(TestAbstractTask, unittest.TestCase):
     def setUp(self):
@@ -60,6 +84,9 @@ class TestLogisticTask(TestAbstractTask, unittest.TestCase):
         )
 
     def tearDown(self):
+        # An open transaction would delete the journal of the next test's
+        # database (same path) when it is garbage collected.
+        self.experiment.session.close()
         shutil.rmtree(".fwd_test_tasks")
 
     def test_exec(self):
@@ -87,6 +114,80 @@ class TestLogisticTask(TestAbstractTask, unittest.TestCase):
             elif isinstance(var, ContinuousVariable):
                 self.assertTrue(var.name not in results_variables)
 
+    def test_variants_regions(self):
+        """Check that only the variants in the regions are tested."""
+        variants = self.experiment.session.query(Variant).all()
+        selected = variants[:2]
+        regions = ["{}:{}-{}".format(v.chrom, v.pos, v.pos) for v in selected]
+
+        task = LogisticTest(variants={"regions": regions})
+        self.experiment.tasks = [task]
+        self.experiment.run_tasks()
+
+        query = self.experiment.session.query
+        tested = query(ExperimentResult.entity_name).distinct().all()
+        self.assertEqual(set([i[0] for i in tested]),
+                         set([v.name for v in selected]))
+
+    def test_variants_selection(self):
+        """Check that the MAF range and names criteria are combined."""
+        variants = self.experiment.session.query(Variant).all()
+        mafs = sorted([v.maf for v in variants])
+        maf_range = [mafs[1], mafs[-2]]
+        names = [v.name for v in variants[:-1]]
+
+        expected = set([
+            v.name for v in variants
+            if maf_range[0] <= v.maf <= maf_range[1] and v.name in names
+        ])
+
+        task = LogisticTest(variants={"maf": maf_range, "names": names})
+        self.experiment.tasks = [task]
+        self.experiment.run_tasks()
+
+        query = self.experiment.session.query
+        tested = query(ExperimentResult.entity_name).distinct().all()
+        self.assertEqual(set([i[0] for i in tested]), expected)
+
+    def test_variants_names_order(self):
+        """Check the order of the variants selected by many names."""
+        session = self.experiment.session
+        n = 3 * VariantSelector._names_chunk_size - 300
+        session.add_all([
+            Variant(name="var_order{}".format(i), chrom="1", pos=i + 1)
+            for i in range(n)
+        ])
+        session.commit()
+
+        names = ["var_order{}".format(i) for i in range(n)]
+        random.shuffle(names)
+        selector = VariantSelector(names=names)
+
+        expected = ["var_order{}".format(i) for i in range(n)]
+        self.assertEqual(selector.get_variants(session), expected)
+        self.assertEqual(
+            [v.name for v in selector.query(session)], expected
+        )
+        self.assertEqual(
+            selector.query(session, [Variant.name, Variant.pos])[:2],
+            [("var_order0", 1), ("var_order1", 2)]
+        )
+
+    def test_variants_invalid_selection(self):
+        """Check that unknown selection criteria raise an error."""
+        task = LogisticTest(variants={"beta": 0.8})
+        self.experiment.tasks = [task]
+        self.assertRaises(ValueError, self.experiment.run_tasks)
+
+    def test_results_type(self):
+        """Without permutations, the results are generic results."""
+        self.experiment.run_tasks()
+
+        query = self.experiment.session.query
+        types = set(i for i, in query(ExperimentResult.results_type))
+        self.assertEqual(types, {"GenericResults"})
+        self.assertEqual(query(LogisticTestResults).count(), 0)
+
     def test_results(self):
         self.tearDown()  # We need another custom experiment.
 
@@ -146,3 +247,585 @@ class TestLogisticTask(TestAbstractTask, unittest.TestCase):
 class TestLogisticTaskMultiprocessing(TestLogisticTask):
     def setUp(self):
         super(TestLogisticTaskMultiprocessing, self).setUp(3)
+
+
+@unittest.skipIf(not STATSMODELS_AVAILABLE, "statsmodels needs to be installed"
+                                            " to test the logistic task.")
+class TestLogisticTaskPermutations(TestAbstractTask, unittest.TestCase):
+    def setUp(self):
+        self.task = LogisticTest(covariates=["var5"],
+                                 adaptive_permutations=500,
+                                 permutation_seed=3)
+        super(TestLogisticTaskPermutations, self).setUp()
+
+    def _check_results(self):
+        results = self.experiment.session.query(LogisticTestResults).all()
+        self.assertEqual(len(results), 10)
+        for result in results:
+            self.assertEqual(result.results_type, "LogisticTest")
+
+        self.assertEqual(self.task.get_meta("adaptive_permutations"), 500)
+        self.assertEqual(self.task.get_meta("permutation_seed"), 3)
+
+        phenotypes = self.experiment.phenotypes
+        variants = ["snp{}".format(i + 1) for i in range(5)]
+        g = self.experiment.genotypes.get_genotype_block(variants)
+        covar = phenotypes.get_phenotype_vector(ContinuousVariable("var5"))
+        x = np.vstack((np.ones_like(covar), covar)).T
+
+        for name in ("var3", "var4"):
+            y = phenotypes.get_phenotype_vector(DiscreteVariable(name))
+            p, n = permutation.LogisticScorePermutations(
+                y, x, 3, 500
+            ).p_values(g)
+
+            for variant, variant_p, variant_n in zip(variants, p, n):
+                result, = [i for i in results if i.phenotype == name and
+                           i.entity_name == variant]
+                self.assertAlmostEqual(result.empirical_significance,
+                                       variant_p)
+                self.assertEqual(result.permutations, variant_n)
+
+    def test_permutations(self):
+        self.experiment.run_tasks()
+        self._check_results()
+
+    def test_multiprocessing(self):
+        self.experiment.cpu = 2
+        self.experiment.run_tasks()
+        self._check_results()
+
+    def test_linear(self):
+        self.assertRaises(ValueError, LinearTest, adaptive_permutations=10)
+
+
+@unittest.skipIf(not STATSMODELS_AVAILABLE, "statsmodels needs to be installed"
+                                            " to test the linear task.")
+class TestLinearTaskPermutations(TestAbstractTask, unittest.TestCase):
+    def setUp(self):
+        self.task = LinearTest(covariates=["var5"], permutations=50,
+                               permutation_seed=3)
+        super(TestLinearTaskPermutations, self).setUp()
+
+    def test_permutations(self):
+        self.experiment.run_tasks()
+
+        min_p = self.task.get_meta("permutation_min_p")
+        self.assertEqual(len(min_p), 50)
+        self.assertEqual(self.task.get_meta("permutations"), 50)
+        self.assertEqual(self.task.get_meta("empirical_threshold"),
+                         permutation.empirical_threshold(min_p, 0.05))
+
+        # The minimum over the outcomes (using the same permutations).
+        phenotypes = self.experiment.phenotypes
+        variants = ["snp{}".format(i + 1) for i in range(5)]
+        g = self.experiment.genotypes.get_genotype_block(variants)
+        covar = phenotypes.get_phenotype_vector(ContinuousVariable("var5"))
+        x = np.vstack((np.ones_like(covar), covar)).T
+        permutations = permutation.SamplePermutations(
+            x.shape[0], 50, 3, block_size=LinearTest.permutation_block_size
+        )
+
+        expected = []
+        for name in ("var1", "var2"):
+            y = phenotypes.get_phenotype_vector(ContinuousVariable(name))
+            max_t = permutation.LinearMaxT(y, x, permutations)
+            max_t.update(g)
+            expected.append(max_t.min_p)
+
+        np.testing.assert_allclose(min_p, np.min(expected, axis=0))
+
+
+class TestSKATTask(TestAbstractTask, unittest.TestCase):
+    def setUp(self):
+        fd, self.snp_set_file = tempfile.mkstemp()
+        with os.fdopen(fd, "w") as f:
+            f.write("variant\tset\n")
+            for variant, set_name in [("snp1", "set1"), ("snp2", "set1"),
+                                      ("snp3", "set1"), ("snp4", "set2"),
+                                      ("snp5", "set2")]:
+                f.write("{}\t{}\n".format(variant, set_name))
+
+        self.task = SKATTest(snp_set_file=self.snp_set_file, engine="numpy",
+                             covariates=["var5"])
+        super(TestSKATTask, self).setUp()
+
+    def tearDown(self):
+        os.remove(self.snp_set_file)
+        super(TestSKATTask, self).tearDown()
+
+    def _results(self):
+        return self.experiment.session.query(ExperimentResult).filter(
+            ExperimentResult.tested_entity == "snp-set"
+        ).all()
+
+    def test_invalid_engine(self):
+        self.assertRaises(ValueError, SKATTest,
+                          snp_set_file=self.snp_set_file, engine="C")
+
+    def test_numpy_engine(self):
+        self.experiment.run_tasks()
+        results = self._results()
+
+        # 2 sets for the 4 outcomes.
+        self.assertEqual(len(results), 8)
+
+        phenotypes = self.experiment.phenotypes
+        y = phenotypes.get_phenotype_vector(ContinuousVariable("var1"))
+        covar = phenotypes.get_phenotype_vector(ContinuousVariable("var5"))
+        g = np.array([
+            self.experiment.genotypes.get_genotypes("snp{}".format(i + 1))
+            for i in range(3)
+        ]).T
+        keep = ~(np.isnan(y) | np.isnan(covar) | np.isnan(g).any(axis=1))
+
+        x = np.vstack((np.ones(keep.sum()), covar[keep])).T
+        q, p = skat.skat(skat.SKATNullModel(y[keep], x), g[keep, :])
+
+        result, = [i for i in results
+                   if i.phenotype == "var1" and i.entity_name == "set1"]
+        self.assertAlmostEqual(result.test_statistic, q)
+        self.assertAlmostEqual(result.significance, p)
+
+    def test_null_models(self):
+        """Null models are shared by the sets with the same samples."""
+        self.experiment.run_tasks()
+
+        phenotypes = self.experiment.phenotypes
+        genotypes = self.experiment.genotypes
+        covar = phenotypes.get_phenotype_vector(ContinuousVariable("var5"))
+
+        expected = 0
+        for phenotype in self.task.outcomes:
+            y = phenotypes.get_phenotype_vector(phenotype)
+            masks = set()
+            for variants in (("snp1", "snp2", "snp3"), ("snp4", "snp5")):
+                g = np.array([genotypes.get_genotypes(i) for i in variants])
+                missing = np.isnan(y) | np.isnan(covar) | np.isnan(g).any(0)
+                masks.add(missing.tobytes())
+            expected += len(masks)
+
+        self.assertEqual(self.task.n_null_models, expected)
+
+        # Only the null models without missing genotypes are kept.
+        for phenotype, not_missing in self.task._null_models:
+            y = phenotypes.get_phenotype_vector(
+                ContinuousVariable(phenotype)
+            )
+            missing = np.isnan(y) | np.isnan(covar)
+            self.assertEqual(not_missing, (~missing).tobytes())
+
+    def test_impute(self):
+        """Missing genotypes are mean imputed (one null model by outcome)."""
+        self.task.impute = True
+        self.experiment.run_tasks()
+        self.assertEqual(self.task.n_null_models, 4)
+
+        # Every set is tested using all the samples.
+        phenotypes = self.experiment.phenotypes
+        y = phenotypes.get_phenotype_vector(ContinuousVariable("var1"))
+        covar = phenotypes.get_phenotype_vector(ContinuousVariable("var5"))
+        keep = ~(np.isnan(y) | np.isnan(covar))
+
+        g = np.array([
+            self.experiment.genotypes.get_genotypes("snp{}".format(i + 4))
+            for i in range(2)
+        ]).T[keep, :]
+        g = np.where(np.isnan(g), np.nanmean(g, axis=0), g)
+
+        x = np.vstack((np.ones(keep.sum()), covar[keep])).T
+        q, p = skat.skat(skat.SKATNullModel(y[keep], x), g)
+
+        result, = [i for i in self._results()
+                   if i.phenotype == "var1" and i.entity_name == "set2"]
+        self.assertAlmostEqual(result.test_statistic, q)
+
+    def test_skat_o(self):
+        self.task.skat_o = True
+        self.experiment.run_tasks()
+
+        for result in self._results():
+            self.assertTrue(result.test_statistic is None)
+            self.assertTrue(0 < result.significance <= 1)
+
+
+class TestSKATTaskMultiprocessing(TestSKATTask):
+    """Test the sets by chunks (of a single set) using 2 processes."""
+    def setUp(self):
+        super(TestSKATTaskMultiprocessing, self).setUp()
+        self.experiment.cpu = 2
+        self.task.block_size = 1
+
+
+class TestSKATTaskSparse(TestSKATTask):
+    """Test the sets using the sparse genotype matrix."""
+    def setUp(self):
+        super(TestSKATTaskSparse, self).setUp()
+        self.experiment.genotypes.sparse_maf(0.5)
+        self.experiment.genotypes.sparse_init(self.experiment)
+
+    def test_sparse_genotypes(self):
+        names = ["snp{}".format(i + 1) for i in range(5)]
+        self.assertTrue(self.experiment.genotypes.is_sparse(names).all())
+
+
+@unittest.skipUnless(SKAT_R_AVAILABLE, "rpy2 and the SKAT R package need to "
+                                       "be installed to compare the engines.")
+class TestSKATTaskEngines(TestAbstractTask, unittest.TestCase):
+    """Compare the numpy implementation of SKAT with the R package."""
+    def setUp(self):
+        fd, self.snp_set_file = tempfile.mkstemp()
+        with os.fdopen(fd, "w") as f:
+            f.write("variant\tset\n")
+            for variant, set_name in [("snp1", "set1"), ("snp2", "set1"),
+                                      ("snp3", "set1"), ("snp4", "set2"),
+                                      ("snp5", "set2")]:
+                f.write("{}\t{}\n".format(variant, set_name))
+
+        # The R package adjusts the binary outcomes for small samples, so
+        # only the continuous outcomes are compared.
+        self.task = SKATTest(snp_set_file=self.snp_set_file, engine="R",
+                             covariates=["var5"], outcomes=["var1", "var2"])
+        super(TestSKATTaskEngines, self).setUp()
+
+        self.experiment.tasks.append(SKATTest(
+            snp_set_file=self.snp_set_file, engine="numpy",
+            covariates=["var5"], outcomes=["var1", "var2"],
+        ))
+
+    def tearDown(self):
+        os.remove(self.snp_set_file)
+        super(TestSKATTaskEngines, self).tearDown()
+
+    def _results(self):
+        """Get the results of the R and of the numpy tasks."""
+        self.experiment.run_tasks()
+
+        results = collections.defaultdict(dict)
+        query = self.experiment.session.query(ExperimentResult).filter(
+            ExperimentResult.tested_entity == "snp-set"
+        )
+        for result in query:
+            results[result.task_name][(result.entity_name,
+                                       result.phenotype)] = (
+                result.test_statistic, result.significance
+            )
+
+        # The R task is the first task.
+        r_results, numpy_results = [results[name] for name in sorted(results)]
+        self.assertEqual(len(r_results), 4)
+        self.assertEqual(set(r_results), set(numpy_results))
+
+        return r_results, numpy_results
+
+    def test_skat(self):
+        r_results, numpy_results = self._results()
+        for key, (q, p) in r_results.items():
+            numpy_q, numpy_p = numpy_results[key]
+            np.testing.assert_allclose(numpy_q, q, rtol=1e-6)
+
+            # Davies' method (R) and Imhof's method (numpy) are both exact up
+            # to their integration error.
+            np.testing.assert_allclose(numpy_p, p, rtol=1e-3)
+
+    def test_skat_o(self):
+        for task in self.experiment.tasks:
+            task.skat_o = True
+
+        r_results, numpy_results = self._results()
+        for key, (q, p) in r_results.items():
+            self.assertTrue(numpy_results[key][0] is None)
+            np.testing.assert_allclose(numpy_results[key][1], p, rtol=1e-2)
+
+
+@unittest.skipIf(not STATSMODELS_AVAILABLE, "statsmodels needs to be installed"
+                                            " to test the burden task.")
+class TestBurdenTask(TestAbstractTask, unittest.TestCase):
+    def setUp(self):
+        fd, self.snp_set_file = tempfile.mkstemp()
+        with os.fdopen(fd, "w") as f:
+            f.write("variant set\n")
+            for variant, set_name in [("snp1", "set1"), ("snp2", "set1"),
+                                      ("snp3", "set1"), ("snp4", "set2"),
+                                      ("snp5", "set2"), ("snp1", "set3")]:
+                f.write("{} {}\n".format(variant, set_name))
+
+        self.task = BurdenTest(snp_set_file=self.snp_set_file,
+                               covariates=["var5"])
+
+        # The dummy samples are shuffled, some orders separate the var3 cases
+        # by the set2 carriers (see test_separated_logistic).
+        random.seed(0)
+        super(TestBurdenTask, self).setUp()
+
+    def tearDown(self):
+        os.remove(self.snp_set_file)
+        super(TestBurdenTask, self).tearDown()
+
+    def _burden(self, variants, weights=True):
+        g = np.array([
+            self.experiment.genotypes.get_genotypes(i) for i in variants
+        ]).T
+        g = np.where(np.isnan(g), np.nanmean(g, axis=0), g)
+        if weights:
+            g = g * skat.beta_weights(skat.genotype_maf(g))
+        return g.sum(axis=1)
+
+    def _fit(self, phenotype, burden, logistic=False):
+        phenotypes = self.experiment.phenotypes
+        y = phenotypes.get_phenotype_vector(phenotype)
+        covar = phenotypes.get_phenotype_vector(ContinuousVariable("var5"))
+        keep = ~(np.isnan(y) | np.isnan(covar))
+
+        x = np.vstack((np.ones(keep.sum()), covar[keep], burden[keep])).T
+        if logistic:
+            return sm.GLM(y[keep], x,
+                          family=sm.families.Binomial()).fit(tol=1e-12)
+        return sm.OLS(y[keep], x).fit()
+
+    def _result(self, phenotype, set_name):
+        result, = self.experiment.session.query(ExperimentResult).filter(
+            ExperimentResult.phenotype == phenotype,
+            ExperimentResult.entity_name == set_name
+        ).all()
+        self.assertEqual(result.tested_entity, "snp-set")
+        return result
+
+    def test_invalid_burden(self):
+        self.assertRaises(ValueError, BurdenTest,
+                          snp_set_file=self.snp_set_file, burden="sum")
+
+    def test_weighted_linear(self):
+        self.experiment.run_tasks()
+        self.assertEqual(
+            self.experiment.session.query(ExperimentResult).count(), 12
+        )
+
+        fit = self._fit(ContinuousVariable("var1"),
+                        self._burden(["snp1", "snp2", "snp3"]))
+        result = self._result("var1", "set1")
+        self.assertAlmostEqual(result.coefficient, fit.params[-1])
+        self.assertAlmostEqual(result.standard_error, fit.bse[-1])
+        self.assertAlmostEqual(result.significance, fit.pvalues[-1])
+
+    def test_cast_logistic(self):
+        self.task.burden = "cast"
+        self.task.weights = "none"
+        self.experiment.run_tasks()
+
+        burden = (self._burden(["snp4", "snp5"], weights=False) > 0)
+        fit = self._fit(DiscreteVariable("var3"), burden.astype(float),
+                        logistic=True)
+        result = self._result("var3", "set2")
+        self.assertAlmostEqual(result.coefficient, fit.params[-1], places=5)
+        self.assertAlmostEqual(result.standard_error, fit.bse[-1], places=5)
+        self.assertAlmostEqual(result.test_statistic, fit.tvalues[-1],
+                               places=5)
+
+    def test_separated_logistic(self):
+        # All the cases are carriers (complete separation).
+        self.task.burden = "cast"
+        self.task.weights = "none"
+        burden = (self._burden(["snp4", "snp5"], weights=False) > 0)
+        self.experiment.phenotypes.data["var3"] = burden.astype(float)
+        self.experiment.run_tasks()
+
+        result = self._result("var3", "set2")
+        self.assertIsNone(result.coefficient)
+        self.assertIsNone(result.standard_error)
+        self.assertIsNone(result.significance)
+
+    def test_gene_sets(self):
+        # The variants are on chromosome 1 (snp1 at 1000, snp2 at 2000, ...).
+        for i in range(5):
+            self.experiment.session.query(Variant).filter(
+                Variant.name == "snp{}".format(i + 1)
+            ).update({"chrom": "1", "pos": (i + 1) * 1000})
+
+        genes = GeneAnnotation(["chr1", "1", "2"], [1000, 4500, 1000],
+                               [2000, 4600, 5000], ["GA", "GB", "GC"])
+        self.task.snp_set = None
+        self.task.genes = genes
+        self.task.gene_flank = 500
+        self.experiment.run_tasks()
+
+        self.assertEqual(
+            {i.entity_name for i in
+             self.experiment.session.query(ExperimentResult).all()},
+            {"GA", "GB"}
+        )
+
+        fit = self._fit(ContinuousVariable("var1"),
+                        self._burden(["snp1", "snp2"]))
+        result = self._result("var1", "GA")
+        self.assertAlmostEqual(result.coefficient, fit.params[-1])
+
+
+class TestBurdenTaskSparse(TestBurdenTask):
+    """Test the burden scores using the sparse genotype matrix."""
+    def setUp(self):
+        super(TestBurdenTaskSparse, self).setUp()
+        self.experiment.genotypes.sparse_maf(0.5)
+        self.experiment.genotypes.sparse_init(self.experiment)
+        self.task.block_size = 2
+
+
+@unittest.skipIf(not STATSMODELS_AVAILABLE, "statsmodels needs to be installed"
+                                            " to test the ACAT task.")
+class TestACATTask(TestAbstractTask, unittest.TestCase):
+    def setUp(self):
+        fd, self.snp_set_file = tempfile.mkstemp()
+        with os.fdopen(fd, "w") as f:
+            f.write("variant set\n")
+            for variant, set_name in [("snp1", "set1"), ("snp2", "set1"),
+                                      ("snp3", "set1"), ("snp4", "set2"),
+                                      ("snp5", "set2")]:
+                f.write("{} {}\n".format(variant, set_name))
+
+        self.task = ACATTest(snp_set_file=self.snp_set_file)
+        super(TestACATTask, self).setUp()
+
+        self.experiment.tasks = [LinearTest(), LogisticTest(), self.task]
+
+    def tearDown(self):
+        os.remove(self.snp_set_file)
+        super(TestACATTask, self).tearDown()
+
+    def _results(self, task_name):
+        return self.experiment.session.query(ExperimentResult).filter(
+            ExperimentResult.task_name == task_name
+        ).all()
+
+    def test_combination(self):
+        self.experiment.run_tasks()
+
+        results = self._results("task2_ACATTest")
+        self.assertEqual(len(results), 8)
+        self.assertEqual({i.tested_entity for i in results}, {"snp-set"})
+
+        variant_results = {
+            i.entity_name: i.significance
+            for i in self._results("task1_LogisticTest")
+            if i.phenotype == "var3"
+        }
+        mafs = dict(self.experiment.session.query(
+            Variant.name, Variant.mac / (2.0 * Variant.n_non_missing)
+        ).all())
+
+        variants = ["snp1", "snp2", "snp3"]
+        p = np.array([variant_results[i] for i in variants])
+        maf = np.array([mafs[i] for i in variants])
+        w = skat.beta_weights(maf) ** 2 * maf * (1 - maf)
+        t = np.sum(w * np.tan((0.5 - p) * np.pi)) / np.sum(w)
+
+        result, = [i for i in results
+                   if i.phenotype == "var3" and i.entity_name == "set1"]
+        self.assertAlmostEqual(result.test_statistic, t)
+        self.assertAlmostEqual(result.significance, 0.5 - np.arctan(t) / np.pi)
+
+    def test_single_variant(self):
+        """The combination of a single p-value is the p-value."""
+        self.task.snp_set = pd.DataFrame({"variant": ["snp2"],
+                                          "set": ["set1"]})
+        self.experiment.run_tasks()
+
+        expected = {
+            i.phenotype: i.significance
+            for i in (self._results("task0_LinearTest") +
+                      self._results("task1_LogisticTest"))
+            if i.entity_name == "snp2"
+        }
+        for result in self._results("task2_ACATTest"):
+            self.assertAlmostEqual(result.significance,
+                                   expected[result.phenotype])
+
+    def test_multiple_tasks(self):
+        self.experiment.tasks.insert(1, LinearTest())
+        self.assertRaises(ValueError, self.experiment.run_tasks)
+
+
+class TestLinearMixedTask(TestAbstractTask, unittest.TestCase):
+    def setUp(self):
+        self.task = LinearMixedTest(covariates=["var5"])
+        super(TestLinearMixedTask, self).setUp()
+
+    def _results(self, phenotype):
+        return self.experiment.session.query(LinearMixedTestResults).filter(
+            LinearMixedTestResults.phenotype == phenotype
+        ).order_by(LinearMixedTestResults.entity_name).all()
+
+    def test_outcomes(self):
+        """Only the continuous outcomes are tested."""
+        self.experiment.run_tasks()
+        self.assertEqual([i.name for i in self.task.outcomes],
+                         ["var1", "var2"])
+        self.assertEqual(len(self._results("var1")), 5)
+        self.assertEqual(len(self._results("var3")), 0)
+        self.assertEqual(set(self.task.get_meta("null_models")),
+                         {"var1", "var2"})
+
+    def test_gls(self):
+        """Compare with a generalized least squares fit."""
+        self.experiment.run_tasks()
+
+        phenotypes = self.experiment.phenotypes
+        y = phenotypes.get_phenotype_vector(ContinuousVariable("var1"))
+        covar = phenotypes.get_phenotype_vector(ContinuousVariable("var5"))
+        keep = ~(np.isnan(y) | np.isnan(covar))
+
+        grm = self.task.get_grm(self.experiment).get_matrix(keep)
+        null_model = self.task.null_models["var1"]
+        sigma = grm + null_model["delta"] * np.eye(grm.shape[0])
+
+        for result in self._results("var1"):
+            g = self.experiment.genotypes.get_genotypes(result.entity_name)
+            g = g[keep]
+            g[np.isnan(g)] = np.nanmean(g)
+
+            x = np.vstack((g, np.ones_like(g), covar[keep])).T
+            inverse = np.linalg.inv(sigma)
+            cov = np.linalg.inv(x.T.dot(inverse).dot(x))
+            beta = cov.dot(x.T).dot(inverse).dot(y[keep])
+
+            residuals = y[keep] - x.dot(beta)
+            scale = residuals.dot(inverse).dot(residuals) / (keep.sum() - 3)
+
+            self.assertAlmostEqual(result.coefficient, beta[0])
+            self.assertAlmostEqual(result.standard_error,
+                                   np.sqrt(scale * cov[0, 0]))
+            self.assertAlmostEqual(result.heritability,
+                                   null_model["heritability"])
+
+    def test_null_model(self):
+        """The variance ratio maximizes the likelihood."""
+        np.random.seed(42)
+        n = 300
+        k = np.corrcoef(np.random.normal(size=(n, 50)))
+        s, u = np.linalg.eigh(k)
+        s = np.clip(s, 0, None)
+
+        # Simulate with a heritability of 0.8.
+        y = np.random.multivariate_normal(np.zeros(n),
+                                          0.8 * k + 0.2 * np.eye(n))
+        ux = u.T.dot(np.ones((n, 1)))
+        uy = u.T.dot(y)
+
+        null_model = lmm.fit_null_model(s, uy, ux)
+        ll = null_model["log_likelihood"]
+        for factor in (0.9, 1.1):
+            self.assertLess(
+                lmm._log_likelihood(s, uy, ux,
+                                    null_model["delta"] * factor)[0],
+                ll
+            )
+        self.assertGreater(null_model["heritability"], 0.5)
+
+    def test_grm_samples(self):
+        """The GRM needs to have the samples of the genotype container."""
+        path = os.path.join(self.experiment.name, "other_grm")
+        compute_grm(self.experiment.genotypes, self.experiment.session, path)
+        with open(os.path.join(path, "samples.npy"), "wb") as f:
+            np.save(f, np.array(["s{}".format(i) for i in range(100)]))
+
+        self.task.grm = path
+        self.assertRaises(ValueError, self.experiment.run_tasks)
@@ -19,6 +19,8 @@ import json
 
 from six.moves import range
 from gepyto.formats.gtf import GTFFile
+import numpy as np
+import pandas as pd
 
 
 class AbstractClassException(Exception):
@@ -36,6 +38,91 @@ def expand(s):
     return os.path.expandvars(os.path.expanduser(s))
 
 
+def parse_region(region):
+    """Parse a genomic region.
+
+    :param region: A region formatted as ``chrom:start-end`` or a
+                   ``(chrom, start, end)`` sequence.
+    :type region: str
+
+    :returns: A ``(chrom, start, end)`` tuple.
+    :rtype: tuple
+
+    """
+    if type(region) in (list, tuple):
+        chrom, start, end = region
+    else:
+        try:
+            chrom, bounds = region.rsplit(":", 1)
+            start, end = bounds.split("-")
+        except ValueError:
+            raise ValueError("Invalid region '{}' (expected "
+                             "chrom:start-end).".format(region))
+
+    return str(chrom), int(start), int(end)
+
+
+class SampleIndex(object):
+    """Hash index of sample IDs to their integer position.
+
+    :param samples: The ordered sample IDs.
+    :type samples: list
+
+    It is shared by the genotype and phenotype containers to compute integer
+    gather arrays (`e.g.` the samples to keep after exclusions or the
+    permutation aligning two containers). These arrays can then be applied
+    to whole blocks of data at once.
+
+    """
+    def __init__(self, samples):
+        self.samples = pd.Index(np.asarray(samples))
+        if not self.samples.is_unique:
+            duplicated = self.samples[self.samples.duplicated()]
+            raise ValueError("Samples are not unique ('{}').".format(
+                duplicated[0]
+            ))
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __contains__(self, sample):
+        return sample in self.samples
+
+    def get_indexer(self, samples):
+        """Get the positions of the samples.
+
+        :param samples: A sequence of sample IDs.
+        :type samples: list
+
+        :returns: An integer array of positions (in the order of the
+                  samples).
+        :rtype: np.ndarray
+
+        A ValueError is raised if some samples are not in the index.
+
+        """
+        samples = np.asarray(samples)
+        positions = self.samples.get_indexer(samples)
+
+        missing = positions == -1
+        if np.any(missing):
+            raise ValueError("Sample(s) not in the index: '{}'.".format(
+                "', '".join([str(i) for i in samples[missing]])
+            ))
+
+        return positions
+
+    def get_complement(self, samples):
+        """Get the (sorted) positions of the samples not in the sequence.
+
+        This is used to compute the samples to keep after exclusions.
+
+        """
+        mask = np.ones(len(self), dtype=bool)
+        mask[self.get_indexer(samples)] = False
+        return np.where(mask)[0]
+
+
 def format_time_delta(delta):
     """Format a timedelta object into a human readable representation."""
 
@@ -47,6 +134,12 @@ def format_time_delta(delta):
     return "{:02d}:{:02d}:{:02d}".format(hours, minutes, s)
 
 
+def float_or_none(value):
+    """Convert a value to float, NaN to None (NULL in the database)."""
+    value = float(value)
+    return None if np.isnan(value) else value
+
+
 def abstract(cls):
     """Decorator to be used to mark abstract classes.
 
@@ -202,6 +295,10 @@ class EnsemblAnnotationParser(object):
     This is used because we want to show some hierarchy in the annotation. We
     want gene -> transcript -> exon.
 
+    Every feature is kept as a Python dict, which is not suitable for large
+    annotation files. Use :py:class:`forward.annotation.GeneAnnotation` to
+    query the genes of a complete annotation.
+
     """
     def __init__(self, filename):
         self.genes = {}